@@ -13,8 +13,15 @@
     "module": "",
     "summary": "Generates XML eCDF annual financial reports",
     "data": [
+        "security/ir.model.access.csv",
+        "data/ecdf_report_job_cron.xml",
+        "data/mis_report.xml",
         "views/res_company.xml",
+        "views/account_fiscalyear.xml",
+        "views/ecdf_report_job.xml",
+        "views/ecdf_report_archive.xml",
         "wizard/ecdf_report_view.xml",
+        "wizard/ecdf_report_batch_view.xml",
     ],
     "installable": True,
 }
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+
+from . import ecdf_benchmark
+from . import ecdf_export
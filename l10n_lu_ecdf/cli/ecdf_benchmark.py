@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the eCDF generation on synthetic ledgers
+
+The ledger is generated in the database: companies with a chart of
+accounts holding the PCN codes of the chart of accounts template, two
+fiscal years with their periods, and balanced move lines inserted with
+SQL. The steps of the generation are then timed and the results are
+written in JSON.
+
+The steps are timed with cold caches: the values and the files stored by
+the previous runs are removed before each run. The generation of the file
+is timed again with warm caches, as when it is requested again.
+
+Usage:
+    openerp-server ecdfbenchmark -d <database> --move-lines 100000 \\
+        --companies 10 --output results.json
+
+The generated ledger is rolled back at the end, unless --keep is given.
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+import openerp
+from openerp.cli import Command
+
+# Account selectors of the KPI expressions: bal[...], bale[...], ...
+ACCOUNT_SELECTOR = re.compile(r"bal[pies]?\[([^\]]*)\]")
+
+
+def get_pcn_codes(mis_template):
+    '''
+    :returns: the account codes needed by the expressions of the template,
+              as the most specific code of each pattern: "1061%" gives
+              an account "1061" unless a more specific pattern exists
+    '''
+    codes = set()
+    for kpi in mis_template.kpi_ids:
+        for selector in ACCOUNT_SELECTOR.findall(kpi.expression or ''):
+            for pattern in selector.split(','):
+                pattern = pattern.strip().rstrip('%')
+                if pattern.isdigit():
+                    codes.add(pattern)
+    return sorted(code for code in codes
+                  if not any(other != code and other.startswith(code)
+                             for other in codes))
+
+
+class EcdfLedgerGenerator(object):
+    '''
+    Generates synthetic Luxembourg ledgers
+    '''
+
+    def __init__(self, env, year, seed=0.42):
+        self.env = env
+        self.year = year
+        self.env.cr.execute('SELECT setseed(%s)', (seed,))
+
+    def create_company(self, index):
+        return self.env['res.company'].create({
+            'name': 'eCDF Benchmark %d' % index,
+            'currency_id': self.env.ref('base.EUR').id,
+            'l10n_lu_matricule': '%013d' % (index + 1),
+            'company_registry': 'B%d' % (10000 + index),
+            'vat': 'LU%08d' % (10000000 + index),
+        })
+
+    def create_chart(self, company, codes):
+        '''
+        :returns: the root account of the new chart of accounts
+        '''
+        account_model = self.env['account.account'].with_context(
+            defer_parent_store_computation=True)
+        root = account_model.create({
+            'name': company.name,
+            'code': '0',
+            'type': 'view',
+            'user_type': self.env.ref('account.data_account_type_view').id,
+            'company_id': company.id,
+        })
+        user_types = {
+            '6': self.env.ref('account.data_account_type_expense').id,
+            '7': self.env.ref('account.data_account_type_income').id,
+        }
+        asset_type = self.env.ref('account.data_account_type_asset').id
+        for code in codes:
+            account_model.create({
+                'name': code,
+                'code': code,
+                'type': 'other',
+                'user_type': user_types.get(code[0], asset_type),
+                'parent_id': root.id,
+                'company_id': company.id,
+            })
+        account_model._parent_store_compute()
+        return root
+
+    def create_fiscal_years(self, company):
+        '''
+        :returns: the previous and the current fiscal years, with periods
+        '''
+        fiscal_years = []
+        for year in (self.year - 1, self.year):
+            fiscal_year = self.env['account.fiscalyear'].create({
+                'company_id': company.id,
+                'name': '%s %d' % (company.name, year),
+                'code': str(year),
+                'date_start': '%d-01-01' % year,
+                'date_stop': '%d-12-31' % year,
+            })
+            fiscal_year.create_period()
+            fiscal_years.append(fiscal_year)
+        return fiscal_years
+
+    def create_move_lines(self, company, chart, fiscal_years, count):
+        '''
+        Inserts about "count" posted move lines, two per move, spread over
+        the periods of the fiscal years and over the accounts of the chart
+        '''
+        journal = self.env['account.journal'].create({
+            'name': 'eCDF Benchmark',
+            'code': 'BENCH',
+            'type': 'general',
+            'company_id': company.id,
+        })
+        account_ids = self.env['account.account'].search(
+            [('parent_id', '=', chart.id)]).ids
+        periods = self.env['account.period'].search(
+            [('fiscalyear_id', 'in', [fy.id for fy in fiscal_years]),
+             ('special', '=', False)])
+        moves = max(count // 2, 1)
+        cr = self.env.cr
+        uid = self.env.uid
+        for index, period in enumerate(periods):
+            period_moves = moves // len(periods)
+            if index < moves % len(periods):
+                period_moves += 1
+            if not period_moves:
+                continue
+            cr.execute('''
+                INSERT INTO account_move
+                    (name, ref, journal_id, period_id, date, state,
+                     company_id, to_check,
+                     create_uid, create_date, write_uid, write_date)
+                SELECT 'BENCH/' || s, 'eCDF benchmark', %s, %s, %s,
+                       'posted', %s, false,
+                       %s, now() at time zone 'UTC',
+                       %s, now() at time zone 'UTC'
+                FROM generate_series(1, %s) s
+            ''', (journal.id, period.id, period.date_start, company.id,
+                  uid, uid, period_moves))
+            cr.execute('''
+                WITH moves AS (
+                    SELECT id, name, journal_id, period_id, date,
+                           company_id,
+                           (%s::int[])[1 + floor(random() * %s)::int]
+                               AS debit_account_id,
+                           (%s::int[])[1 + floor(random() * %s)::int]
+                               AS credit_account_id,
+                           round((random() * 10000)::numeric, 2) AS amount
+                    FROM account_move
+                    WHERE journal_id = %s AND period_id = %s
+                )
+                INSERT INTO account_move_line
+                    (name, move_id, account_id, journal_id, period_id,
+                     date, state, company_id, debit, credit,
+                     blocked, centralisation,
+                     create_uid, create_date, write_uid, write_date)
+                SELECT name, id, debit_account_id, journal_id, period_id,
+                       date, 'valid', company_id, amount, 0.0,
+                       false, 'normal',
+                       %s, now() at time zone 'UTC',
+                       %s, now() at time zone 'UTC'
+                FROM moves
+                UNION ALL
+                SELECT name, id, credit_account_id, journal_id, period_id,
+                       date, 'valid', company_id, 0.0, amount,
+                       false, 'normal',
+                       %s, now() at time zone 'UTC',
+                       %s, now() at time zone 'UTC'
+                FROM moves
+            ''', (account_ids, len(account_ids),
+                  account_ids, len(account_ids),
+                  journal.id, period.id,
+                  uid, uid, uid, uid))
+        self.env.invalidate_all()
+        return moves * 2
+
+    def generate(self, companies, move_lines):
+        '''
+        :returns: list of dict(company, chart, fiscal_years, move_lines)
+        '''
+        codes = get_pcn_codes(
+            self.env.ref('l10n_lu_mis_reports.mis_report_ca'))
+        ledgers = []
+        for index in range(companies):
+            company = self.create_company(index)
+            chart = self.create_chart(company, codes)
+            fiscal_years = self.create_fiscal_years(company)
+            count = move_lines // companies
+            if index < move_lines % companies:
+                count += 1
+            ledgers.append({
+                'company': company,
+                'chart': chart,
+                'fiscal_years': fiscal_years,
+                'move_lines': self.create_move_lines(company, chart,
+                                                     fiscal_years, count),
+            })
+        return ledgers
+
+
+class EcdfBenchmarkRunner(object):
+    '''
+    Times the steps of the eCDF generation
+    '''
+
+    def __init__(self, env, companies, repeat=1):
+        '''
+        :param companies: companies of the benchmark
+        '''
+        self.env = env
+        self.companies = companies
+        self.repeat = repeat
+        self.timings = []
+
+    def clear_results(self):
+        '''
+        Removes the values of the KPIs and the files stored for the
+        companies of the benchmark, in the transaction of the benchmark
+        '''
+        self.env.cr.execute('''
+            DELETE FROM ecdf_kpi_result r
+            USING account_account a
+            WHERE a.id = r.chart_account_id AND a.company_id IN %s
+        ''', (tuple(self.companies.ids),))
+        self.env['ecdf.report.archive'].search(
+            [('company_id', 'in', self.companies.ids)]).unlink()
+
+    def measure(self, step, func, cold=True, **params):
+        '''
+        Runs func "repeat" times and records its durations
+        :param cold: clear the caches and the stored results before each
+                     run, or keep them
+        :returns: the result of the last run
+        '''
+        durations = []
+        for dummy in range(self.repeat):
+            if cold:
+                self.clear_results()
+                self.env['ecdf.report'].clear_caches()
+                self.env.invalidate_all()
+            start = time.time()
+            result = func()
+            durations.append(time.time() - start)
+        timing = {
+            'step': step,
+            'cold': cold,
+            'durations': durations,
+            'min': min(durations),
+            'max': max(durations),
+            'mean': sum(durations) / len(durations),
+        }
+        timing.update(params)
+        self.timings.append(timing)
+        return result
+
+    def _get_report(self, ledger):
+        previous_year, current_year = ledger['fiscal_years']
+        return self.env['ecdf.report'].create({
+            'language': 'FR',
+            'target_move': 'posted',
+            'with_pl': True,
+            'with_bs': True,
+            'with_ac': True,
+            'reports_type': 'full',
+            'current_fiscyear': current_year.id,
+            'prev_fiscyear': previous_year.id,
+            'matricule': '1111111111111',
+            'vat': 'LU12345678',
+            'company_registry': 'L123456',
+            'chart_account_id': ledger['chart'].id,
+        })
+
+    def run_report(self, ledger):
+        '''
+        Times the steps of the generation of the file of one company
+        '''
+        report = self._get_report(ledger)
+        fiscal_years = report.current_fiscyear | report.prev_fiscyear
+        for report_def in report._get_reports():
+            mis_template = self.env.ref(report_def['templ'])
+            data = self.measure(
+                'compute',
+                lambda: report.compute_multi(mis_template, fiscal_years),
+                report_type=report_def['type'])
+            data_current = data[report.current_fiscyear.id]
+            if report_def['type'] == 'CA_PLANCOMPTA':
+                self.measure(
+                    '_get_chart_ac',
+                    lambda: report._get_chart_ac(data_current,
+                                                 report_def['type'],
+                                                 report_def['model']),
+                    report_type=report_def['type'])
+            else:
+                data_previous = data[report.prev_fiscyear.id]
+                self.measure(
+                    '_get_finan_report',
+                    lambda: report._get_finan_report(data_current,
+                                                     report_def['type'],
+                                                     report_def['model'],
+                                                     data_previous),
+                    report_type=report_def['type'])
+
+        xml_file = tempfile.TemporaryFile()
+        try:
+            report._write_ecdf_file(xml_file,
+                                    report._allocate_file_reference(),
+                                    [report._get_declarer()])
+            self.measure('validate_xml',
+                         lambda: report._validate_xml_file(xml_file),
+                         size=xml_file.tell())
+        finally:
+            xml_file.close()
+
+        self.measure('print_xml', report.print_xml)
+        # the same request again: the archived file is returned
+        self.measure('print_xml', report.print_xml, cold=False)
+
+    def run_batch(self, ledgers, workers=1):
+        '''
+        Times the generation of one file for all the companies
+        '''
+        batch = self.env['ecdf.report.batch'].create({
+            'language': 'FR',
+            'target_move': 'posted',
+            'reports_type': 'full',
+            'matricule': '1111111111111',
+            'vat': 'LU12345678',
+            'company_registry': 'L123456',
+            'workers': workers,
+            'line_ids': [(0, 0, {
+                'company_id': ledger['company'].id,
+                'current_fiscyear': ledger['fiscal_years'][1].id,
+                'prev_fiscyear': ledger['fiscal_years'][0].id,
+            }) for ledger in ledgers],
+        })
+        self.measure('batch_print_xml', batch.print_xml,
+                     companies=len(ledgers), workers=workers)
+
+
+def run_benchmark(env, companies=1, move_lines=10000, year=2015,
+                  repeat=1, workers=1, seed=0.42, commit=False):
+    '''
+    Generates a synthetic ledger and times the eCDF generation on it
+    :param commit: commit the generated ledger before the measures
+    :returns: the results, as a dict serialisable in JSON
+    '''
+    start = time.time()
+    ledgers = EcdfLedgerGenerator(env, year, seed=seed).generate(
+        companies, move_lines)
+    generation = time.time() - start
+    if commit:
+        env.cr.commit()
+
+    company_records = env['res.company'].browse(
+        [ledger['company'].id for ledger in ledgers])
+    runner = EcdfBenchmarkRunner(env, company_records, repeat=repeat)
+    runner.run_report(ledgers[0])
+    if companies > 1:
+        runner.run_batch(ledgers, workers=workers)
+    return {
+        'parameters': {
+            'companies': companies,
+            'move_lines': move_lines,
+            'year': year,
+            'repeat': repeat,
+            'workers': workers,
+            'seed': seed,
+        },
+        'ledger': {
+            'accounts': len(env['account.account'].search(
+                [('parent_id', '=', ledgers[0]['chart'].id)])),
+            'move_lines': sum(ledger['move_lines'] for ledger in ledgers),
+            'generation': generation,
+        },
+        'timings': runner.timings,
+    }
+
+
+class EcdfBenchmark(Command):
+    """Benchmark the eCDF generation on a synthetic ledger"""
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog="%s ecdfbenchmark" % sys.argv[0].split(os.path.sep)[-1],
+            description=self.__doc__)
+        parser.add_argument('--move-lines', type=int, default=10000,
+                            help="Number of move lines of the ledger, "
+                                 "spread over the companies")
+        parser.add_argument('--companies', type=int, default=1,
+                            help="Number of companies")
+        parser.add_argument('--year', type=int, default=2015,
+                            help="Fiscal year to declare")
+        parser.add_argument('--repeat', type=int, default=1,
+                            help="Number of runs of each step")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Parallel workers of the batch wizard "
+                                 "(requires --keep)")
+        parser.add_argument('--seed', type=float, default=0.42,
+                            help="Seed of the random generator, "
+                                 "between -1 and 1")
+        parser.add_argument('--output',
+                            help="JSON file of the results "
+                                 "(default: standard output)")
+        parser.add_argument('--keep', action='store_true',
+                            help="Commit the generated ledger")
+        args, odoo_args = parser.parse_known_args(cmdargs)
+        if args.workers > 1 and not args.keep:
+            parser.error("--workers requires --keep: the workers only see "
+                         "committed data")
+
+        openerp.tools.config.parse_config(odoo_args)
+        dbname = openerp.tools.config['db_name']
+        if not dbname:
+            parser.error("a database is required (-d)")
+
+        registry = openerp.registry(dbname)
+        with openerp.api.Environment.manage():
+            cr = registry.cursor()
+            try:
+                env = openerp.api.Environment(cr, openerp.SUPERUSER_ID, {})
+                results = run_benchmark(env,
+                                        companies=args.companies,
+                                        move_lines=args.move_lines,
+                                        year=args.year,
+                                        repeat=args.repeat,
+                                        workers=args.workers,
+                                        seed=args.seed,
+                                        commit=args.keep)
+                if args.keep:
+                    cr.commit()
+                else:
+                    cr.rollback()
+            finally:
+                cr.close()
+
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(results, output, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
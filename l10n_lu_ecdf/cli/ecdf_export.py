@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+'''
+Headless export of eCDF files, for scheduled runs
+
+The reports of the given companies and fiscal years are generated with the
+same logic as the eCDF report wizard, without saving wizards, and written
+as validated XML files in an output directory: one file per company, or
+one file for all the companies with --combined (the user's company being
+the agent).
+
+Usage:
+    openerp-server ecdfexport -d <database> --company 123456 \\
+        --company 654321 --fiscal-year 2015 --output-dir /srv/ecdf
+
+The companies are given by their eCDF prefix, the fiscal years by their
+code or name. The identifiers of all the companies are checked before any
+computation; --check-only writes the invalid ones in JSON. The KPI values
+computed are committed, so that the next run only evaluates again the KPIs
+of the accounts having new move lines.
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import openerp
+from openerp.cli import Command
+from openerp.exceptions import Warning as UserError
+from openerp.tools.translate import _
+
+_logger = logging.getLogger(__name__)
+
+REPORT_TYPES = ('ac', 'bs', 'pl')
+
+
+class EcdfExporter(object):
+    '''
+    Generates the eCDF files of companies in a directory
+    '''
+
+    def __init__(self, env, language='FR', target_move='posted',
+                 reports=REPORT_TYPES, reports_type='full', remarks=None,
+                 matricule=None, vat=None, company_registry=None, workers=1):
+        '''
+        :param reports: report types to declare, among "ac" (chart of
+                        accounts), "bs" (balance sheet) and "pl" (profit
+                        and loss)
+        :param matricule, vat, company_registry: agent, the company of
+                        each declarer by default
+        :param workers: number of report types computed at the same time
+        '''
+        self.env = env
+        self.workers = workers
+        self.values = {
+            'language': language,
+            'target_move': target_move,
+            'with_ac': 'ac' in reports,
+            'with_bs': 'bs' in reports,
+            'with_pl': 'pl' in reports,
+            'reports_type': reports_type,
+            'remarks': remarks,
+            'matricule': matricule,
+            'vat': vat,
+            'company_registry': company_registry,
+        }
+
+    def get_companies(self, prefixes):
+        '''
+        :param prefixes: eCDF prefixes of the companies
+        :returns: the companies, in the order of the prefixes
+        '''
+        company_model = self.env['res.company']
+        companies = company_model.browse()
+        for prefix in prefixes:
+            company = company_model.search([('ecdf_prefixe', '=', prefix)])
+            if len(company) != 1:
+                raise UserError(
+                    _('Company not found'),
+                    _('No single company has the eCDF prefix %s') % prefix)
+            companies |= company
+        return companies
+
+    def get_fiscal_years(self, company, fiscal_years):
+        '''
+        :param fiscal_years: codes or names of the fiscal years
+        :returns: the fiscal years of the company
+        '''
+        fiscal_year_model = self.env['account.fiscalyear']
+        res = fiscal_year_model.browse()
+        for name in fiscal_years:
+            fiscal_year = fiscal_year_model.search(
+                [('company_id', '=', company.id),
+                 '|', ('code', '=', name), ('name', '=', name)],
+                limit=1)
+            if not fiscal_year:
+                raise UserError(
+                    _('Fiscal year not found'),
+                    _('The company %s has no fiscal year %s') % (
+                        company.name, name))
+            res |= fiscal_year
+        return res
+
+    def get_report(self, company, fiscal_year=None):
+        '''
+        :returns: an eCDF report wizard (not saved) declaring the fiscal
+                  year of the company, and the fiscal year before it
+        '''
+        chart_account = self.env['ecdf.report.batch']._get_chart_account(
+            company)
+        values = dict(self.values, chart_account_id=chart_account.id)
+        if fiscal_year:
+            values.update({
+                'current_fiscyear': fiscal_year.id,
+                'prev_fiscyear': fiscal_year.get_previous_fiscalyear().id,
+            })
+        report = self.env['ecdf.report'].new(values)
+        report.check_matr()
+        report.check_rcs()
+        report.check_vat()
+        return report
+
+    def get_declarer(self, company, fiscal_years):
+        '''
+        :returns: XML node "Declarer" of the company, declaring all the
+                  fiscal years
+        '''
+        declarer = None
+        for fiscal_year in fiscal_years:
+            node = self.get_report(company, fiscal_year)._get_declarer(
+                workers=self.workers)
+            if declarer is None:
+                declarer = node
+            else:
+                for declaration in list(node.iterchildren('Declaration')):
+                    declarer.append(declaration)
+        return declarer
+
+    def write_file(self, report, output_dir, declarers):
+        '''
+        Writes and validates an eCDF file, named after a new file reference
+        of the report, then renames it: a file of the output directory is
+        always complete and valid
+        :param report: eCDF report wizard giving the agent of the file
+        :param declarers: iterable of XML nodes "Declarer"
+        :returns: path of the file
+        '''
+        reference = report._allocate_file_reference()
+        path = os.path.join(output_dir, reference + '.xml')
+        part_path = path + '.part'
+        try:
+            with open(part_path, 'w+b') as xml_file:
+                report._write_ecdf_file(xml_file, reference, declarers)
+                report._validate_xml_file(xml_file)
+            os.rename(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        _logger.info('eCDF file %s written', path)
+        return path
+
+    def export(self, companies, fiscal_years, output_dir, combined=False):
+        '''
+        :param companies: companies to declare
+        :param fiscal_years: codes or names of the fiscal years to declare
+        :param combined: one file for all the companies, the user's company
+                         being the agent, instead of one file per company
+        :returns: paths of the files written
+        '''
+        # All the identifiers checked before any computation
+        companies.ecdf_assert_identifiers()
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        years_by_company = [(company,
+                             self.get_fiscal_years(company, fiscal_years))
+                            for company in companies]
+        if combined:
+            agent_report = self.get_report(self.env.user.company_id)
+            declarers = (self.get_declarer(company, company_years)
+                         for company, company_years in years_by_company)
+            return [self.write_file(agent_report, output_dir, declarers)]
+        paths = []
+        for company, company_years in years_by_company:
+            declarer = self.get_declarer(company, company_years)
+            report = self.get_report(company, company_years[0])
+            paths.append(self.write_file(report, output_dir, [declarer]))
+        return paths
+
+
+class EcdfExport(Command):
+    """Generate eCDF files in a directory"""
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(
+            prog="%s ecdfexport" % sys.argv[0].split(os.path.sep)[-1],
+            description=self.__doc__)
+        parser.add_argument('--company', action='append', required=True,
+                            dest='companies',
+                            help="eCDF prefix of a company to declare "
+                                 "(repeatable)")
+        parser.add_argument('--fiscal-year', action='append',
+                            dest='fiscal_years',
+                            help="Code or name of a fiscal year to declare "
+                                 "(repeatable)")
+        parser.add_argument('--reports', default=','.join(REPORT_TYPES),
+                            help="Report types, among ac (chart of "
+                                 "accounts), bs (balance sheet) and pl "
+                                 "(profit and loss) (default: all)")
+        parser.add_argument('--abbreviated', action='store_true',
+                            help="Abbreviated balance sheet and profit "
+                                 "and loss")
+        parser.add_argument('--language', default='FR',
+                            choices=['FR', 'DE', 'EN'])
+        parser.add_argument('--all-entries', action='store_true',
+                            help="Include the unposted entries")
+        parser.add_argument('--remarks', help="Comments of the chart of "
+                                              "accounts")
+        parser.add_argument('--matricule', help="Matricule of the agent")
+        parser.add_argument('--vat', help="Tax ID of the agent")
+        parser.add_argument('--company-registry',
+                            help="Company registry of the agent")
+        parser.add_argument('--combined', action='store_true',
+                            help="One file for all the companies, the "
+                                 "user's company being the agent")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Report types computed at the same time")
+        parser.add_argument('--output-dir',
+                            help="Directory of the generated files")
+        parser.add_argument('--check-only', action='store_true',
+                            help="Only check the identifiers of the "
+                                 "companies, and write the invalid ones in "
+                                 "JSON")
+        args, odoo_args = parser.parse_known_args(cmdargs)
+        reports = [r.strip() for r in args.reports.split(',') if r.strip()]
+        unknown = set(reports) - set(REPORT_TYPES)
+        if unknown:
+            parser.error("unknown report types: %s" % ', '.join(unknown))
+        if not args.check_only:
+            if not args.fiscal_years:
+                parser.error("a fiscal year is required (--fiscal-year)")
+            if not args.output_dir:
+                parser.error("an output directory is required "
+                             "(--output-dir)")
+
+        openerp.tools.config.parse_config(odoo_args)
+        dbname = openerp.tools.config['db_name']
+        if not dbname:
+            parser.error("a database is required (-d)")
+
+        registry = openerp.registry(dbname)
+        with openerp.api.Environment.manage():
+            cr = registry.cursor()
+            try:
+                env = openerp.api.Environment(cr, openerp.SUPERUSER_ID, {})
+                exporter = EcdfExporter(
+                    env,
+                    language=args.language,
+                    target_move='all' if args.all_entries else 'posted',
+                    reports=reports,
+                    reports_type='abbreviated' if args.abbreviated
+                    else 'full',
+                    remarks=args.remarks,
+                    matricule=args.matricule,
+                    vat=args.vat,
+                    company_registry=args.company_registry,
+                    workers=args.workers)
+                companies = exporter.get_companies(args.companies)
+                if args.check_only:
+                    errors = companies.ecdf_check_identifiers()
+                    json.dump(errors, sys.stdout, indent=2)
+                    sys.exit(1 if errors else 0)
+                paths = exporter.export(companies, args.fiscal_years,
+                                        args.output_dir,
+                                        combined=args.combined)
+                cr.commit()
+            except UserError as e:
+                cr.rollback()
+                sys.exit('%s: %s' % (e.args[0], e.args[-1]))
+            finally:
+                cr.close()
+
+        for path in paths:
+            sys.stdout.write(path + '\n')
@@ -1 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from . import account_account
+from . import account_fiscalyear
+from . import account_move_line
+from . import ecdf_account_change
+from . import ecdf_balance_snapshot
+from . import ecdf_file_reference
+from . import ecdf_kpi_result
+from . import ecdf_report_archive
+from . import ecdf_report_job
+from . import mis_report
+from . import mis_report_kpi
 from . import res_company
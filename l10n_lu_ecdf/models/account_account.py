@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from openerp import models, api
+
+# Fields of the accounts used to resolve the account codes of the templates
+# in the eCDF wizard
+ECDF_ACCOUNT_FIELDS = ('code', 'parent_id', 'type', 'child_consol_ids')
+
+
+class AccountAccount(models.Model):
+    _inherit = 'account.account'
+
+    @api.model
+    def create(self, vals):
+        self.env['ecdf.report'].clear_caches()
+        return super(AccountAccount, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if any(field in vals for field in ECDF_ACCOUNT_FIELDS):
+            self.env['ecdf.report'].clear_caches()
+        return super(AccountAccount, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['ecdf.report'].clear_caches()
+        return super(AccountAccount, self).unlink()
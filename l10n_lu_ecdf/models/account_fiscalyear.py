@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from datetime import timedelta
+
+from openerp import models, fields, api
+
+
+class AccountFiscalyear(models.Model):
+    _inherit = 'account.fiscalyear'
+
+    ecdf_snapshot_date = fields.Datetime(
+        'eCDF Balances Snapshot',
+        readonly=True,
+        copy=False,
+        help="Date of the snapshot of the balances used by the eCDF "
+             "reports once the fiscal year is closed")
+
+    @api.multi
+    def get_previous_fiscalyear(self):
+        '''
+        :returns: the fiscal year of the same company ending the day before
+                  this one starts
+        '''
+        self.ensure_one()
+        # get the date stop
+        previous_date_stop = datetime.strftime(
+            datetime.strptime(self.date_start, "%Y-%m-%d") -
+            timedelta(days=1),
+            "%Y-%m-%d"
+        )
+        # search fiscal year with the previous date stop as date stop
+        return self.search([('date_stop', '=', previous_date_stop),
+                            ('company_id', '=', self.company_id.id)],
+                           limit=1)
+
+    @api.multi
+    def ecdf_refresh_balance_snapshot(self):
+        '''
+        Button: (re)computes the snapshot of the balances of the fiscal years
+        '''
+        self.env['ecdf.balance.snapshot'].refresh(self)
+        return True
+
+    @api.multi
+    def write(self, vals):
+        res = super(AccountFiscalyear, self).write(vals)
+        if vals.get('state') == 'done':
+            self.ecdf_refresh_balance_snapshot()
+        elif 'state' in vals:
+            # reopened: the snapshot may become stale
+            self.filtered('ecdf_snapshot_date').write(
+                {'ecdf_snapshot_date': False})
+        return res
+
+
+class AccountFiscalyearCloseState(models.TransientModel):
+    _inherit = 'account.fiscalyear.close.state'
+
+    @api.multi
+    def data_save(self):
+        '''
+        The fiscal year is closed with SQL queries: compute its snapshot
+        '''
+        res = super(AccountFiscalyearCloseState, self).data_save()
+        for wizard in self:
+            wizard.fy_id.ecdf_refresh_balance_snapshot()
+        return res
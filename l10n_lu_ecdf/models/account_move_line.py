@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from openerp import models, api
+
+# Fields of the move lines the balances of the accounts depend on
+ECDF_LINE_FIELDS = ('account_id', 'company_id', 'debit', 'credit',
+                    'period_id', 'date', 'move_id', 'journal_id', 'state')
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    @api.model
+    def create(self, vals, check=True):
+        line = super(AccountMoveLine, self).create(vals, check=check)
+        self.env['ecdf.account.change'].record(line.ids)
+        return line
+
+    @api.multi
+    def write(self, vals, check=True, update_check=True):
+        if not any(field in vals for field in ECDF_LINE_FIELDS):
+            return super(AccountMoveLine, self).write(
+                vals, check=check, update_check=update_check)
+        change_model = self.env['ecdf.account.change']
+        # the accounts the lines are moved from, and the ones they are
+        # moved to
+        change_model.record(self.ids)
+        res = super(AccountMoveLine, self).write(
+            vals, check=check, update_check=update_check)
+        if 'account_id' in vals or 'company_id' in vals:
+            change_model.record(self.ids)
+        return res
+
+    @api.multi
+    def unlink(self, check=True):
+        self.env['ecdf.account.change'].record(self.ids)
+        return super(AccountMoveLine, self).unlink(check=check)
+
+
+class AccountMove(models.Model):
+    _inherit = 'account.move'
+
+    @api.multi
+    def post(self):
+        res = super(AccountMove, self).post()
+        self.env['ecdf.account.change'].record_moves(self.ids)
+        return res
+
+    @api.multi
+    def button_cancel(self):
+        self.env['ecdf.account.change'].record_moves(self.ids)
+        return super(AccountMove, self).button_cancel()
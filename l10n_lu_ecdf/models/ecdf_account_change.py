@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+Log of the accounts whose move lines changed
+
+Each creation, modification or removal of move lines records their
+accounts, with the id of the writing transaction. The values of the KPIs
+stored by ecdf.kpi.result are evaluated again for the accounts recorded by
+the transactions which were not committed when they were computed: the
+transactions from the oldest one still running then, so that the lines of
+transactions committed after the computation are not missed.
+
+The log is also the version of the ledger of a company, part of the digest
+of the requests of the archived files.
+'''
+
+from datetime import datetime, timedelta
+
+from openerp import models, fields, api
+
+# Changes kept at least this time, for the generations running meanwhile
+RETENTION = timedelta(days=1)
+
+
+class EcdfAccountChange(models.Model):
+    '''
+    Account having move lines changed by a transaction
+    '''
+    _name = 'ecdf.account.change'
+    _description = 'eCDF Account Change'
+    _log_access = False
+
+    company_id = fields.Many2one('res.company', 'Company',
+                                 required=True,
+                                 index=True,
+                                 ondelete='cascade')
+    account_id = fields.Many2one('account.account', 'Account',
+                                 required=True,
+                                 ondelete='cascade')
+    # transaction id, bigint
+    txid = fields.Float('Transaction', digits=(32, 0), required=True,
+                        index=True)
+    date = fields.Datetime('Date', required=True)
+
+    @api.model
+    def record(self, line_ids):
+        '''
+        Records the accounts of move lines in the current transaction
+        '''
+        if not line_ids:
+            return
+        self.env.cr.execute('''
+            INSERT INTO ecdf_account_change
+                (company_id, account_id, txid, date)
+            SELECT DISTINCT company_id, account_id, txid_current(),
+                   now() at time zone 'UTC'
+            FROM account_move_line
+            WHERE id IN %s
+        ''', (tuple(line_ids),))
+
+    @api.model
+    def record_moves(self, move_ids):
+        '''
+        Records the accounts of the lines of moves posted or cancelled
+        '''
+        if not move_ids:
+            return
+        self.env.cr.execute('SELECT id FROM account_move_line '
+                            'WHERE move_id IN %s', (tuple(move_ids),))
+        self.record([r[0] for r in self.env.cr.fetchall()])
+
+    @api.model
+    def get_state(self, company):
+        '''
+        :returns: dict(xmin, change_id, change_count): the oldest
+                  transaction running now, and the version of the ledger
+                  of the company, the last change and the number of
+                  changes recorded so far
+        '''
+        self.env.cr.execute('''
+            SELECT txid_snapshot_xmin(txid_current_snapshot()),
+                   coalesce(max(id), 0), count(*)
+            FROM ecdf_account_change
+            WHERE company_id = %s
+        ''', (company.id,))
+        xmin, change_id, change_count = self.env.cr.fetchone()
+        return {
+            'xmin': float(xmin),
+            'change_id': change_id,
+            'change_count': change_count + company.ecdf_purged_changes,
+        }
+
+    @api.model
+    def get_account_ids(self, company, xmin):
+        '''
+        :param xmin: oldest transaction running when values were computed
+        :returns: the ids of the accounts of the company changed since
+        '''
+        self.env.cr.execute('''
+            SELECT DISTINCT account_id
+            FROM ecdf_account_change
+            WHERE company_id = %s AND txid >= %s
+        ''', (company.id, xmin))
+        return set(r[0] for r in self.env.cr.fetchall())
+
+    @api.model
+    def purge(self, company):
+        '''
+        Removes the changes of the company older than RETENTION and
+        consumed by all its stored values, except the last one, which
+        holds the version of the ledger
+        '''
+        cr = self.env.cr
+        limit = fields.Datetime.to_string(datetime.now() - RETENTION)
+        cr.execute('''
+            DELETE FROM ecdf_account_change
+            WHERE company_id = %s AND date < %s
+              AND id < (SELECT max(id) FROM ecdf_account_change
+                        WHERE company_id = %s)
+              AND txid < coalesce(
+                  (SELECT min(r.ledger_xmin)
+                   FROM ecdf_kpi_result r
+                   JOIN account_account a ON a.id = r.chart_account_id
+                   WHERE a.company_id = %s),
+                  txid_snapshot_xmin(txid_current_snapshot()))
+        ''', (company.id, limit, company.id, company.id))
+        if cr.rowcount:
+            # the number of changes of the version of the ledger goes on
+            cr.execute('UPDATE res_company '
+                       'SET ecdf_purged_changes = '
+                       'coalesce(ecdf_purged_changes, 0) + %s '
+                       'WHERE id = %s', (cr.rowcount, company.id))
+            company.invalidate_cache(['ecdf_purged_changes'])
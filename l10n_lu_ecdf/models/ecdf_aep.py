@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+'''
+Accounting Expression Processor used by the eCDF wizard
+
+The MIS Builder AEP queries account.move.line once per (domain, mode) and
+per evaluated period. For eCDF declarations the same templates are
+evaluated for several fiscal years in a row, so this processor can be fed
+with balances fetched beforehand, per account and per period, in one
+grouped query covering all the fiscal years to declare.
+
+Templates like the chart of accounts select nested account prefixes
+(bale[10%], bale[101%], ...). With a code index, the balances of such
+patterns are summed bottom-up once per query, each prefix from the
+accounts and the prefixes just below it, instead of summing all the
+accounts of each pattern.
+'''
+
+from collections import defaultdict
+
+from openerp.tools.float_utils import float_is_zero
+from openerp.addons.mis_builder.models.accounting_none import AccountingNone
+from openerp.addons.mis_builder.models.aep import\
+    AccountingExpressionProcessor as AEP
+
+# Modes whose null balances are no values, as in MIS Builder
+ZERO_AS_NONE_MODES = tuple(getattr(AEP, mode)
+                           for mode in ('MODE_INITIAL', 'MODE_UNALLOCATED')
+                           if hasattr(AEP, mode))
+
+
+class EcdfBalances(object):
+    '''
+    Sums of debit and credit of move lines, per account and per period
+
+    The balances can be shared by the processors of several templates of a
+    company: each fetch only queries the accounts and periods not fetched
+    yet, so templates selecting the same accounts aggregate the move lines
+    once.
+    '''
+
+    def __init__(self, env, target_move):
+        self.env = env
+        self.target_move = target_move
+        # {account_id: {period_id: (debit, credit)}}
+        self._data = defaultdict(dict)
+        # {period_id: ids of the accounts fetched for the period}
+        self._fetched = defaultdict(set)
+
+    def covers(self, account_ids, period_ids):
+        '''
+        :returns: True if the balances of these accounts and periods
+                  have been fetched
+        '''
+        return all(self._fetched[period_id].issuperset(account_ids)
+                   for period_id in period_ids)
+
+    def fetch(self, account_ids, period_ids):
+        '''
+        Fetches the debit and credit sums of the given accounts and periods
+        which have not been fetched yet, with one query grouped by account
+        and period.
+        '''
+        account_ids = set(account_ids)
+        missing_account_ids = set()
+        missing_period_ids = set()
+        for period_id in period_ids:
+            missing = account_ids - self._fetched[period_id]
+            if missing:
+                missing_account_ids |= missing
+                missing_period_ids.add(period_id)
+        if missing_account_ids:
+            self._fetch(missing_account_ids, missing_period_ids)
+
+    def _fetch(self, account_ids, period_ids):
+        '''
+        Fetches the debit and credit sums of the given accounts and periods
+        with one query grouped by account and period.
+        Access rules of account.move.line are applied, as in read_group.
+        Periods of closed fiscal years are read from their snapshot.
+        '''
+        snapshot_model = self.env['ecdf.balance.snapshot']
+        snapshot_period_ids = snapshot_model.get_fresh_period_ids(period_ids)
+        if account_ids and snapshot_period_ids:
+            for account_id, period_id, debit, credit in \
+                    snapshot_model.read_balances(account_ids,
+                                                 snapshot_period_ids,
+                                                 self.target_move):
+                self._data[account_id][period_id] = (debit, credit)
+        move_line_period_ids = period_ids - snapshot_period_ids
+        if account_ids and move_line_period_ids:
+            aml_model = self.env['account.move.line']
+            domain = [('account_id', 'in', list(account_ids)),
+                      ('period_id', 'in', list(move_line_period_ids))]
+            if self.target_move == 'posted':
+                domain.append(('move_id.state', '=', 'posted'))
+            query = aml_model._where_calc(domain)
+            aml_model._apply_ir_rules(query, 'read')
+            from_clause, where_clause, where_params = query.get_sql()
+            self.env.cr.execute(
+                'SELECT "account_move_line".account_id, '
+                '"account_move_line".period_id, '
+                'SUM("account_move_line".debit), '
+                'SUM("account_move_line".credit) '
+                'FROM ' + from_clause + ' WHERE ' + where_clause +
+                ' GROUP BY "account_move_line".account_id, '
+                '"account_move_line".period_id',
+                where_params)
+            for account_id, period_id, debit, credit in \
+                    self.env.cr.fetchall():
+                self._data[account_id][period_id] = \
+                    (debit or 0.0, credit or 0.0)
+        for period_id in period_ids:
+            self._fetched[period_id] |= account_ids
+
+    def get(self, account_ids, period_ids):
+        '''
+        :returns: {account_id: (debit, credit)} summed over the periods,
+                  for the accounts having move lines in these periods
+        '''
+        res = {}
+        for account_id in account_ids:
+            account_data = self._data.get(account_id)
+            if not account_data:
+                continue
+            debit = credit = 0.0
+            found = False
+            for period_id in period_ids:
+                if period_id in account_data:
+                    found = True
+                    debit += account_data[period_id][0]
+                    credit += account_data[period_id][1]
+            if found:
+                res[account_id] = (debit, credit)
+        return res
+
+
+class EcdfAEP(AEP):
+    '''
+    AEP able to evaluate the accounting variables from prefetched balances
+
+    Usage: parse_expr() and done_parsing() as usual, then prefetch() with
+    all the periods to compute, then mis.report._compute() once per period.
+    '''
+
+    def __init__(self, env):
+        super(EcdfAEP, self).__init__(env)
+        self._balances = None
+        # {(period_from id, period_to id, target_move): {mode: period_ids}}
+        self._prefetched_periods = {}
+        # code index, see set_code_index()
+        self._prefix_ids = {}
+        self._prefix_parent = {}
+        self._prefix_order = []
+        self._account_prefix = {}
+        self._indexed_account_ids_by_code = None
+
+    def get_parsed_state(self):
+        '''
+        :returns: an immutable copy of the parsed expressions and of the
+                  account ids they resolve to, to be cached and restored
+                  with set_parsed_state().
+        This method must be executed after done_parsing().
+        '''
+        return (
+            tuple((key, tuple(account_ids))
+                  for key, account_ids in self._map_account_ids.items()),
+            tuple((code, frozenset(account_ids))
+                  for code, account_ids in
+                  self._account_ids_by_code.items()),
+        )
+
+    def set_parsed_state(self, state):
+        '''
+        Restores a state returned by get_parsed_state(), in place of
+        parse_expr() and done_parsing().
+        '''
+        map_account_ids, account_ids_by_code = state
+        self._map_account_ids = defaultdict(set)
+        for key, account_ids in map_account_ids:
+            self._map_account_ids[key] = list(account_ids)
+        self._account_ids_by_code = defaultdict(set)
+        for code, account_ids in account_ids_by_code:
+            self._account_ids_by_code[code] = set(account_ids)
+
+    def get_code_index(self):
+        '''
+        :returns: an immutable index of the "prefix%" patterns, to be cached
+                  and restored with set_code_index(): tuple of
+                  (pattern, prefix) and tuple of (account id, code).
+                  Only the patterns resolved to exactly the accounts
+                  whose code starts with the prefix are indexed.
+        This method must be executed after done_parsing().
+        '''
+        account_ids = set()
+        for pattern_account_ids in self._account_ids_by_code.values():
+            account_ids |= pattern_account_ids
+        codes = dict((account['id'], account['code'] or '') for account in
+                     self.env['account.account'].browse(
+                         list(account_ids)).read(['code']))
+        account_ids_by_prefix = defaultdict(set)
+        for account_id, code in codes.items():
+            for i in range(1, len(code) + 1):
+                account_ids_by_prefix[code[:i]].add(account_id)
+        patterns = []
+        for pattern, pattern_account_ids in \
+                self._account_ids_by_code.items():
+            if not pattern or not pattern.endswith('%'):
+                continue
+            prefix = pattern[:-1]
+            if '%' in prefix or '_' in prefix:
+                continue
+            if account_ids_by_prefix.get(prefix) == pattern_account_ids:
+                patterns.append((pattern, prefix))
+        return tuple(sorted(patterns)), tuple(sorted(codes.items()))
+
+    def set_code_index(self, index):
+        '''
+        Restores an index returned by get_code_index(): the indexed patterns
+        are then evaluated from the totals of their prefix
+        '''
+        patterns, account_codes = index
+        self._prefix_ids = {}
+        self._indexed_account_ids_by_code = defaultdict(
+            set, self._account_ids_by_code)
+        for i, (pattern, prefix) in enumerate(patterns):
+            # the total of a prefix is stored in the balances as the one
+            # of a virtual account
+            virtual_id = -(i + 1)
+            self._prefix_ids[prefix] = virtual_id
+            self._indexed_account_ids_by_code[pattern] = set([virtual_id])
+        self._prefix_order = sorted(self._prefix_ids, key=len, reverse=True)
+        self._prefix_parent = {}
+        for prefix in self._prefix_order:
+            self._prefix_parent[prefix] = self._get_deepest_prefix(
+                prefix[:-1])
+        self._account_prefix = {}
+        for account_id, code in account_codes:
+            prefix = self._get_deepest_prefix(code)
+            if prefix is not None:
+                self._account_prefix[account_id] = prefix
+
+    def _get_deepest_prefix(self, code):
+        '''
+        :returns: the longest indexed prefix of the code, or None
+        '''
+        for i in range(len(code), 0, -1):
+            if code[:i] in self._prefix_ids:
+                return code[:i]
+        return None
+
+    def _add_prefix_totals(self):
+        '''
+        Adds the totals of the indexed prefixes to the queried balances,
+        in one bottom-up pass: each prefix sums its own accounts and the
+        prefixes just below it
+        '''
+        if not self._prefix_ids:
+            return
+        for account_data in self._data.values():
+            totals = {}
+            for account_id, (debit, credit) in account_data.items():
+                prefix = self._account_prefix.get(account_id)
+                if prefix is None:
+                    continue
+                total = totals.setdefault(prefix, [0.0, 0.0])
+                total[0] += debit
+                total[1] += credit
+            for prefix in self._prefix_order:
+                total = totals.get(prefix)
+                if total is None:
+                    continue
+                parent = self._prefix_parent[prefix]
+                if parent is not None:
+                    parent_total = totals.setdefault(parent, [0.0, 0.0])
+                    parent_total[0] += total[0]
+                    parent_total[1] += total[1]
+                account_data[self._prefix_ids[prefix]] = tuple(total)
+
+    def replace_expr(self, expr):
+        if not self._prefix_ids:
+            return super(EcdfAEP, self).replace_expr(expr)
+        # evaluate the indexed patterns from the totals of their prefix
+        account_ids_by_code = self._account_ids_by_code
+        self._account_ids_by_code = self._indexed_account_ids_by_code
+        try:
+            return super(EcdfAEP, self).replace_expr(expr)
+        finally:
+            self._account_ids_by_code = account_ids_by_code
+
+    def parse_variable(self, source):
+        '''
+        :param source: accounting variable of an expression, such as
+                       "bale[70%]"
+        :returns: (field, mode, account codes, domain) of the variable,
+                  for get_variable_account_ids() and get_variable_value()
+        '''
+        field, mode, account_codes, domain = self._parse_match_object(
+            self._ACC_RE.search(source))
+        return field, mode, tuple(account_codes), domain
+
+    def get_variable_account_ids(self, variable):
+        '''
+        :param variable: variable returned by parse_variable()
+        :returns: the ids of the accounts whose balances are used by the
+                  variable
+        This method must be executed after done_parsing().
+        '''
+        account_ids = set()
+        for account_code in variable[2]:
+            account_ids.update(self._account_ids_by_code[account_code])
+        return account_ids
+
+    def resolve_variable(self, variable):
+        '''
+        :param variable: variable returned by parse_variable()
+        :returns: (field, mode, domain, account ids) of the variable, the
+                  indexed patterns resolving to the totals of their prefix,
+                  for get_variable_value()
+        This method must be executed after done_parsing(), and after
+        set_code_index() if the patterns are indexed.
+        '''
+        field, mode, account_codes, domain = variable
+        if self._prefix_ids:
+            account_ids_by_code = self._indexed_account_ids_by_code
+        else:
+            account_ids_by_code = self._account_ids_by_code
+        account_ids = []
+        for account_code in account_codes:
+            account_ids.extend(account_ids_by_code[account_code])
+        return field, mode, domain, tuple(account_ids)
+
+    def get_variable_value(self, resolved_variable):
+        '''
+        :param resolved_variable: variable returned by resolve_variable()
+        :returns: the value of the variable, the one replace_expr() would
+                  substitute to it
+        This method must be executed after do_queries().
+        '''
+        field, mode, domain, account_ids = resolved_variable
+        account_ids_data = self._data[(domain, mode)]
+        v = AccountingNone
+        for account_id in account_ids:
+            debit, credit = account_ids_data.get(
+                account_id, (AccountingNone, AccountingNone))
+            if field == 'bal':
+                v += debit - credit
+            elif field == 'deb':
+                v += debit
+            elif field == 'crd':
+                v += credit
+        if v is not AccountingNone and mode in ZERO_AS_NONE_MODES and \
+                float_is_zero(v, precision_digits=2):
+            v = AccountingNone
+        return v
+
+    def set_balances(self, balances):
+        '''
+        Uses balances shared with the processors of other templates
+        :param balances: EcdfBalances of the company
+        '''
+        self._balances = balances
+
+    def _get_prefetch_modes(self):
+        modes = set()
+        for domain, mode in self._map_account_ids:
+            if mode == self.MODE_END and getattr(self, 'smart_end', False):
+                # computed from the initial and variation balances
+                continue
+            modes.add(mode)
+        return modes
+
+    def _get_prefetch_period_ids(self, date_from, date_to,
+                                 period_from, period_to,
+                                 mode, target_move):
+        '''
+        :returns: the ids of the periods that the standard AEP would query
+                  for this mode, or None if its move line domain is not
+                  a plain selection of periods
+        '''
+        domain = self.get_aml_domain_for_dates(date_from, date_to,
+                                               period_from, period_to,
+                                               mode, target_move)
+        period_ids = None
+        for leaf in domain:
+            if leaf == '&':
+                continue
+            if not isinstance(leaf, (list, tuple)):
+                return None
+            if leaf[0] == 'period_id' and leaf[1] == 'in':
+                period_ids = leaf[2]
+            elif target_move == 'posted' and \
+                    tuple(leaf) == ('move_id.state', '=', 'posted'):
+                continue
+            else:
+                return None
+        return period_ids
+
+    def prefetch(self, periods, target_move, account_ids=None):
+        '''
+        Fetches the balances needed to compute all the given periods,
+        with one grouped query on account.move.line.
+        This method must be executed after done_parsing().
+
+        :param periods: list of (date_from, date_to, period_from, period_to)
+        :param target_move: 'posted' or 'all'
+        :param account_ids: fetch only the balances of these accounts, the
+                            other ones being considered as without moves
+        '''
+        if any(domain for domain, mode in self._map_account_ids):
+            # move line filters in expressions: use the standard queries
+            return
+        modes = self._get_prefetch_modes()
+        if account_ids is None:
+            account_ids = set()
+            for account_id_list in self._map_account_ids.values():
+                account_ids.update(account_id_list)
+        all_period_ids = set()
+        for date_from, date_to, period_from, period_to in periods:
+            if not period_from or not period_to:
+                continue
+            period_ids_by_mode = {}
+            for mode in modes:
+                period_ids = self._get_prefetch_period_ids(
+                    date_from, date_to, period_from, period_to,
+                    mode, target_move)
+                if period_ids is None:
+                    break
+                period_ids_by_mode[mode] = frozenset(period_ids)
+            else:
+                key = (period_from.id, period_to.id, target_move)
+                self._prefetched_periods[key] = period_ids_by_mode
+                for period_ids in period_ids_by_mode.values():
+                    all_period_ids.update(period_ids)
+        if self._balances is None or \
+                self._balances.target_move != target_move:
+            self._balances = EcdfBalances(self.env, target_move)
+        self._balances.fetch(account_ids, all_period_ids)
+
+    def do_queries(self, date_from, date_to, period_from, period_to,
+                   target_move, additional_move_line_filter=None):
+        self._do_queries(date_from, date_to, period_from, period_to,
+                         target_move, additional_move_line_filter)
+        self._add_prefix_totals()
+
+    def _do_queries(self, date_from, date_to, period_from, period_to,
+                    target_move, additional_move_line_filter=None):
+        period_ids_by_mode = None
+        if self._balances is not None and period_from and period_to and \
+                not additional_move_line_filter:
+            period_ids_by_mode = self._prefetched_periods.get(
+                (period_from.id, period_to.id, target_move))
+        if period_ids_by_mode is None:
+            return super(EcdfAEP, self).do_queries(
+                date_from, date_to, period_from, period_to,
+                target_move, additional_move_line_filter)
+        # {(domain, mode): {account_id: (debit, credit)}}
+        self._data = defaultdict(dict)
+        ends = []
+        for key, account_ids in self._map_account_ids.items():
+            domain, mode = key
+            if mode not in period_ids_by_mode:
+                ends.append(key)
+                continue
+            self._data[key] = self._balances.get(account_ids,
+                                                 period_ids_by_mode[mode])
+        # compute ending balances by summing initial and variation
+        for key in ends:
+            domain, mode = key
+            initial_data = self._data[(domain, self.MODE_INITIAL)]
+            variation_data = self._data[(domain, self.MODE_VARIATION)]
+            for account_id in set(initial_data) | set(variation_data):
+                di, ci = initial_data.get(account_id, (0.0, 0.0))
+                dv, cv = variation_data.get(account_id, (0.0, 0.0))
+                self._data[key][account_id] = (di + dv, ci + cv)
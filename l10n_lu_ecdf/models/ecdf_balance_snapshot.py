@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+from openerp import SUPERUSER_ID, models, fields, api
+from openerp.exceptions import AccessError
+from openerp.tools.translate import _
+
+
+class EcdfBalanceSnapshot(models.Model):
+    '''
+    Debit and credit of the accounts per period, for closed fiscal years
+
+    Balances of a closed fiscal year never change: they are computed from
+    the move lines when the year is closed (or on demand), and the eCDF
+    wizard reads them from this table instead of the move lines.
+    The table is queried in SQL: the snapshots are only refreshed and read
+    for the companies of the user, as the move lines.
+    '''
+    _name = 'ecdf.balance.snapshot'
+    _description = 'eCDF Balance Snapshot'
+    _log_access = False
+
+    account_id = fields.Many2one('account.account', 'Account',
+                                 required=True,
+                                 index=True,
+                                 ondelete='cascade')
+    fiscalyear_id = fields.Many2one('account.fiscalyear', 'Fiscal Year',
+                                    required=True,
+                                    index=True,
+                                    ondelete='cascade')
+    period_id = fields.Many2one('account.period', 'Period',
+                                required=True,
+                                index=True,
+                                ondelete='cascade')
+    target_move = fields.Selection(
+        [('posted', 'All Posted Entries'), ('all', 'All Entries')],
+        string='Target Moves',
+        required=True
+    )
+    debit = fields.Float('Debit')
+    credit = fields.Float('Credit')
+    balance = fields.Float('Balance')
+
+    @api.model
+    def _get_company_ids(self):
+        '''
+        :returns: the ids of the companies of the user, or None for the
+                  superuser, the multi-company rules not applying to him
+        '''
+        if self.env.uid == SUPERUSER_ID:
+            return None
+        return set(self.env.user.company_ids.ids)
+
+    @api.model
+    def refresh(self, fiscal_years):
+        '''
+        (Re)computes the snapshot of the fiscal years from the move lines,
+        for both target moves
+        '''
+        if not fiscal_years:
+            return
+        self.check_access_rights('write')
+        company_ids = self._get_company_ids()
+        if company_ids is not None and not company_ids.issuperset(
+                fiscal_years.mapped('company_id').ids):
+            raise AccessError(_('You cannot refresh the eCDF balances of '
+                                'the fiscal years of another company.'))
+        cr = self.env.cr
+        cr.execute('DELETE FROM ecdf_balance_snapshot '
+                   'WHERE fiscalyear_id IN %s',
+                   (tuple(fiscal_years.ids),))
+        for target_move in ('all', 'posted'):
+            posted_clause = ''
+            if target_move == 'posted':
+                posted_clause = "AND am.state = 'posted'"
+            cr.execute('''
+                INSERT INTO ecdf_balance_snapshot
+                    (account_id, fiscalyear_id, period_id, target_move,
+                     debit, credit, balance)
+                SELECT aml.account_id, p.fiscalyear_id, aml.period_id, %s,
+                       SUM(aml.debit), SUM(aml.credit),
+                       SUM(aml.debit) - SUM(aml.credit)
+                FROM account_move_line aml
+                JOIN account_period p ON p.id = aml.period_id
+                JOIN account_move am ON am.id = aml.move_id
+                WHERE p.fiscalyear_id IN %s ''' + posted_clause + '''
+                GROUP BY aml.account_id, p.fiscalyear_id, aml.period_id
+            ''', (target_move, tuple(fiscal_years.ids)))
+        fiscal_years.write({'ecdf_snapshot_date': fields.Datetime.now()})
+        self.invalidate_cache()
+
+    @api.model
+    def get_fresh_period_ids(self, period_ids):
+        '''
+        :returns: the ids of the periods, among the given ones, whose
+                  balances can be read from the snapshot: their fiscal year
+                  is closed, its snapshot has been computed and it belongs
+                  to a company of the user
+        '''
+        if not period_ids:
+            return set()
+        self.check_access_rights('read')
+        company_ids = self._get_company_ids()
+        company_clause = ''
+        params = [tuple(period_ids)]
+        if company_ids is not None:
+            if not company_ids:
+                return set()
+            company_clause = 'AND fy.company_id IN %s'
+            params.append(tuple(company_ids))
+        self.env.cr.execute('''
+            SELECT p.id
+            FROM account_period p
+            JOIN account_fiscalyear fy ON fy.id = p.fiscalyear_id
+            WHERE p.id IN %s
+              AND fy.state = 'done'
+              AND fy.ecdf_snapshot_date IS NOT NULL
+        ''' + company_clause, params)
+        return set(r[0] for r in self.env.cr.fetchall())
+
+    @api.model
+    def read_balances(self, account_ids, period_ids, target_move):
+        '''
+        :returns: list of (account_id, period_id, debit, credit), for the
+                  accounts of the companies of the user
+        '''
+        if not account_ids or not period_ids:
+            return []
+        self.check_access_rights('read')
+        company_ids = self._get_company_ids()
+        company_clause = ''
+        params = [tuple(account_ids), tuple(period_ids), target_move]
+        if company_ids is not None:
+            if not company_ids:
+                return []
+            company_clause = 'AND a.company_id IN %s'
+            params.append(tuple(company_ids))
+        self.env.cr.execute('''
+            SELECT s.account_id, s.period_id, s.debit, s.credit
+            FROM ecdf_balance_snapshot s
+            JOIN account_account a ON a.id = s.account_id
+            WHERE s.account_id IN %s
+              AND s.period_id IN %s
+              AND s.target_move = %s
+        ''' + company_clause, params)
+        return self.env.cr.fetchall()
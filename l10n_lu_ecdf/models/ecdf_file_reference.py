@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+Allocation of the references of the eCDF files
+
+A file reference is made of the eCDF prefix of the company, the creation
+second of the file and a sequence number from 01 to 99, telling apart the
+files created in the same second. The references handed out are recorded
+in a table having a unique constraint: concurrent allocations for the same
+prefix and second retry with the next number, and spill over to the next
+second once the 99 numbers are used.
+
+The allocations are committed at once, in their own transaction, so that
+concurrent generations never wait for each other.
+'''
+
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from openerp import models, fields, api
+
+# File type (X for XML files) and creation second of the file
+STAMP_FORMAT = "X%Y%m%dT%H%M%S"
+MAX_SEQUENCE = 99
+# References kept to detect collisions, per prefix
+RETENTION = timedelta(hours=1)
+
+
+class EcdfFileReference(models.Model):
+    '''
+    File reference handed out for a generated eCDF file
+    '''
+    _name = 'ecdf.file.reference'
+    _description = 'eCDF File Reference'
+    _log_access = False
+
+    prefix = fields.Char('eCDF Prefix', size=6, required=True)
+    stamp = fields.Char('Creation Second', size=16, required=True)
+    sequence = fields.Integer('Sequence', required=True)
+
+    _sql_constraints = [
+        ('reference_uniq',
+         'unique(prefix, stamp, sequence)',
+         'A file reference is handed out once.'),
+    ]
+
+    @api.model
+    def _allocate(self, prefix, now=None):
+        '''
+        Allocates a file reference in the current transaction
+        :param prefix: eCDF prefix of the company
+        :param now: creation time of the file, the current time by default
+        :returns: the file reference, 000000XyyyymmddThhmmssNN
+        '''
+        cr = self.env.cr
+        now = now or datetime.now()
+        cr.execute('DELETE FROM ecdf_file_reference '
+                   'WHERE prefix = %s AND stamp < %s',
+                   (prefix, (now - RETENTION).strftime(STAMP_FORMAT)))
+        while True:
+            stamp = now.strftime(STAMP_FORMAT)
+            cr.execute('SELECT max(sequence) FROM ecdf_file_reference '
+                       'WHERE prefix = %s AND stamp = %s', (prefix, stamp))
+            sequence = (cr.fetchone()[0] or 0) + 1
+            while sequence <= MAX_SEQUENCE:
+                try:
+                    with cr.savepoint():
+                        cr.execute('INSERT INTO ecdf_file_reference '
+                                   '(prefix, stamp, sequence) '
+                                   'VALUES (%s, %s, %s)',
+                                   (prefix, stamp, sequence),
+                                   log_exceptions=False)
+                    return '%s%s%02d' % (prefix, stamp, sequence)
+                except psycopg2.IntegrityError:
+                    # allocated meanwhile by another generation
+                    sequence += 1
+            # all the numbers of the second are used
+            now += timedelta(seconds=1)
+
+    @api.model
+    def allocate(self, prefix):
+        '''
+        Allocates a file reference in a transaction of its own, committed
+        at once
+        :param prefix: eCDF prefix of the company
+        :returns: the file reference, 000000XyyyymmddThhmmssNN
+        '''
+        cr = self.pool.cursor()
+        try:
+            reference = self.with_env(self.env(cr=cr))._allocate(prefix)
+            cr.commit()
+        finally:
+            cr.close()
+        return reference
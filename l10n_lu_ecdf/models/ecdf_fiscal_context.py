@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Fiscal year context of the eCDF pipeline
+
+The computation and the XML generation of each report need the periods of
+the declared fiscal years and the values of the first text fields of the
+forms. They are resolved once per fiscal year, with one search covering
+all the fiscal years, and passed through the pipeline.
+'''
+
+from datetime import datetime
+
+
+class EcdfFiscalContext(object):
+    '''
+    Periods and form values of a fiscal year, for a company
+    '''
+
+    def __init__(self, fiscal_year, periods, currency):
+        '''
+        :param periods: the periods of the fiscal year, sorted by date,
+                        without the special periods
+        '''
+        self.fiscal_year = fiscal_year
+        self.periods = periods
+        self.currency = currency
+        self.period_from = periods[0] if periods else None
+        self.period_to = periods[-1] if periods else None
+        self.year = None
+        self.text_fields = ()
+        if periods:
+            date_start = datetime.strptime(self.period_from.date_start,
+                                           "%Y-%m-%d")
+            date_stop = datetime.strptime(self.period_to.date_stop,
+                                          "%Y-%m-%d")
+            self.year = date_start.strftime("%Y")
+            # TextField 01, 02 and 03 of the forms
+            self.text_fields = (('01', date_start.strftime("%d/%m/%Y")),
+                                ('02', date_stop.strftime("%d/%m/%Y")),
+                                ('03', currency.name))
+
+    @classmethod
+    def resolve(cls, env, fiscal_years, currency):
+        '''
+        :param fiscal_years: fiscal years to resolve
+        :param currency: currency of the company
+        :returns: dict {fiscal year id: EcdfFiscalContext}
+        '''
+        period_model = env['account.period']
+        period_ids_by_year = dict((fiscal_year.id, [])
+                                  for fiscal_year in fiscal_years)
+        periods = period_model.search(
+            [('special', '=', False),
+             ('fiscalyear_id', 'in', fiscal_years.ids)])
+        for period in periods.sorted(key=lambda r: r.date_start):
+            period_ids_by_year[period.fiscalyear_id.id].append(period.id)
+        return dict((fiscal_year.id,
+                     cls(fiscal_year,
+                         period_model.browse(
+                             period_ids_by_year[fiscal_year.id]),
+                         currency))
+                    for fiscal_year in fiscal_years)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+Compact KPI values of the eCDF pipeline
+
+The values computed for a template and a fiscal year are kept as a column
+of floats and a column of flags telling the missing values apart, sharing
+the names of the KPIs with all the values of the template, instead of one
+dict per KPI: the chart of accounts alone has more than a thousand KPIs
+per company and fiscal year.
+
+For compatibility, the values can still be read as a list of dict(kpi_name,
+kpi_technical_name, val).
+'''
+
+from array import array
+
+from openerp.addons.mis_builder.models.accounting_none import AccountingNone
+
+# Flags of the values
+VALUE = 0
+NONE = 1
+ACCOUNTING_NONE = 2
+# values which are not numbers, kept as they are
+OTHER = 3
+
+
+class EcdfKpiTable(object):
+    '''
+    Names of the KPIs of a template, in the order of its KPIs
+    '''
+    __slots__ = ('names', 'technical_names')
+
+    def __init__(self, names, technical_names):
+        '''
+        :param names: tuple of the descriptions of the KPIs
+        :param technical_names: tuple of the technical names of the KPIs
+        '''
+        self.names = names
+        self.technical_names = technical_names
+
+    def __len__(self):
+        return len(self.technical_names)
+
+
+class EcdfKpiData(object):
+    '''
+    Values of the KPIs of a template for a fiscal year
+    '''
+    __slots__ = ('table', 'values', 'flags', 'others')
+
+    def __init__(self, table, values):
+        '''
+        :param table: EcdfKpiTable of the template
+        :param values: iterable of the values, in the order of the table
+        '''
+        self.table = table
+        self.values = array('d', [0.0]) * len(table)
+        self.flags = bytearray(len(table))
+        self.others = None
+        for index, val in enumerate(values):
+            if val is None:
+                self.flags[index] = NONE
+            elif val is AccountingNone:
+                self.flags[index] = ACCOUNTING_NONE
+            elif isinstance(val, (int, float)) and \
+                    not isinstance(val, bool):
+                self.values[index] = val
+            else:
+                if self.others is None:
+                    self.others = {}
+                self.flags[index] = OTHER
+                self.others[index] = val
+
+    @classmethod
+    def from_dict(cls, table, values):
+        '''
+        :param table: EcdfKpiTable of the template
+        :param values: dict {KPI technical name: value}, the KPIs not in
+                       the dict having no value
+        '''
+        return cls(table, (values.get(name)
+                           for name in table.technical_names))
+
+    @classmethod
+    def wrap(cls, data):
+        '''
+        :param data: EcdfKpiData, or list of dict(kpi_name,
+                     kpi_technical_name, val)
+        :returns: the data as EcdfKpiData
+        '''
+        if data is None or isinstance(data, cls):
+            return data
+        table = EcdfKpiTable(
+            tuple(report['kpi_name'] for report in data),
+            tuple(report['kpi_technical_name'] for report in data))
+        return cls(table, (report['val'] for report in data))
+
+    def get_val(self, index):
+        '''
+        :returns: the value of the KPI at this index, None or AccountingNone
+                  if it has no value
+        '''
+        flag = self.flags[index]
+        if flag == VALUE:
+            return self.values[index]
+        if flag == NONE:
+            return None
+        if flag == ACCOUNTING_NONE:
+            return AccountingNone
+        return self.others[index]
+
+    def has_val(self, index):
+        '''
+        :returns: True if the KPI at this index has a value
+        '''
+        return self.flags[index] in (VALUE, OTHER)
+
+    def get_kpi_name(self, index):
+        return self.table.names[index]
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return {'kpi_name': self.table.names[index],
+                'kpi_technical_name': self.table.technical_names[index],
+                'val': self.get_val(index)}
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __eq__(self, other):
+        if isinstance(other, EcdfKpiData) and other.table is self.table:
+            return self.flags == other.flags and \
+                self.values == other.values and \
+                self.others == other.others
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'EcdfKpiData(%r)' % list(self)
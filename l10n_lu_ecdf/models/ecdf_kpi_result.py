@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+
+from openerp import models, fields, api
+from openerp.addons.mis_builder.models.accounting_none import AccountingNone
+
+# Encoding of AccountingNone in the stored values
+ACCOUNTING_NONE = 'AccountingNone'
+
+
+class EcdfKpiResult(models.Model):
+    '''
+    Last computed values of the KPIs of a template, for a chart of accounts
+    and a fiscal year
+
+    The state of the ledger is stored with the values: when the eCDF file is
+    generated again, only the KPIs using accounts having new, modified or
+    removed move lines since then are evaluated again (see
+    ecdf.account.change).
+    '''
+    _name = 'ecdf.kpi.result'
+    _description = 'eCDF KPI Result'
+
+    chart_account_id = fields.Many2one('account.account', 'Chart of Account',
+                                       required=True,
+                                       index=True,
+                                       ondelete='cascade')
+    fiscalyear_id = fields.Many2one('account.fiscalyear', 'Fiscal Year',
+                                    required=True,
+                                    ondelete='cascade')
+    mis_report_id = fields.Many2one('mis.report', 'MIS Template',
+                                    required=True,
+                                    ondelete='cascade')
+    target_move = fields.Selection(
+        [('posted', 'All Posted Entries'), ('all', 'All Entries')],
+        string='Target Moves',
+        required=True
+    )
+    # Template, chart of accounts and periods the values were computed with
+    signature = fields.Char('Signature', required=True)
+    # Oldest transaction running when the values were computed
+    ledger_xmin = fields.Float('Ledger Transaction', digits=(32, 0))
+    values = fields.Text('Values')
+
+    _sql_constraints = [
+        ('result_uniq',
+         'unique(chart_account_id, fiscalyear_id, mis_report_id, '
+         'target_move)',
+         'The values of a template are stored once per fiscal year.'),
+    ]
+
+    @api.model
+    def get_ledger_state(self, company):
+        '''
+        :returns: the state of the ledger of the company, read from the log
+                  of the changes of its move lines, without reading them:
+                  dict(xmin, change_id, change_count), see
+                  ecdf.account.change.get_state
+        '''
+        return self.env['ecdf.account.change'].get_state(company)
+
+    @api.model
+    def get_signature(self, chart_account, mis_template, fiscal_context):
+        '''
+        :param fiscal_context: EcdfFiscalContext of the fiscal year
+        :returns: a digest of what the values depend on, beside the move
+                  lines: the expressions of the template, the accounts of
+                  the company and the periods of the fiscal year
+        '''
+        self.env.cr.execute('''
+            SELECT count(*), max(write_date)
+            FROM account_account
+            WHERE company_id = %s
+        ''', (chart_account.company_id.id,))
+        accounts = self.env.cr.fetchone()
+        digest = hashlib.sha1(json.dumps([
+            [(kpi.name, kpi.expression) for kpi in mis_template.kpi_ids],
+            [chart_account.id, accounts[0], str(accounts[1])],
+            fiscal_context.periods.ids,
+        ]))
+        return digest.hexdigest()
+
+    @api.model
+    def find(self, chart_account, fiscal_year, mis_template, target_move):
+        return self.search([('chart_account_id', '=', chart_account.id),
+                            ('fiscalyear_id', '=', fiscal_year.id),
+                            ('mis_report_id', '=', mis_template.id),
+                            ('target_move', '=', target_move)],
+                           limit=1)
+
+    @api.multi
+    def get_changed_account_ids(self):
+        '''
+        :returns: the ids of the accounts having move lines created,
+                  modified or removed by the transactions not committed
+                  when the values were computed, or None if the values were
+                  stored without the state of the ledger: all the values
+                  must be computed again
+        '''
+        self.ensure_one()
+        if not self.ledger_xmin:
+            return None
+        return self.env['ecdf.account.change'].get_account_ids(
+            self.chart_account_id.company_id, self.ledger_xmin)
+
+    @api.multi
+    def get_values(self):
+        '''
+        :returns: dict {KPI name: value}
+        '''
+        self.ensure_one()
+        values = json.loads(self.values or '{}')
+        for name, val in values.items():
+            if val == ACCOUNTING_NONE:
+                values[name] = AccountingNone
+        return values
+
+    @api.model
+    def store(self, chart_account, fiscal_year, mis_template, target_move,
+              signature, ledger_state, values):
+        '''
+        Stores the values of the KPIs of a template, with the state of the
+        ledger they were computed from
+        :param values: dict {KPI name: value}
+        '''
+        encoded = {}
+        for name, val in values.items():
+            if val is AccountingNone:
+                val = ACCOUNTING_NONE
+            elif val is not None:
+                try:
+                    val = float(val)
+                except (TypeError, ValueError):
+                    # not a value that can be stored: compute it next time
+                    signature = False
+                    break
+            encoded[name] = val
+        result = self.find(chart_account, fiscal_year, mis_template,
+                           target_move)
+        if not signature:
+            result.unlink()
+            return
+        vals = {'ledger_xmin': ledger_state['xmin'],
+                'signature': signature,
+                'values': json.dumps(encoded)}
+        if result:
+            result.write(vals)
+        else:
+            vals.update({'chart_account_id': chart_account.id,
+                         'fiscalyear_id': fiscal_year.id,
+                         'mis_report_id': mis_template.id,
+                         'target_move': target_move})
+            self.create(vals)
+        self.env['ecdf.account.change'].purge(chart_account.company_id)
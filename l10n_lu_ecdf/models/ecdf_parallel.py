@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+Runs independent eCDF computations in worker threads, each worker having
+its own database cursor
+'''
+
+import logging
+import Queue
+import threading
+
+import openerp
+from openerp import api
+
+_logger = logging.getLogger(__name__)
+
+
+def export_snapshot(env):
+    '''
+    Exports the snapshot of the transaction of the caller, so that workers
+    see the same data. The snapshot remains valid until the transaction
+    ends. The changes not committed by the caller are not part of it.
+    :returns: identifier of the snapshot
+    '''
+    env.cr.execute('SELECT pg_export_snapshot()')
+    return env.cr.fetchone()[0]
+
+
+def run_in_workers(env, tasks, workers=1, snapshot=None):
+    '''
+    Runs tasks in worker threads, each worker having its own cursor.
+    Workers only see committed data and roll back their transaction when
+    done, so tasks must be read-only and return plain values (no records,
+    no XML nodes).
+
+    :param env: environment of the caller
+    :param tasks: list of callables taking an environment as argument
+    :param workers: number of worker threads; with 1 worker, the tasks run
+                    in the environment of the caller
+    :param snapshot: optional snapshot exported by the caller, imported by
+                     the repeatable read transaction of each worker
+    :returns: list of the results of the tasks, in the same order
+    '''
+    if workers <= 1 or len(tasks) <= 1:
+        return [task(env) for task in tasks]
+
+    dbname = env.cr.dbname
+    uid = env.uid
+    context = dict(env.context)
+    results = [None] * len(tasks)
+    errors = []
+    queue = Queue.Queue()
+    for index, task in enumerate(tasks):
+        queue.put((index, task))
+
+    def work():
+        with api.Environment.manage():
+            cr = openerp.registry(dbname).cursor()
+            try:
+                if snapshot:
+                    # must be the first query of the transaction
+                    cr.execute('SET TRANSACTION ISOLATION LEVEL '
+                               'REPEATABLE READ')
+                    cr.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                worker_env = api.Environment(cr, uid, context)
+                while not errors:
+                    try:
+                        index, task = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    results[index] = task(worker_env)
+                    worker_env.invalidate_all()
+            except Exception as e:
+                _logger.exception('eCDF worker failed')
+                errors.append(e)
+            finally:
+                cr.rollback()
+                cr.close()
+
+    threads = [threading.Thread(target=work, name='ecdf-worker-%d' % i)
+               for i in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Instrumentation of the eCDF generation
+
+A profiler records, per stage of the generation and per report type, the
+wall time, the number of SQL queries and the number of rows they returned
+or affected. The queries are counted by wrapping the execute() method of
+the cursor while a stage runs.
+'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class EcdfProfiler(object):
+    '''
+    Records the statistics of the stages of an eCDF generation
+    A profiler without cursor is disabled: its stages record nothing.
+    '''
+
+    def __init__(self, cr=None):
+        self.cr = cr
+        # {(stage, report_type): [duration, queries, rows]}
+        self._stats = OrderedDict()
+
+    @contextmanager
+    def stage(self, stage, report_type=None):
+        '''
+        Context manager recording the statistics of a stage
+        Nested stages are recorded in the enclosing stages too.
+        '''
+        if self.cr is None:
+            yield
+            return
+        cr = self.cr
+        counters = [0, 0]
+        patched = 'execute' in vars(cr)
+        execute = cr.execute
+
+        def counting_execute(query, params=None, log_exceptions=None):
+            res = execute(query, params, log_exceptions)
+            counters[0] += 1
+            counters[1] += max(cr.rowcount, 0)
+            return res
+
+        cr.execute = counting_execute
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            if patched:
+                cr.execute = execute
+            else:
+                del cr.execute
+            stats = self._stats.setdefault((stage, report_type), [0.0, 0, 0])
+            stats[0] += duration
+            stats[1] += counters[0]
+            stats[2] += counters[1]
+
+    def merge(self, other):
+        '''
+        Adds the statistics recorded by another profiler, such as the one of
+        a worker
+        '''
+        for key, (duration, queries, rows) in other._stats.items():
+            stats = self._stats.setdefault(key, [0.0, 0, 0])
+            stats[0] += duration
+            stats[1] += queries
+            stats[2] += rows
+
+    def get_stats(self):
+        '''
+        :returns: list of dict(stage, report_type, duration, queries, rows)
+                  in the order of the stages
+        '''
+        return [{'stage': stage,
+                 'report_type': report_type,
+                 'duration': round(duration, 3),
+                 'queries': queries,
+                 'rows': rows}
+                for (stage, report_type), (duration, queries, rows)
+                in self._stats.items()]
+
+    def format(self):
+        '''
+        :returns: the statistics as a text table
+        '''
+        lines = ['%-12s %-14s %10s %8s %10s' % ('Stage', 'Report',
+                                                'Time (s)', 'Queries',
+                                                'Rows')]
+        for stats in self.get_stats():
+            lines.append('%-12s %-14s %10.3f %8d %10d' % (
+                stats['stage'], stats['report_type'] or '',
+                stats['duration'], stats['queries'], stats['rows']))
+        return '\n'.join(lines)
+
+    def log(self, file_reference):
+        '''
+        Logs the statistics as one JSON line
+        '''
+        _logger.info('eCDF profile %s %s', file_reference,
+                     json.dumps(self.get_stats()))
+
+
+# Profiler used when the instrumentation is not enabled
+NO_PROFILER = EcdfProfiler()
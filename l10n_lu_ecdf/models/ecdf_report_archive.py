@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+'''
+Archive of the generated eCDF files
+
+The files generated by the eCDF wizard are attached to the declared fiscal
+year, and indexed by a digest of the request: the versions of the
+templates, the state of the ledger and the parameters of the wizard. The
+same request returns the archived file instead of computing it again.
+
+Files with the same content, apart from their reference, share the same
+attachment: each archive keeps its own reference, which is written back in
+the shared content when the archived file is returned.
+'''
+
+import base64
+import hashlib
+import re
+
+from openerp import models, fields, api
+
+# Size of the base64 chunks decoded at once
+CHUNK_SIZE = 4 * 65536
+# End of the header part depending on the file reference
+FILE_REFERENCE_END = '</FileReference>'
+FILE_REFERENCE = re.compile(r'<FileReference>[^<]*</FileReference>')
+
+
+def get_content_hash(datas):
+    '''
+    :param datas: content of an eCDF file, encoded in base64
+    :returns: digest of the content following the file reference
+    '''
+    digest = hashlib.sha1()
+    header = True
+    rest = ''
+    for start in range(0, len(datas), CHUNK_SIZE):
+        # decode whole groups of 4 characters, without the line breaks
+        chunk = rest + datas[start:start + CHUNK_SIZE].replace('\n', '')
+        size = len(chunk) - len(chunk) % 4
+        rest = chunk[size:]
+        content = base64.b64decode(chunk[:size])
+        if header:
+            # the header is far smaller than a chunk
+            index = content.find(FILE_REFERENCE_END)
+            if index >= 0:
+                content = content[index + len(FILE_REFERENCE_END):]
+            header = False
+        digest.update(content)
+    return digest.hexdigest()
+
+
+class EcdfReportArchive(models.Model):
+    '''
+    eCDF file generated for a request
+    '''
+    _name = 'ecdf.report.archive'
+    _description = 'eCDF Report Archive'
+    _order = 'id desc'
+
+    company_id = fields.Many2one('res.company', 'Company',
+                                 required=True,
+                                 readonly=True,
+                                 ondelete='cascade')
+    fiscalyear_id = fields.Many2one('account.fiscalyear', 'Fiscal Year',
+                                    required=True,
+                                    readonly=True,
+                                    ondelete='cascade')
+    user_id = fields.Many2one('res.users', 'User',
+                              readonly=True,
+                              default=lambda self: self.env.user)
+    file_reference = fields.Char('File name', size=24, readonly=True)
+    request_hash = fields.Char('Request', required=True, readonly=True,
+                               index=True)
+    content_hash = fields.Char('Content', required=True, readonly=True,
+                               index=True)
+    attachment_id = fields.Many2one('ir.attachment', 'XML File',
+                                    required=True,
+                                    readonly=True)
+
+    _sql_constraints = [
+        ('request_uniq',
+         'unique(company_id, request_hash)',
+         'A request is archived once per company.'),
+    ]
+
+    @api.model
+    def find(self, company, request_hash):
+        return self.search([('company_id', '=', company.id),
+                            ('request_hash', '=', request_hash)],
+                           limit=1)
+
+    @api.model
+    def archive(self, company, fiscal_year, request_hash, file_reference,
+                datas):
+        '''
+        Archives a generated file, sharing the attachment of a file with
+        the same content if any. The attachments are managed by the
+        archives, whatever the access rights of the user on the fiscal
+        years.
+        :param fiscal_year: declared fiscal year, holding the attachment
+        :param datas: content of the file, encoded in base64
+        :returns: the archive of the request
+        '''
+        content_hash = get_content_hash(datas)
+        same_content = self.search([('company_id', '=', company.id),
+                                    ('content_hash', '=', content_hash)],
+                                   limit=1)
+        if same_content:
+            attachment = same_content.attachment_id
+        else:
+            attachment = self.env['ir.attachment'].sudo().create({
+                'name': file_reference + '.xml',
+                'datas_fname': file_reference + '.xml',
+                'datas': datas,
+                'res_model': fiscal_year._name,
+                'res_id': fiscal_year.id,
+                'company_id': company.id,
+            })
+        vals = {'fiscalyear_id': fiscal_year.id,
+                'file_reference': file_reference,
+                'content_hash': content_hash,
+                'attachment_id': attachment.id}
+        archive = self.find(company, request_hash)
+        if archive:
+            previous = archive.attachment_id
+            archive.write(vals)
+            if previous != attachment and not self.search(
+                    [('attachment_id', '=', previous.id)]):
+                previous.sudo().unlink()
+        else:
+            vals.update({'company_id': company.id,
+                         'request_hash': request_hash})
+            archive = self.create(vals)
+        return archive
+
+    @api.multi
+    def unlink(self):
+        '''
+        Removes the attachments which are no longer shared
+        '''
+        attachments = self.mapped('attachment_id')
+        res = super(EcdfReportArchive, self).unlink()
+        shared = self.search([('attachment_id', 'in', attachments.ids)])
+        (attachments - shared.mapped('attachment_id')).sudo().unlink()
+        return res
+
+    @api.multi
+    def get_datas(self):
+        '''
+        :returns: the archived file with the reference of the archive,
+                  encoded in base64
+        '''
+        self.ensure_one()
+        datas = self.attachment_id.datas
+        if self.attachment_id.datas_fname == self.file_reference + '.xml':
+            return datas
+        # attachment shared with a file of another reference
+        content = FILE_REFERENCE.sub(
+            '<FileReference>%s</FileReference>' % self.file_reference,
+            base64.b64decode(datas), count=1)
+        return base64.b64encode(content)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+'''
+Background generation of eCDF files
+
+The eCDF wizard can enqueue its computation as a job, which is run by a
+scheduled action. The progress is stored per report type and per fiscal
+year, and the generated file is attached to the job.
+
+A job runs with the rights of the user who enqueued it. The scheduled
+action holds a session lock on the job while running it, kept across the
+commits of the progress and released with the connection of a crashed
+server: a running job which is not locked, left by a crashed server, is
+pending again for the next scheduled action, and a job is never run by
+two scheduled actions at once, however long its declarations take.
+'''
+
+import logging
+import traceback
+
+from openerp import models, fields, api
+from openerp.tools.translate import _
+
+_logger = logging.getLogger(__name__)
+
+# Fields of the job which are values of the eCDF report wizard
+REPORT_FIELDS = ('chart_account_id', 'current_fiscyear', 'prev_fiscyear',
+                 'language', 'target_move', 'with_pl', 'with_bs', 'with_ac',
+                 'reports_type', 'remarks', 'matricule', 'vat',
+                 'company_registry')
+
+
+class EcdfReportJob(models.Model):
+    '''
+    Generation of an eCDF file in the background
+    '''
+    _name = 'ecdf.report.job'
+    _description = 'eCDF Report Job'
+    _order = 'id desc'
+
+    name = fields.Char('Name', compute='_compute_name')
+    state = fields.Selection([('pending', 'Pending'),
+                              ('running', 'Running'),
+                              ('done', 'Done'),
+                              ('failed', 'Failed')],
+                             'State',
+                             required=True,
+                             readonly=True,
+                             default='pending')
+    user_id = fields.Many2one('res.users', 'User',
+                              readonly=True,
+                              default=lambda self: self.env.user)
+    company_id = fields.Many2one('res.company', 'Company',
+                                 required=True,
+                                 readonly=True)
+    date_start = fields.Datetime('Started on', readonly=True)
+    date_done = fields.Datetime('Done on', readonly=True)
+    date_heartbeat = fields.Datetime('Last Heartbeat', readonly=True)
+    error = fields.Text('Error', readonly=True)
+    step_ids = fields.One2many('ecdf.report.job.step', 'job_id', 'Progress',
+                               readonly=True)
+    progress = fields.Float('Progress (%)', compute='_compute_progress')
+    attachment_id = fields.Many2one('ir.attachment', 'XML File',
+                                    readonly=True)
+    # Values of the eCDF report wizard
+    chart_account_id = fields.Many2one('account.account',
+                                       'Chart of Account',
+                                       required=True,
+                                       readonly=True)
+    current_fiscyear = fields.Many2one('account.fiscalyear',
+                                       'Current Fiscal Year',
+                                       required=True,
+                                       readonly=True)
+    prev_fiscyear = fields.Many2one('account.fiscalyear',
+                                    'Previous Fiscal Year',
+                                    readonly=True)
+    language = fields.Selection(
+        (('FR', 'FR'), ('DE', 'DE'), ('EN', 'EN')),
+        'Language',
+        required=True,
+        readonly=True
+    )
+    target_move = fields.Selection(
+        [('posted', 'All Posted Entries'), ('all', 'All Entries')],
+        string='Target Moves',
+        required=True,
+        readonly=True
+    )
+    with_pl = fields.Boolean('Profit & Loss', readonly=True)
+    with_bs = fields.Boolean('Balance Sheet', readonly=True)
+    with_ac = fields.Boolean('Chart of Accounts', readonly=True)
+    reports_type = fields.Selection((('full', 'Full'),
+                                     ('abbreviated', 'Abbreviated')),
+                                    'Reports Type',
+                                    required=True,
+                                    readonly=True)
+    remarks = fields.Text('Comments', readonly=True)
+    matricule = fields.Char('Matricule', size=13, readonly=True)
+    vat = fields.Char("Tax ID", size=10, readonly=True)
+    company_registry = fields.Char('Company Registry', size=7,
+                                   readonly=True)
+
+    @api.multi
+    @api.depends('company_id', 'current_fiscyear')
+    def _compute_name(self):
+        for job in self:
+            job.name = '%s - %s' % (job.company_id.name,
+                                    job.current_fiscyear.name)
+
+    @api.multi
+    @api.depends('step_ids.state')
+    def _compute_progress(self):
+        for job in self:
+            if job.step_ids:
+                done = job.step_ids.filtered(lambda s: s.state == 'done')
+                job.progress = 100.0 * len(done) / len(job.step_ids)
+            else:
+                job.progress = 0.0
+
+    @api.multi
+    def _get_report(self):
+        '''
+        :returns: an eCDF report wizard (not saved) with the values of
+                  the job
+        '''
+        self.ensure_one()
+        values = {}
+        for field in REPORT_FIELDS:
+            value = self[field]
+            if isinstance(value, models.BaseModel):
+                value = value.id
+            values[field] = value
+        return self.env['ecdf.report'].new(values)
+
+    @api.multi
+    def _try_lock(self):
+        '''
+        Locks the job for the database session, until _unlock()
+        :returns: True if locked, False if locked by another session
+        '''
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT pg_try_advisory_lock("
+            "'ecdf_report_job'::regclass::oid::integer, %s)", (self.id,))
+        return self.env.cr.fetchone()[0]
+
+    @api.multi
+    def _unlock(self):
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT pg_advisory_unlock("
+            "'ecdf_report_job'::regclass::oid::integer, %s)", (self.id,))
+
+    @api.multi
+    def run(self, autocommit=False):
+        '''
+        Generates the eCDF file of the job and attaches it to the job
+        :param autocommit: commit the progress after each report, so it
+                           can be followed by the users (scheduled action)
+        '''
+        for job in self:
+            job.write({'state': 'running',
+                       'date_start': fields.Datetime.now(),
+                       'date_heartbeat': fields.Datetime.now(),
+                       'error': False})
+            job.step_ids.write({'state': 'pending'})
+            if autocommit:
+                self.env.cr.commit()
+
+            def progress(report_type, fiscal_years):
+                job.step_ids.filtered(
+                    lambda s: s.report_type == report_type and
+                    s.fiscalyear_id in fiscal_years
+                ).write({'state': 'done'})
+                job.date_heartbeat = fields.Datetime.now()
+                if autocommit:
+                    self.env.cr.commit()
+
+            report = job._get_report()
+            ref = report._allocate_file_reference()
+            datas = report._generate_xml_file(
+                ref, [report._get_declarer(progress=progress)])
+            attachment = self.env['ir.attachment'].create({
+                'name': ref + '.xml',
+                'datas_fname': ref + '.xml',
+                'datas': datas,
+                'res_model': self._name,
+                'res_id': job.id,
+            })
+            job.write({'state': 'done',
+                       'date_done': fields.Datetime.now(),
+                       'attachment_id': attachment.id})
+            if autocommit:
+                self.env.cr.commit()
+        return True
+
+    @api.model
+    def _reset_stale_jobs(self):
+        '''
+        Sets the running jobs which are not locked pending again, their
+        server having stopped while running them
+        '''
+        stale_jobs = self.browse()
+        for job in self.search([('state', '=', 'running')]):
+            if not job._try_lock():
+                continue
+            job._unlock()
+            _logger.warning('eCDF report job %d stale, run again', job.id)
+            stale_jobs |= job
+        stale_jobs.write({'state': 'pending'})
+        return stale_jobs
+
+    @api.model
+    def _cron_run_jobs(self):
+        '''
+        Scheduled action: runs the pending jobs, one after the other, with
+        the rights of the users who enqueued them. The jobs locked by other
+        scheduled actions are skipped.
+        '''
+        if self._reset_stale_jobs():
+            self.env.cr.commit()
+        for job in self.search([('state', '=', 'pending')], order='id'):
+            if not job._try_lock():
+                continue
+            try:
+                # new transaction: the job may have been run meanwhile
+                self.env.cr.commit()
+                job.invalidate_cache()
+                if job.state != 'pending':
+                    continue
+                try:
+                    job.sudo(job.create_uid.id).run(autocommit=True)
+                except Exception:
+                    _logger.exception('eCDF report job %d failed', job.id)
+                    self.env.cr.rollback()
+                    self.env.invalidate_all()
+                    job.write({'state': 'failed',
+                               'error': traceback.format_exc()})
+                    self.env.cr.commit()
+            finally:
+                job._unlock()
+        return True
+
+    @api.multi
+    def action_retry(self):
+        self.filtered(lambda j: j.state == 'failed').write(
+            {'state': 'pending', 'error': False})
+        return True
+
+    @api.multi
+    def action_download(self):
+        '''
+        :returns: action downloading the generated file
+        '''
+        self.ensure_one()
+        if not self.attachment_id:
+            return False
+        return {
+            'name': _('eCDF File'),
+            'type': 'ir.actions.act_url',
+            'url': '/web/binary/saveas?model=ir.attachment&field=datas'
+                   '&filename_field=datas_fname&id=%d' %
+                   self.attachment_id.id,
+            'target': 'self',
+        }
+
+
+class EcdfReportJobStep(models.Model):
+    '''
+    Progress of a job: a report type computed for a fiscal year
+    '''
+    _name = 'ecdf.report.job.step'
+    _description = 'eCDF Report Job Step'
+    _order = 'id'
+
+    job_id = fields.Many2one('ecdf.report.job', 'Job',
+                             required=True,
+                             ondelete='cascade')
+    report_type = fields.Char('Report Type', required=True)
+    fiscalyear_id = fields.Many2one('account.fiscalyear', 'Fiscal Year',
+                                    required=True)
+    state = fields.Selection([('pending', 'Pending'),
+                              ('done', 'Done')],
+                             'State',
+                             required=True,
+                             default='pending')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+'''
+Evaluation plans of the MIS templates declared in eCDF
+
+The plan of a template is compiled when the module is installed or updated.
+It is stored on the template and holds, independently of the chart of
+accounts:
+ - the KPIs in dependency order, the totals after the KPIs they use
+ - the expression of each KPI, its accounting variables (bale[...], ...)
+   being replaced by the names of variables
+ - the names of the KPIs used by each KPI
+ - the eCDF codes of the KPIs declared in eCDF
+so that the eCDF wizard evaluates the KPIs without parsing their
+expressions again. When its KPIs are modified, the plan is only marked as
+stale, and compiled again and stored when used next: the KPIs of the
+templates are loaded one by one.
+'''
+
+import json
+import re
+
+import psycopg2
+
+from openerp import models, fields, api
+
+from .ecdf_aep import EcdfAEP
+
+# Technical name of the KPIs declared in eCDF: ecdf_<code 1>_<code 2>
+#   P&L and BS: code 1 for the previous year, code 2 for the current year
+#   Chart of accounts: code 1 for the debit column, code 2 for the credit one
+ECDF_KPI_NAME = re.compile(r"""^ecdf\_(?P<code1>\d*)\_(?P<code2>\d*)""", re.X)
+
+# Names used in the KPI expressions
+IDENTIFIER = re.compile(r"\b[a-zA-Z_]\w*\b")
+
+# Names of the accounting variables in the compiled expressions
+VARIABLE_NAME = '_ecdf_var%d'
+
+# Templates declared by the eCDF wizard, per report type
+ECDF_TEMPLATES = {
+    'CA_PLANCOMPTA': 'l10n_lu_mis_reports.mis_report_ca',
+    'CA_BILAN': 'l10n_lu_mis_reports.mis_report_bs_2016',
+    'CA_BILANABR': 'l10n_lu_mis_reports.mis_report_abr_bs',
+    'CA_COMPP': 'l10n_lu_mis_reports.mis_report_pl_2016',
+    'CA_COMPPABR': 'l10n_lu_mis_reports.mis_report_abr_pl',
+}
+
+# Version of the format of the plans, the plans of another version being
+# compiled again
+PLAN_VERSION = 1
+
+
+class MisReport(models.Model):
+    _inherit = 'mis.report'
+
+    ecdf_plan = fields.Text('eCDF Evaluation Plan', readonly=True,
+                            copy=False)
+
+    @api.multi
+    def _ecdf_compile_plan(self):
+        '''
+        :returns: the evaluation plan of the template, dict(version,
+                  kpis, codes) where kpis is a list of dict(name,
+                  expression, variables, used) in dependency order and
+                  codes a list of [KPI name, code 1, code 2]
+        '''
+        self.ensure_one()
+        aep = EcdfAEP(self.env)
+        kpi_names = set(kpi.name for kpi in self.kpi_ids)
+        entries = {}
+        codes = []
+        for kpi in self.kpi_ids:
+            expression = kpi.expression or ''
+            variables = []
+
+            def replace(mo):
+                source = mo.group(0)
+                if source not in variables:
+                    variables.append(source)
+                return VARIABLE_NAME % variables.index(source)
+
+            used_names = set(IDENTIFIER.findall(
+                aep._ACC_RE.sub('', expression))) & kpi_names
+            used_names.discard(kpi.name)
+            entries[kpi.name] = {
+                'name': kpi.name,
+                'expression': aep._ACC_RE.sub(replace, expression),
+                'variables': variables,
+                'used': sorted(used_names),
+            }
+            line_match = ECDF_KPI_NAME.match(kpi.name or '')
+            if line_match:
+                codes.append([kpi.name,
+                              line_match.group('code1'),
+                              line_match.group('code2')])
+
+        # The totals after the KPIs they use
+        order = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for used_name in entries[name]['used']:
+                visit(used_name)
+            order.append(entries[name])
+
+        for kpi in self.kpi_ids:
+            visit(kpi.name)
+        return {'version': PLAN_VERSION, 'kpis': order, 'codes': codes}
+
+    @api.multi
+    def ecdf_compile_plan(self):
+        '''
+        Compiles and stores the evaluation plans of the templates
+        '''
+        for mis_template in self:
+            mis_template.ecdf_plan = json.dumps(
+                mis_template._ecdf_compile_plan())
+        return True
+
+    @api.model
+    def ecdf_compile_all_plans(self):
+        '''
+        Compiles the plans of the templates declared by the eCDF wizard, at
+        the installation or the update of the module
+        '''
+        mis_templates = self.browse()
+        for xml_id in ECDF_TEMPLATES.values():
+            mis_templates |= self.env.ref(xml_id)
+        return mis_templates.ecdf_compile_plan()
+
+    @api.multi
+    def ecdf_invalidate_plan(self):
+        '''
+        Marks the stored plans of the templates as stale
+        '''
+        self.filtered('ecdf_plan').write({'ecdf_plan': False})
+        return True
+
+    @api.multi
+    def ecdf_get_plan(self):
+        '''
+        :returns: the stored evaluation plan of the template, compiled
+                  again and stored if missing or of another version
+        '''
+        self.ensure_one()
+        if self.ecdf_plan:
+            plan = json.loads(self.ecdf_plan)
+            if plan.get('version') == PLAN_VERSION:
+                return plan
+        plan = self._ecdf_compile_plan()
+        self._ecdf_store_plan(plan)
+        return plan
+
+    @api.multi
+    def _ecdf_store_plan(self, plan):
+        '''
+        Stores a plan compiled during a generation, unless the template is
+        being updated by another transaction: the plan is then compiled
+        again next time
+        '''
+        self.ensure_one()
+        cr = self.env.cr
+        try:
+            with cr.savepoint():
+                cr.execute('SELECT id FROM mis_report WHERE id = %s '
+                           'FOR UPDATE NOWAIT', (self.id,),
+                           log_exceptions=False)
+                self.sudo().write({'ecdf_plan': json.dumps(plan)})
+        except psycopg2.OperationalError:
+            # locked or updated meanwhile
+            pass
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from openerp import models, api
+
+# Fields of the KPIs used to parse the templates and to name their values in
+# the eCDF wizard
+ECDF_KPI_FIELDS = ('name', 'description', 'expression', 'sequence',
+                   'report_id')
+
+
+class MisReportKpi(models.Model):
+    _inherit = 'mis.report.kpi'
+
+    @api.model
+    def create(self, vals):
+        self.env['ecdf.report'].clear_caches()
+        kpi = super(MisReportKpi, self).create(vals)
+        kpi.report_id.ecdf_invalidate_plan()
+        return kpi
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in ECDF_KPI_FIELDS):
+            return super(MisReportKpi, self).write(vals)
+        self.env['ecdf.report'].clear_caches()
+        mis_templates = self.mapped('report_id')
+        res = super(MisReportKpi, self).write(vals)
+        (mis_templates | self.mapped('report_id')).ecdf_invalidate_plan()
+        return res
+
+    @api.multi
+    def unlink(self):
+        self.env['ecdf.report'].clear_caches()
+        mis_templates = self.mapped('report_id')
+        res = super(MisReportKpi, self).unlink()
+        mis_templates.exists().ecdf_invalidate_plan()
+        return res
@@ -1,8 +1,76 @@
 # -*- coding: utf-8 -*-
 
-from openerp import models, fields
+import re
+
+from openerp import models, fields, api
+from openerp.exceptions import Warning as UserError
+from openerp.tools.translate import _
+
+# Identifiers of the agents and of the declarers
+MATRICULE_LENGTHS = (11, 13)
+RCS_NUMBER = re.compile(r"^[A-Z][^0]\d{1,5}$")
+VAT_NUMBER = re.compile(r"^[A-Z]{2}\d{8}$")
+ECDF_PREFIX = re.compile(r"^[0-9A-Z]{6}$")
 
 
 class res_company(models.Model):
     _inherit = "res.company"
     ecdf_prefixe = fields.Char("eCDF Prefix", size=6)
+    # changes of the move lines removed from ecdf.account.change
+    ecdf_purged_changes = fields.Integer("Purged eCDF Account Changes",
+                                         readonly=True)
+
+    @api.multi
+    def ecdf_check_identifiers(self):
+        '''
+        Checks the identifiers declared in eCDF files for all the companies
+        at once, before any computation
+        :returns: list of dict(company_id, company, field, value, message),
+                  one per invalid identifier, empty if all are valid
+        '''
+        errors = []
+        for company in self.read(['name', 'l10n_lu_matricule',
+                                  'company_registry', 'vat',
+                                  'ecdf_prefixe']):
+            def error(field, message):
+                errors.append({'company_id': company['id'],
+                               'company': company['name'],
+                               'field': field,
+                               'value': company[field],
+                               'message': message})
+
+            matricule = company['l10n_lu_matricule']
+            if not matricule:
+                error('l10n_lu_matricule', _('Matricule not present'))
+            elif len(matricule) not in MATRICULE_LENGTHS:
+                error('l10n_lu_matricule',
+                      _('Matricule must be 11 or 13 characters long.'))
+            registry = company['company_registry']
+            if registry and not RCS_NUMBER.match(registry):
+                error('company_registry',
+                      _('RCS number must begin with an uppercase letter '
+                        'followed by 2 to 6 digits. The first digit must '
+                        'not be 0.'))
+            vat = company['vat']
+            if vat and not VAT_NUMBER.match(vat):
+                error('vat', _('VAT number must begin with two uppercase '
+                               'letters followed by 8 digits.'))
+            prefix = company['ecdf_prefixe']
+            if prefix and not ECDF_PREFIX.match(prefix):
+                error('ecdf_prefixe',
+                      _('eCDF prefix must be made of 6 digits or uppercase '
+                        'letters.'))
+        return errors
+
+    @api.multi
+    def ecdf_assert_identifiers(self):
+        '''
+        Raises an error listing all the invalid identifiers of the companies
+        '''
+        errors = self.ecdf_check_identifiers()
+        if errors:
+            raise UserError(
+                _('Invalid eCDF identifiers'),
+                '\n'.join('%s - %s (%s): %s' % (
+                    error['company'], error['field'], error['value'] or '',
+                    error['message']) for error in errors))
@@ -1 +1,5 @@
 from . import test_l10n_lu_ecdf
+from . import test_ecdf_report_batch
+from . import test_ecdf_benchmark
+from . import test_ecdf_export
+from . import test_ecdf_file_reference
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from openerp.tests import common
+
+from ..cli.ecdf_benchmark import EcdfLedgerGenerator, get_pcn_codes, \
+    run_benchmark
+
+
+class TestEcdfBenchmark(common.TransactionCase):
+
+    def test_pcn_codes(self):
+        '''
+        Only the most specific codes of the template are kept
+        '''
+        codes = get_pcn_codes(
+            self.env.ref('l10n_lu_mis_reports.mis_report_ca'))
+        self.assertTrue(codes)
+        self.assertNotIn('106', codes)
+        self.assertIn('106141', codes)
+
+    def test_generate(self):
+        ledger = EcdfLedgerGenerator(self.env, 2015).generate(1, 100)[0]
+        move_lines = self.env['account.move.line'].search(
+            [('company_id', '=', ledger['company'].id)])
+        self.assertEqual(len(move_lines), 100)
+        self.assertEqual(sum(move_lines.mapped('debit')),
+                         sum(move_lines.mapped('credit')))
+
+    def test_run_benchmark(self):
+        results = run_benchmark(self.env, companies=2, move_lines=200)
+        self.assertEqual(results['ledger']['move_lines'], 200)
+        steps = set(timing['step'] for timing in results['timings'])
+        self.assertEqual(steps, set(['compute', '_get_chart_ac',
+                                     '_get_finan_report', 'validate_xml',
+                                     'print_xml', 'batch_print_xml']))
+        # the file is generated with cold and warm caches
+        self.assertEqual(
+            sorted(timing['cold'] for timing in results['timings']
+                   if timing['step'] == 'print_xml'),
+            [False, True])
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+import os
+import shutil
+import tempfile
+
+from lxml import etree
+from openerp.exceptions import Warning as UserError
+from openerp.tests import common
+
+from ..cli.ecdf_export import EcdfExporter
+
+
+class TestEcdfExport(common.TransactionCase):
+
+    def setUp(self):
+        super(TestEcdfExport, self).setUp()
+
+        self.company = self.env.ref('base.main_company')
+        self.company.l10n_lu_matricule = '0000000000000'
+        self.company.company_registry = 'L654321'
+        self.company.vat = 'LU12345613'
+        self.company.ecdf_prefixe = '123456'
+
+        fiscal_year_model = self.env['account.fiscalyear']
+        for year in ('2014', '2015'):
+            fiscal_year_model.create({
+                'company_id': self.company.id,
+                'name': 'fiscalyear_%s' % year,
+                'code': year,
+                'date_start': datetime.strptime(year + '0101',
+                                                "%Y%m%d").date(),
+                'date_stop': datetime.strptime(year + '1231',
+                                               "%Y%m%d").date(),
+            }).create_period()
+
+        self.exporter = EcdfExporter(self.env, reports=('bs', 'pl'),
+                                     matricule='1111111111111',
+                                     vat='LU12345678',
+                                     company_registry='L123456')
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        super(TestEcdfExport, self).tearDown()
+
+    def _get_declarers(self, path):
+        root = etree.parse(path).getroot()
+        return root.findall('.//{http://www.ctie.etat.lu/2011/ecdf}Declarer')
+
+    def test_get_companies(self):
+        self.assertEqual(self.exporter.get_companies(['123456']),
+                         self.company)
+        with self.assertRaises(UserError):
+            self.exporter.get_companies(['654321'])
+        with self.assertRaises(UserError):
+            self.exporter.get_fiscal_years(self.company, ['1999'])
+
+    def test_export(self):
+        '''
+        One valid file per company, with the declarations of all its years,
+        the file names being unique
+        '''
+        paths = self.exporter.export(self.company, ['2015'],
+                                     self.output_dir)
+        self.assertEqual(len(paths), 1)
+        declarers = self._get_declarers(paths[0])
+        self.assertEqual(len(declarers), 1)
+        self.assertEqual(len(declarers[0].findall(
+            '{http://www.ctie.etat.lu/2011/ecdf}Declaration')), 2)
+
+        paths += self.exporter.export(self.company, ['2014', '2015'],
+                                      self.output_dir)
+        self.assertEqual(len(set(paths)), 2)
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         sorted(os.path.basename(path) for path in paths))
+        self.assertEqual(len(self._get_declarers(paths[1])[0].findall(
+            '{http://www.ctie.etat.lu/2011/ecdf}Declaration')), 4)
+
+    def test_export_combined(self):
+        paths = self.exporter.export(self.company, ['2015'],
+                                     self.output_dir, combined=True)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(len(self._get_declarers(paths[0])), 1)
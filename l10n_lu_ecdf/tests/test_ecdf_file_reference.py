@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from openerp.tests import common
+
+
+class TestEcdfFileReference(common.TransactionCase):
+
+    def test_allocate(self):
+        '''
+        The numbers 01 to 99 are handed out within a second, then the
+        references spill over to the next second
+        '''
+        reference_model = self.env['ecdf.file.reference']
+        now = datetime(2016, 3, 31, 23, 59, 59)
+        references = [reference_model._allocate('123456', now=now)
+                      for __ in range(100)]
+        self.assertEqual(len(set(references)), 100)
+        self.assertEqual(references[0], '123456X20160331T23595901')
+        self.assertEqual(references[98], '123456X20160331T23595999')
+        self.assertEqual(references[99], '123456X20160401T00000001')
+        self.assertEqual(reference_model._allocate('654321', now=now),
+                         '654321X20160331T23595901')
+        self.assertEqual(reference_model._allocate('123456', now=now),
+                         '123456X20160401T00000002')
+
+    def test_allocate_taken(self):
+        '''
+        A number allocated by another generation is skipped
+        '''
+        reference_model = self.env['ecdf.file.reference']
+        now = datetime(2016, 3, 31, 12, 0, 0)
+        reference_model.create({'prefix': '123456',
+                                'stamp': 'X20160331T120000',
+                                'sequence': 1})
+        self.assertEqual(reference_model._allocate('123456', now=now),
+                         '123456X20160331T12000002')
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import base64
+from datetime import datetime
+
+from lxml import etree
+from openerp.exceptions import Warning as UserError
+from openerp.tests import common
+
+
+class TestEcdfReportBatch(common.TransactionCase):
+
+    def setUp(self):
+        super(TestEcdfReportBatch, self).setUp()
+
+        self.account_fiscalyear = self.env['account.fiscalyear']
+
+        # Company instance
+        self.company = self.env.ref('base.main_company')
+        self.company.l10n_lu_matricule = '0000000000000'
+        self.company.company_registry = 'L654321'
+        self.company.vat = 'LU12345613'
+
+        # Fiscal years with periods
+        self.fiscal_year_2015 = self.account_fiscalyear.create({
+            'company_id': self.company.id,
+            'name': 'fiscalyear_2015',
+            'code': '2015',
+            'date_start': datetime.strptime('01012015', "%d%m%Y").date(),
+            'date_stop': datetime.strptime('31122015', "%d%m%Y").date()})
+        self.fiscal_year_2015.create_period()
+        self.fiscal_year_2014 = self.account_fiscalyear.create({
+            'company_id': self.company.id,
+            'name': 'fiscalyear_2014',
+            'code': '2014',
+            'date_start': datetime.strptime('01012014', "%d%m%Y").date(),
+            'date_stop': datetime.strptime('31122014', "%d%m%Y").date()})
+        self.fiscal_year_2014.create_period()
+
+        # eCDF batch instance
+        self.batch = self.env['ecdf.report.batch'].create({
+            'language': 'FR',
+            'target_move': 'posted',
+            'with_pl': True,
+            'with_bs': True,
+            'with_ac': False,
+            'reports_type': 'full',
+            'matricule': '1111111111111',
+            'vat': 'LU12345678',
+            'company_registry': 'L123456'})
+
+    def _get_declarers(self):
+        root = etree.fromstring(base64.decodestring(self.batch.xml_file))
+        return root.findall('.//{http://www.ctie.etat.lu/2011/ecdf}Declarer')
+
+    def test_print_xml_no_company(self):
+        with self.assertRaises(UserError), self.cr.savepoint():
+            self.batch.print_xml()
+
+    def test_print_xml(self):
+        '''
+        One declarer per company, with the declarations of all its years
+        '''
+        self.batch.line_ids = [
+            (0, 0, {'company_id': self.company.id,
+                    'current_fiscyear': self.fiscal_year_2015.id,
+                    'prev_fiscyear': self.fiscal_year_2014.id})]
+        self.batch.print_xml()
+        declarers = self._get_declarers()
+        self.assertEqual(len(declarers), 1)
+        self.assertEqual(len(declarers[0].findall(
+            '{http://www.ctie.etat.lu/2011/ecdf}Declaration')), 2)
+
+        self.batch.line_ids = [
+            (0, 0, {'company_id': self.company.id,
+                    'current_fiscyear': self.fiscal_year_2014.id})]
+        self.batch.print_xml()
+        declarers = self._get_declarers()
+        self.assertEqual(len(declarers), 1)
+        self.assertEqual(len(declarers[0].findall(
+            '{http://www.ctie.etat.lu/2011/ecdf}Declaration')), 4)
+
+    def test_check_identifiers(self):
+        '''
+        The identifiers of all the companies are checked in one pass,
+        before any computation
+        '''
+        other = self.env['res.company'].create({
+            'name': 'eCDF other company',
+            'l10n_lu_matricule': False,
+            'company_registry': 'L0123',
+            'vat': 'LU123',
+            'ecdf_prefixe': 'ab12',
+        })
+        companies = self.company | other
+        self.assertFalse(self.company.ecdf_check_identifiers())
+        errors = companies.ecdf_check_identifiers()
+        self.assertEqual(set(error['company_id'] for error in errors),
+                         set([other.id]))
+        self.assertEqual(set(error['field'] for error in errors),
+                         set(['l10n_lu_matricule', 'company_registry',
+                              'vat', 'ecdf_prefixe']))
+
+        self.batch.line_ids = [
+            (0, 0, {'company_id': self.company.id,
+                    'current_fiscyear': self.fiscal_year_2015.id}),
+            (0, 0, {'company_id': other.id,
+                    'current_fiscyear': self.fiscal_year_2015.id})]
+        with self.assertRaises(UserError), self.cr.savepoint():
+            self.batch.print_xml()
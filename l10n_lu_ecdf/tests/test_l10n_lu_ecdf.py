@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
+from cStringIO import StringIO
 from datetime import datetime
 import logging
 import re as re
+import base64
+import zipfile
 
 from lxml import etree
+from openerp.addons.mis_builder.models.aep import\
+    AccountingExpressionProcessor as AEP
 from openerp.addons.mis_builder.models.accounting_none import AccountingNone
-from openerp.exceptions import ValidationError
+from openerp.exceptions import AccessError, ValidationError
 from openerp.exceptions import Warning as UserError
 from openerp.tests import common
 
+from ..models.ecdf_aep import EcdfAEP, EcdfBalances
+from ..models.ecdf_kpi_data import EcdfKpiData
+from ..models.ecdf_profiler import EcdfProfiler, NO_PROFILER
+from ..models.ecdf_report_archive import get_content_hash
+
 _logger = logging.getLogger(__name__)
 
 
@@ -82,6 +93,44 @@ class TestL10nLuEcdf(common.TransactionCase):
             'company_registry': 'L123456',
             'chart_account_id': self.chart_of_account.id})
 
+    def _create_capital_account(self):
+        '''
+        Creates the account 101000
+        :returns: tuple (account, counterpart account for its moves)
+        '''
+        account = self.account_account.create({
+            'name': 'Subscribed capital',
+            'code': '101000',
+            'type': 'other',
+            'user_type': self.env.ref(
+                'account.data_account_type_liability').id,
+            'parent_id': self.chart_of_account.id,
+            'company_id': self.company.id})
+        counterpart = self.account_account.search(
+            [('type', '=', 'other'),
+             ('company_id', '=', self.company.id),
+             ('id', '!=', account.id)], limit=1)
+        return account, counterpart
+
+    def _create_capital_move(self, account, counterpart):
+        '''
+        :returns: a draft move of 1000.0 on the credit of the account, in
+                  the first period of the current fiscal year
+        '''
+        period = self.current_fiscal_year.period_ids.filtered(
+            lambda p: not p.special)[0]
+        journal = self.env['account.journal'].search(
+            [('company_id', '=', self.company.id)], limit=1)
+        return self.env['account.move'].create({
+            'journal_id': journal.id,
+            'period_id': period.id,
+            'date': period.date_start,
+            'line_id': [
+                (0, 0, {'name': 'capital', 'account_id': account.id,
+                        'credit': 1000.0}),
+                (0, 0, {'name': 'capital', 'account_id': counterpart.id,
+                        'debit': 1000.0})]})
+
     def test_check_matr(self):
         '''
         Matricule must be 11 or 13 characters long
@@ -167,11 +216,31 @@ class TestL10nLuEcdf(common.TransactionCase):
         except ValidationError:
             self.fail()
 
+    def test_check_identifiers_multi(self):
+        '''
+        The records after a record without identifiers are checked too
+        '''
+        report = self.report.copy({'matricule': False,
+                                   'company_registry': False,
+                                   'vat': False})
+        self.env.cr.execute('''UPDATE ecdf_report
+                               SET matricule = '1', company_registry = 'L0',
+                                   vat = 'LU1'
+                               WHERE id = %s''', (self.report.id,))
+        self.env.invalidate_all()
+        reports = report | self.report
+        with self.assertRaises(ValidationError):
+            reports.check_matr()
+        with self.assertRaises(ValidationError):
+            reports.check_rcs()
+        with self.assertRaises(ValidationError):
+            reports.check_vat()
+
     def check_prev_fiscyear(self):
         with self.assertRaises(ValidationError), self.cr.savepoint():
             self.report.previous_fiscal_year = self.current_fiscal_year
 
-    def test_compute_file_reference(self):
+    def test_allocate_file_reference(self):
         '''
         File ref must match the following pattern : 000000XyyyymmddThhmmssNN
         '''
@@ -179,9 +248,10 @@ class TestL10nLuEcdf(common.TransactionCase):
         exp = r"""^\d{6}X\d{8}T\d{8}$"""
         rexp = re.compile(exp, re.X)
 
-        self.report._compute_file_reference()
+        reference = self.report._allocate_file_reference()
 
-        self.assertIsNotNone(rexp.match(self.report.file_reference))
+        self.assertIsNotNone(rexp.match(reference))
+        self.assertNotEqual(self.report._allocate_file_reference(), reference)
 
     def test_get_ecdf_file_version(self):
         report_file_version = self.report.get_ecdf_file_version()
@@ -372,12 +442,631 @@ class TestL10nLuEcdf(common.TransactionCase):
 <NumericField id="642">321,00</NumericField></FormData>'
         self.assertEqual(etree.tostring(element), expected)
 
+    def test_ecdf_code_map(self):
+        '''
+        Only the KPIs named after eCDF codes are mapped, with their index
+        in the data
+        '''
+        names = ('ecdf_642_641', 'total', '', 'ecdf_0118_0119')
+        code_map = self.report._get_ecdf_code_map(names)
+        self.assertEqual(code_map, ((0, '642', '641'),
+                                    (3, '0118', '0119')))
+        self.assertIs(self.report._get_ecdf_code_map(names), code_map)
+
+    def test_profiler(self):
+        '''
+        The queries of a stage are counted, including the nested stages
+        '''
+        profiler = EcdfProfiler(self.env.cr)
+        with profiler.stage('outer'):
+            self.env.cr.execute('SELECT 1 UNION SELECT 2')
+            with profiler.stage('inner', 'CA_BILAN'):
+                self.env.cr.execute('SELECT 1')
+        self.assertNotIn('execute', vars(self.env.cr))
+        stats = dict(((s['stage'], s['report_type']), s)
+                     for s in profiler.get_stats())
+        self.assertEqual(stats[('outer', None)]['queries'], 2)
+        self.assertEqual(stats[('outer', None)]['rows'], 3)
+        self.assertEqual(stats[('inner', 'CA_BILAN')]['queries'], 1)
+
+        # Statistics of a worker
+        total = EcdfProfiler(self.env.cr)
+        total.merge(profiler)
+        total.merge(profiler)
+        stats = dict(((s['stage'], s['report_type']), s)
+                     for s in total.get_stats())
+        self.assertEqual(stats[('outer', None)]['queries'], 4)
+
+        # Disabled profiler
+        with NO_PROFILER.stage('outer'):
+            self.env.cr.execute('SELECT 1')
+        self.assertFalse(NO_PROFILER.get_stats())
+
+    def test_declarer_profiling(self):
+        '''
+        The stages of each report type are recorded
+        '''
+        profiler = EcdfProfiler(self.env.cr)
+        self.report._get_declarer(profiler=profiler)
+        stages = set((s['stage'], s['report_type'])
+                     for s in profiler.get_stats())
+        for report in self.report._get_reports():
+            for stage in ('parse', 'compute', 'xml'):
+                self.assertIn((stage, report['type']), stages)
+        self.assertIn('compute', profiler.format())
+
+    def test_fiscal_contexts(self):
+        '''
+        Periods and text fields of the fiscal years, resolved at once
+        '''
+        self.current_fiscal_year.create_period()
+        contexts = self.report._get_fiscal_contexts(
+            self.current_fiscal_year | self.previous_fiscal_year)
+        current = contexts[self.current_fiscal_year.id]
+        self.assertEqual(len(current.periods), 12)
+        self.assertEqual(current.period_from.date_start, '2015-01-01')
+        self.assertEqual(current.period_to.date_stop, '2015-12-31')
+        self.assertEqual(current.year, '2015')
+        self.assertEqual(dict(current.text_fields),
+                         {'01': '01/01/2015',
+                          '02': '31/12/2015',
+                          '03': self.company.currency_id.name})
+        # No periods
+        previous = contexts[self.previous_fiscal_year.id]
+        self.assertFalse(previous.periods)
+        self.assertIsNone(previous.period_from)
+        self.assertIsNone(self.report._get_chart_ac(
+            [], 'CA_PLANCOMPTA', '1', fiscal_context=previous))
+
     def test_onchange_current_fiscal_year(self):
         self.report.current_fiscyear = self.fiscal_year_2008.id
         self.report._onchange_current_fiscal_year()
         if self.report.prev_fiscyear != self.fiscal_year_2007:
             self.fail()
 
+    def _get_test_declarer(self):
+        '''
+        :returns: a valid XML node "Declarer" with an empty declaration
+        '''
+        declarer = etree.Element('Declarer')
+        for tag, text in (('MatrNbr', '0000000000000'),
+                          ('RCSNbr', 'L654321'),
+                          ('VATNbr', '12345613')):
+            etree.SubElement(declarer, tag).text = text
+        declaration = etree.SubElement(declarer, 'Declaration',
+                                       type='CA_BILAN',
+                                       language='FR',
+                                       model='1')
+        etree.SubElement(declaration, 'Year').text = '2015'
+        etree.SubElement(declaration, 'Period').text = '1'
+        etree.SubElement(declaration, 'FormData')
+        return declarer
+
+    def test_validate_xml(self):
+        '''
+        The written file is validated against the eCDF schema, as a stream
+        '''
+        ref = '000000X20150101T01010101'
+        # No declarer
+        xml_file = StringIO()
+        self.report._write_ecdf_file(xml_file, ref, [])
+        with self.assertRaises(UserError):
+            self.report._validate_xml_file(xml_file)
+
+        xml_file = StringIO()
+        self.report._write_ecdf_file(xml_file, ref,
+                                     [self._get_test_declarer()])
+        self.report._validate_xml_file(xml_file)
+        self.assertIn('<Declarer><MatrNbr>0000000000000</MatrNbr>',
+                      xml_file.read())
+
+    def test_generate_xml_file(self):
+        '''
+        The file is written and validated as a stream, with the header of
+        the wizard
+        '''
+        ref = '000000X20150101T01010101'
+        datas = self.report._generate_xml_file(ref,
+                                               [self._get_test_declarer()])
+        doc = etree.fromstring(base64.decodestring(datas))
+        self.assertEqual(doc.findtext('{%s}FileReference' % doc.nsmap[None]),
+                         ref)
+        self.assertEqual(len(doc.findall('.//{%s}Declarer' %
+                                         doc.nsmap[None])), 1)
+        # No declarer
+        with self.assertRaises(UserError):
+            self.report._generate_xml_file(ref, [])
+
+    def test_compute_multi(self):
+        '''
+        Values computed for several fiscal years in one pass must be the
+        same as the ones computed by MIS Builder, year by year
+        '''
+        self.current_fiscal_year.create_period()
+        self.previous_fiscal_year.create_period()
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_bs_2016')
+        fiscal_years = self.current_fiscal_year | self.previous_fiscal_year
+        data = self.report.compute_multi(mis_report, fiscal_years)
+
+        for fiscal_year in fiscal_years:
+            aep = AEP(self.env)
+            for kpi in mis_report.kpi_ids:
+                aep.parse_expr(kpi.expression)
+            aep.done_parsing(self.chart_of_account)
+            periods = self.env['account.period'].search(
+                [('special', '=', False),
+                 ('fiscalyear_id', '=', fiscal_year.id)]
+            ).sorted(key=lambda r: r.date_start)
+            kpi_values = mis_report._compute(self.env.lang, aep,
+                                             fiscal_year.date_start,
+                                             fiscal_year.date_stop,
+                                             periods[0],
+                                             periods[-1],
+                                             'posted')
+            # the sums of the indexed prefixes may be rounded differently
+            expected = [self._round_val(kpi_values[kpi.name]['val'])
+                        for kpi in mis_report.kpi_ids]
+            self.assertEqual([self._round_val(line['val'])
+                              for line in data[fiscal_year.id]],
+                             expected)
+
+    def test_kpi_data(self):
+        '''
+        The values of the fiscal years share the names of the KPIs of the
+        template, and are declared as lists of dicts would be
+        '''
+        self.current_fiscal_year.create_period()
+        self.previous_fiscal_year.create_period()
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_ca')
+        fiscal_years = self.current_fiscal_year | self.previous_fiscal_year
+        data = self.report.compute_multi(mis_report, fiscal_years)
+        data_current = data[self.current_fiscal_year.id]
+        data_previous = data[self.previous_fiscal_year.id]
+        self.assertTrue(isinstance(data_current, EcdfKpiData))
+        self.assertIs(data_current.table, data_previous.table)
+        self.assertEqual(len(data_current), len(mis_report.kpi_ids))
+
+        lines = list(data_current)
+        self.assertEqual([line['kpi_technical_name'] for line in lines],
+                         [kpi.name for kpi in mis_report.kpi_ids])
+        self.assertEqual(EcdfKpiData.wrap(lines), data_current)
+        self.assertEqual(
+            etree.tostring(self.report._get_chart_ac(
+                data_current, 'CA_PLANCOMPTA', '1')),
+            etree.tostring(self.report._get_chart_ac(
+                lines, 'CA_PLANCOMPTA', '1')))
+
+    def _round_val(self, val):
+        if isinstance(val, float):
+            return round(val, 2)
+        return val
+
+    def test_aep_code_index(self):
+        '''
+        Patterns evaluated from the totals of their prefix have the same
+        values as the ones summing their accounts
+        '''
+        accounts = self.account_account
+        for code in ('601', '6011', '6012', '60121', '602'):
+            accounts |= self.account_account.create({
+                'name': code,
+                'code': code,
+                'type': 'other',
+                'user_type': self.env.ref(
+                    'account.data_account_type_expense').id,
+                'parent_id': self.chart_of_account.id,
+                'company_id': self.company.id})
+        expr = 'bale[60%] + bale[601%] - bale[6012%] + bale[602%]'
+        aep = EcdfAEP(self.env)
+        aep.parse_expr(expr)
+        aep.done_parsing(self.chart_of_account)
+        key = list(aep._map_account_ids)[0]
+        aep._data = defaultdict(dict)
+        aep._data[key] = {accounts[0].id: (10.0, 0.0),
+                          accounts[1].id: (0.0, 3.0),
+                          accounts[3].id: (7.5, 0.25)}
+        expected = aep.replace_expr(expr)
+
+        aep.set_code_index(aep.get_code_index())
+        self.assertIn('601', aep._prefix_ids)
+        self.assertIn('6012', aep._prefix_ids)
+        aep._add_prefix_totals()
+        self.assertEqual(aep.replace_expr(expr), expected)
+
+    def test_compute_incremental(self):
+        '''
+        After new moves, only the KPIs of their accounts are evaluated again,
+        with the same values as a full computation
+        '''
+        self.current_fiscal_year.create_period()
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_bs_2016')
+        account, counterpart = self._create_capital_account()
+        self.report.compute(mis_report, self.current_fiscal_year)
+        result_model = self.env['ecdf.kpi.result']
+        result = result_model.find(self.chart_of_account,
+                                   self.current_fiscal_year,
+                                   mis_report, 'posted')
+        self.assertTrue(result)
+        self.assertFalse(result.get_changed_account_ids())
+
+        dirty = self.report._get_dirty_kpis(mis_report, set([account.id]))
+        self.assertIn('ecdf_304_303', dirty)
+
+        # New move on the account
+        move = self._create_capital_move(account, counterpart)
+        move.post()
+        self.assertIn(account.id, result.get_changed_account_ids())
+        data = self.report.compute(mis_report, self.current_fiscal_year)
+        values = dict((line['kpi_technical_name'], line['val'])
+                      for line in data)
+        self.assertEqual(values['ecdf_304_303'], 1000.0)
+
+        # Same values from scratch
+        result.unlink()
+        self.assertEqual(
+            self.report.compute(mis_report, self.current_fiscal_year),
+            data)
+
+        # Removed moves are detected
+        move.button_cancel()
+        move.unlink()
+        result = result_model.find(self.chart_of_account,
+                                   self.current_fiscal_year,
+                                   mis_report, 'posted')
+        self.assertIn(account.id, result.get_changed_account_ids())
+
+        # Values stored without the state of the ledger
+        result.ledger_xmin = False
+        self.assertIsNone(result.get_changed_account_ids())
+
+    def test_account_change(self):
+        '''
+        Changes of move lines are logged per account, and the log is
+        purged without changing the version of the ledger
+        '''
+        self.current_fiscal_year.create_period()
+        change_model = self.env['ecdf.account.change']
+        state = change_model.get_state(self.company)
+        account, counterpart = self._create_capital_account()
+        self._create_capital_move(account, counterpart)
+        new_state = change_model.get_state(self.company)
+        self.assertGreater(new_state['change_id'], state['change_id'])
+        self.assertGreater(new_state['change_count'], state['change_count'])
+        self.assertTrue(set([account.id, counterpart.id]) <=
+                        change_model.get_account_ids(self.company,
+                                                     new_state['xmin']))
+
+        # Old changes consumed by all the stored values are purged
+        self.env.cr.execute('''
+            UPDATE ecdf_account_change SET date = '2000-01-01', txid = 0
+            WHERE company_id = %s
+        ''', (self.company.id,))
+        change_model.purge(self.company)
+        self.assertEqual(
+            change_model.search_count([('company_id', '=', self.company.id)]),
+            1)
+        purged_state = change_model.get_state(self.company)
+        self.assertEqual(purged_state['change_id'], new_state['change_id'])
+        self.assertEqual(purged_state['change_count'],
+                         new_state['change_count'])
+
+    def test_compute_moved_line(self):
+        '''
+        A line moved to another account invalidates the KPIs of both
+        accounts
+        '''
+        self.current_fiscal_year.create_period()
+        self.report.target_move = 'all'
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_bs_2016')
+        account, counterpart = self._create_capital_account()
+        move = self._create_capital_move(account, counterpart)
+        data = self.report.compute(mis_report, self.current_fiscal_year)
+        values = dict((line['kpi_technical_name'], line['val'])
+                      for line in data)
+        self.assertEqual(values['ecdf_304_303'], 1000.0)
+
+        move.line_id.filtered(
+            lambda line: line.account_id == account).account_id = counterpart
+        result_model = self.env['ecdf.kpi.result']
+        result = result_model.find(self.chart_of_account,
+                                   self.current_fiscal_year,
+                                   mis_report, 'all')
+        changed_account_ids = result.get_changed_account_ids()
+        self.assertIn(account.id, changed_account_ids)
+        self.assertIn(counterpart.id, changed_account_ids)
+        data = self.report.compute(mis_report, self.current_fiscal_year)
+        values = dict((line['kpi_technical_name'], line['val'])
+                      for line in data)
+        self.assertNotEqual(values['ecdf_304_303'], 1000.0)
+
+        # Same values from scratch
+        result.unlink()
+        self.assertEqual(
+            self.report.compute(mis_report, self.current_fiscal_year),
+            data)
+
+    def test_preview(self):
+        '''
+        Previewed codes have the values declared in the file
+        '''
+        self.current_fiscal_year.create_period()
+        self.previous_fiscal_year.create_period()
+        self._create_capital_move(*self._create_capital_account()).post()
+
+        declared = {}
+        for field in self.report._get_declarer().iter('NumericField'):
+            declared[field.get('id')] = float(field.text.replace(',', '.'))
+        self.assertEqual(declared['303'], 1000.0)
+        codes = set(declared) | set(['9999'])
+        self.assertEqual(self.report.preview(codes),
+                         dict((code, declared.get(code)) for code in codes))
+        self.assertEqual(self.report.preview(['303', '639']),
+                         {'303': 1000.0, '639': declared['639']})
+
+        # Multi-year mode: the current fiscal year is previewed
+        self.report.first_fiscyear = self.previous_fiscal_year
+        self.assertEqual(self.report.preview(['303', '639']),
+                         {'303': 1000.0, '639': declared['639']})
+        self.report.first_fiscyear = False
+
+        self.report.preview_codes = '303, 9999'
+        self.report.action_preview()
+        self.assertIn('303: 1000,00', self.report.preview_result)
+
+    def test_kpi_order(self):
+        '''
+        Totals are evaluated after the KPIs they use, and totals using
+        accounts already used by their KPIs are reported
+        '''
+        for code in ('601', '602'):
+            self.account_account.create({
+                'name': code,
+                'code': code,
+                'type': 'other',
+                'user_type': self.env.ref(
+                    'account.data_account_type_expense').id,
+                'parent_id': self.chart_of_account.id,
+                'company_id': self.company.id})
+        mis_report = self.env['mis.report'].create({
+            'name': 'eCDF test',
+            'kpi_ids': [
+                (0, 0, {'name': 'total', 'description': 'Total',
+                        'expression': 'charges + bale[60%]',
+                        'sequence': 1}),
+                (0, 0, {'name': 'charges', 'description': 'Charges',
+                        'expression': 'purchases + bale[602%]',
+                        'sequence': 2}),
+                (0, 0, {'name': 'purchases', 'description': 'Purchases',
+                        'expression': 'bale[601%]',
+                        'sequence': 3})]})
+        self.assertEqual(self.report._get_template_order(mis_report),
+                         ('purchases', 'charges', 'total'))
+        redundant = self.ecdf_report._get_redundant_kpis(
+            mis_report.id, mis_report.write_date, self.chart_of_account.id)
+        self.assertEqual(set(redundant), set(['total']))
+
+        # No redundant totals in the eCDF templates
+        for xml_id in ('mis_report_ca', 'mis_report_bs_2016',
+                       'mis_report_pl_2016', 'mis_report_abr_bs',
+                       'mis_report_abr_pl'):
+            mis_report = self.env.ref('l10n_lu_mis_reports.' + xml_id)
+            self.assertFalse(self.ecdf_report._get_redundant_kpis(
+                mis_report.id, mis_report.write_date,
+                self.chart_of_account.id))
+
+    def test_kpi_plan(self):
+        '''
+        The evaluation plans of the templates are compiled at the
+        installation, and marked as stale when their KPIs are modified
+        '''
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_bs_2016')
+        self.assertTrue(mis_report.ecdf_plan)
+        plan = mis_report.ecdf_get_plan()
+        self.assertEqual(len(plan['kpis']), len(mis_report.kpi_ids))
+        self.assertEqual(
+            set(name for name, code1, code2 in plan['codes']),
+            set(kpi.name for kpi in mis_report.kpi_ids
+                if kpi.name.startswith('ecdf_')))
+
+        mis_report = self.env['mis.report'].create({
+            'name': 'eCDF test',
+            'kpi_ids': [
+                (0, 0, {'name': 'total', 'description': 'Total',
+                        'expression': 'charges + bale[60%] - bale[60%]',
+                        'sequence': 1}),
+                (0, 0, {'name': 'charges', 'description': 'Charges',
+                        'expression': 'balp[6%]',
+                        'sequence': 2})]})
+        self.assertFalse(mis_report.ecdf_plan)
+        # only the templates of the wizard are compiled at the update
+        self.env['mis.report'].ecdf_compile_all_plans()
+        self.assertFalse(mis_report.ecdf_plan)
+        mis_report.ecdf_compile_plan()
+        self.assertTrue(mis_report.ecdf_plan)
+        plan = mis_report.ecdf_get_plan()
+        self.assertEqual([entry['name'] for entry in plan['kpis']],
+                         ['charges', 'total'])
+        total = plan['kpis'][1]
+        self.assertEqual(total['expression'],
+                         'charges + _ecdf_var0 - _ecdf_var0')
+        self.assertEqual(total['variables'], ['bale[60%]'])
+        self.assertEqual(total['used'], ['charges'])
+
+        mis_report.kpi_ids.filtered(
+            lambda kpi: kpi.name == 'charges').expression = 'bale[7%]'
+        self.assertFalse(mis_report.ecdf_plan)
+        self.assertEqual(mis_report.ecdf_get_plan()['kpis'][0]['variables'],
+                         ['bale[7%]'])
+        # the plan compiled again is stored
+        self.assertTrue(mis_report.ecdf_plan)
+
+    def test_aep_variable_value(self):
+        '''
+        Accounting variables of the plans have the values replace_expr()
+        substitutes to them
+        '''
+        expr = 'bale[60%] + balp[60%] - crdp[601%] + debi[6%]'
+        aep = EcdfAEP(self.env)
+        aep.parse_expr(expr)
+        aep.done_parsing(self.chart_of_account)
+        aep._data = defaultdict(dict)
+        for i, key in enumerate(aep._map_account_ids):
+            aep._data[key] = dict(
+                (account_id, (10.0 * i, 2.5))
+                for account_id in aep._map_account_ids[key][:3])
+        for mo in aep._ACC_RE.finditer(expr):
+            variable = aep.resolve_variable(aep.parse_variable(mo.group(0)))
+            self.assertEqual(repr(aep.get_variable_value(variable)),
+                             aep.replace_expr(mo.group(0))[1:-1])
+
+    def test_compute_declaration(self):
+        '''
+        Reports computed one by one give the declarer of the sequential
+        generation; values computed for a worker are collected, not stored
+        '''
+        self.current_fiscal_year.create_period()
+        self.report.with_ac = True
+        declarer = etree.tostring(self.report._get_declarer(workers=1))
+        fiscal_contexts = self.report._get_fiscal_contexts(
+            self.report.current_fiscyear | self.report.prev_fiscyear)
+        declarations = [self.report._compute_declaration(report,
+                                                         fiscal_contexts)
+                        for report in self.report._get_reports()]
+        self.assertEqual(
+            [etree.tostring(d) for d in declarations if d is not None],
+            [etree.tostring(d) for d in
+             etree.fromstring(declarer).iterchildren('Declaration')])
+
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_ca')
+        result_model = self.env['ecdf.kpi.result']
+        result_model.find(self.chart_of_account, self.current_fiscal_year,
+                          mis_report, 'posted').unlink()
+        stored_results = []
+        data = self.report.compute_multi(mis_report,
+                                         self.current_fiscal_year,
+                                         stored_results=stored_results)
+        self.assertFalse(result_model.find(self.chart_of_account,
+                                           self.current_fiscal_year,
+                                           mis_report, 'posted'))
+        self.assertEqual(len(stored_results), 1)
+        self.assertEqual(stored_results[0][:3],
+                         (self.chart_of_account.id,
+                          self.current_fiscal_year.id, mis_report.id))
+        result_model.store(*self.report._browse_store_args(stored_results[0]))
+        self.assertEqual(
+            self.report.compute_multi(mis_report, self.current_fiscal_year),
+            data)
+
+    def test_aep_parsed_state_cache(self):
+        '''
+        Parsed templates are cached until their KPIs or the accounts change
+        '''
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_bs_2016')
+        args = (mis_report.id, mis_report.write_date,
+                self.chart_of_account.id)
+        state = self.ecdf_report._get_aep_parsed_state(*args)
+        self.assertIs(self.ecdf_report._get_aep_parsed_state(*args), state)
+
+        # KPI modified: cache cleared
+        kpi = mis_report.kpi_ids[0]
+        kpi.expression = kpi.expression
+        new_state = self.ecdf_report._get_aep_parsed_state(*args)
+        self.assertIsNot(new_state, state)
+
+        # Account modified: cache cleared
+        account = self.account_account.search(
+            [('parent_id', '!=', False)], limit=1)
+        account.code = account.code
+        self.assertIsNot(self.ecdf_report._get_aep_parsed_state(*args),
+                         new_state)
+
+        # The restored processor has the same state
+        aep = self.report._get_aep(mis_report)
+        map_account_ids, account_ids_by_code = \
+            self.ecdf_report._get_aep_parsed_state(*args)
+        self.assertEqual(
+            dict((key, set(ids)) for key, ids in map_account_ids),
+            dict((key, set(ids)) for key, ids in
+                 aep._map_account_ids.items()))
+        self.assertEqual(dict(account_ids_by_code),
+                         dict(aep._account_ids_by_code))
+
+    def test_balance_snapshot(self):
+        '''
+        Balances of closed fiscal years are read from their snapshot
+        '''
+        snapshot_model = self.env['ecdf.balance.snapshot']
+        self.previous_fiscal_year.create_period()
+        period_ids = self.previous_fiscal_year.period_ids.ids
+        self.assertFalse(snapshot_model.get_fresh_period_ids(period_ids))
+
+        # Closing the fiscal year computes its snapshot
+        self.previous_fiscal_year.state = 'done'
+        self.assertTrue(self.previous_fiscal_year.ecdf_snapshot_date)
+        self.assertEqual(snapshot_model.get_fresh_period_ids(period_ids),
+                         set(period_ids))
+
+        # The snapshots of other companies are neither read nor refreshed
+        other = self.env['res.company'].create({'name': 'eCDF other company'})
+        manager = self.env['res.users'].create({
+            'name': 'eCDF other manager',
+            'login': 'ecdf_other_manager',
+            'company_id': other.id,
+            'company_ids': [(6, 0, [other.id])],
+            'groups_id': [(6, 0, [
+                self.env.ref('account.group_account_manager').id])]})
+        self.assertFalse(
+            snapshot_model.sudo(manager).get_fresh_period_ids(period_ids))
+        self.assertFalse(snapshot_model.sudo(manager).read_balances(
+            self.account_account.search([]).ids, period_ids, 'posted'))
+        with self.assertRaises(AccessError):
+            snapshot_model.sudo(manager).refresh(self.previous_fiscal_year)
+
+        # Same values from the snapshot and from the move lines
+        mis_report = self.env.ref('l10n_lu_mis_reports.mis_report_bs_2016')
+        data = self.report.compute(mis_report, self.previous_fiscal_year)
+        self.previous_fiscal_year.state = 'draft'
+        self.assertFalse(self.previous_fiscal_year.ecdf_snapshot_date)
+        self.assertFalse(snapshot_model.get_fresh_period_ids(period_ids))
+        self.assertEqual(
+            self.report.compute(mis_report, self.previous_fiscal_year),
+            data)
+
+    def test_shared_balances(self):
+        '''
+        Shared balances only fetch the accounts and periods not fetched yet
+        '''
+        self.current_fiscal_year.create_period()
+        period_ids = self.current_fiscal_year.period_ids.ids
+        account_ids = self.account_account.search(
+            [('company_id', '=', self.company.id)]).ids
+        balances = EcdfBalances(self.env, 'posted')
+        profiler = EcdfProfiler(self.env.cr)
+        with profiler.stage('first'):
+            balances.fetch(account_ids[1:], period_ids)
+        with profiler.stage('covered'):
+            balances.fetch(account_ids[2:], period_ids[:1])
+        with profiler.stage('missing'):
+            balances.fetch(account_ids[:2], period_ids)
+        queries = dict((s['stage'], s['queries'])
+                       for s in profiler.get_stats())
+        self.assertTrue(queries['first'])
+        self.assertEqual(queries['covered'], 0)
+        self.assertTrue(queries['missing'])
+        self.assertTrue(balances.covers(account_ids, period_ids))
+
+        # The templates of a declarer use the balances of the first one
+        mis_reports = [self.env.ref('l10n_lu_mis_reports.' + xml_id)
+                       for xml_id in ('mis_report_ca', 'mis_report_bs_2016')]
+        balances = EcdfBalances(self.env, 'posted')
+        data = [self.report.compute_multi(mis_report,
+                                          self.current_fiscal_year,
+                                          balances=balances)
+                for mis_report in mis_reports]
+        self.assertEqual(data, [self.report.compute_multi(
+            mis_report, self.current_fiscal_year)
+            for mis_report in mis_reports])
+
     def test_print_xml(self):
         '''
         Main test : generation of all types of reports
@@ -422,3 +1111,204 @@ class TestL10nLuEcdf(common.TransactionCase):
         # With no previous year, full
         self.report.reports_type = 'full'
         self.report.print_xml()
+
+    def test_multi_year(self):
+        '''
+        In multi-year mode, each declared fiscal year is computed once and
+        declared as by the wizard of the fiscal year
+        '''
+        for fiscal_year in (self.fiscal_year_2007, self.fiscal_year_2008,
+                            self.previous_fiscal_year,
+                            self.current_fiscal_year):
+            fiscal_year.create_period()
+        self.report.first_fiscyear = self.fiscal_year_2008
+        self.assertEqual(self.report._get_declared_fiscal_years(),
+                         self.fiscal_year_2008 | self.previous_fiscal_year |
+                         self.current_fiscal_year)
+        self.assertEqual(
+            set(self.report._get_report_fiscal_years(
+                {'type': 'CA_BILAN'}).ids),
+            set([self.fiscal_year_2007.id, self.fiscal_year_2008.id,
+                 self.previous_fiscal_year.id, self.current_fiscal_year.id]))
+
+        computed = []
+        declarations = self.report._compute_multi_year_declarations(
+            self.report._get_reports(),
+            progress=lambda report_type, fiscal_years: computed.append(
+                (report_type, len(fiscal_years))))
+        self.assertEqual(computed, [('CA_PLANCOMPTA', 3), ('CA_BILAN', 4),
+                                    ('CA_COMPP', 4)])
+        self.assertEqual([fiscal_year for fiscal_year, year_declarations
+                          in declarations],
+                         [self.fiscal_year_2008, self.previous_fiscal_year,
+                          self.current_fiscal_year])
+
+        # Same declarations as the wizard of the current fiscal year
+        declarer = self.report.copy({'first_fiscyear': False})._get_declarer()
+        self.assertEqual(
+            [etree.tostring(declaration)
+             for declaration in declarations[-1][1]],
+            [etree.tostring(declaration)
+             for declaration in declarer.iterchildren('Declaration')])
+
+        # One file with the declarations of all the fiscal years
+        self.report.print_xml()
+        content = base64.b64decode(self.report.xml_file)
+        self.assertEqual(content.count('<Declaration '), 9)
+
+        # One file per fiscal year
+        self.report.multi_year_output = 'per_year'
+        self.report.print_xml()
+        self.assertTrue(self.report.full_file_name.endswith('.zip'))
+        zip_file = zipfile.ZipFile(
+            StringIO(base64.b64decode(self.report.xml_file)))
+        self.assertEqual(len(zip_file.namelist()), 3)
+        self.assertEqual(self.env['ecdf.report.archive'].search_count(
+            [('fiscalyear_id', '=', self.fiscal_year_2008.id)]), 1)
+
+        with self.assertRaises(UserError):
+            self.report.print_xml_background()
+        with self.assertRaises(ValidationError), self.cr.savepoint():
+            self.report.first_fiscyear = self.account_fiscalyear.create({
+                'company_id': self.company.id,
+                'name': 'next_fiscalyear',
+                'code': '987654',
+                'date_start': '2016-01-01',
+                'date_stop': '2016-12-31'})
+
+    def test_print_xml_archive(self):
+        '''
+        The file of an unchanged request is returned from the archive, and
+        files with the same content share their attachment, each one keeping
+        its own reference
+        '''
+        self.current_fiscal_year.create_period()
+        self.previous_fiscal_year.create_period()
+        archive_model = self.env['ecdf.report.archive']
+        self.report.print_xml()
+        request_hash = self.report._get_request_hash()
+        archive = archive_model.find(self.company, request_hash)
+        self.assertTrue(archive)
+        self.assertEqual(archive.attachment_id.res_model,
+                         'account.fiscalyear')
+        self.assertEqual(archive.attachment_id.res_id,
+                         self.current_fiscal_year.id)
+        self.assertEqual(self.report.full_file_name,
+                         archive.file_reference + '.xml')
+
+        # Same request: archived file
+        self.report.full_file_name = False
+        self.report.print_xml()
+        self.assertEqual(self.report.full_file_name,
+                         archive.file_reference + '.xml')
+        self.assertEqual(self.report.xml_file, archive.attachment_id.datas)
+
+        # Other request, same content: shared attachment
+        self.report.remarks = 'other comment'
+        self.report.with_ac = False
+        self.report.print_xml()
+        new_archive = archive_model.find(self.company,
+                                         self.report._get_request_hash())
+        self.assertNotEqual(new_archive, archive)
+        self.report.remarks = 'comment'
+        self.report.print_xml()
+        same_archive = archive_model.find(self.company,
+                                          self.report._get_request_hash())
+        self.assertEqual(same_archive.attachment_id,
+                         new_archive.attachment_id)
+        self.assertNotEqual(same_archive.file_reference,
+                            new_archive.file_reference)
+        self.assertEqual(self.report.full_file_name,
+                         same_archive.file_reference + '.xml')
+        self.assertIn(same_archive.file_reference,
+                      base64.decodestring(self.report.xml_file))
+        self.assertEqual(base64.decodestring(same_archive.get_datas()),
+                         base64.decodestring(self.report.xml_file))
+        self.assertEqual(new_archive.get_datas(),
+                         new_archive.attachment_id.datas)
+
+        # Same request: archived file, with its own reference
+        self.report.print_xml()
+        self.assertEqual(self.report.full_file_name,
+                         same_archive.file_reference + '.xml')
+        self.assertEqual(
+            base64.decodestring(self.report.xml_file),
+            base64.decodestring(same_archive.get_datas()))
+
+        # The content hash ignores the file reference
+        datas = archive.attachment_id.datas
+        content = base64.decodestring(datas)
+        self.assertEqual(
+            get_content_hash(base64.encodestring(content.replace(
+                archive.file_reference, '000000X20150101T00000001'))),
+            get_content_hash(datas))
+
+    def test_print_xml_accountant(self):
+        '''
+        Accountants archive the files they generate, without write access
+        on the fiscal years
+        '''
+        self.current_fiscal_year.create_period()
+        self.previous_fiscal_year.create_period()
+        accountant = self.env['res.users'].create({
+            'name': 'eCDF accountant',
+            'login': 'ecdf_accountant',
+            'company_id': self.company.id,
+            'company_ids': [(6, 0, [self.company.id])],
+            'groups_id': [(6, 0, [
+                self.env.ref('account.group_account_user').id])]})
+        report = self.env['ecdf.report'].sudo(accountant).create(
+            self.report._get_report_values())
+        report.print_xml()
+        archive = self.env['ecdf.report.archive'].find(
+            self.company, report._get_request_hash())
+        self.assertEqual(archive.user_id, accountant)
+        self.assertEqual(report.full_file_name,
+                         archive.file_reference + '.xml')
+
+    def test_print_xml_background(self):
+        '''
+        Generation enqueued as a job, with progress per report and year
+        '''
+        self.current_fiscal_year.create_period()
+        self.previous_fiscal_year.create_period()
+
+        action = self.report.print_xml_background()
+        job = self.env['ecdf.report.job'].browse(action['res_id'])
+        self.assertEqual(job.state, 'pending')
+        # CA for the current year, BS and P&L for both years
+        self.assertEqual(len(job.step_ids), 5)
+        self.assertEqual(job.progress, 0.0)
+
+        job.run()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.progress, 100.0)
+        self.assertTrue(job.attachment_id.datas)
+
+    def test_reset_stale_jobs(self):
+        '''
+        A running job which is not locked is pending again
+        '''
+        action = self.report.print_xml_background()
+        job = self.env['ecdf.report.job'].browse(action['res_id'])
+        job.write({'state': 'running',
+                   'date_heartbeat': '2015-01-01 00:00:00'})
+        job_model = self.env['ecdf.report.job']
+        self.assertEqual(job_model._reset_stale_jobs(), job)
+        self.assertEqual(job.state, 'pending')
+
+        # A job locked by a scheduled action keeps running, whatever its
+        # heartbeat
+        job.state = 'running'
+        cr = self.registry.cursor()
+        try:
+            locked_job = job.with_env(self.env(cr=cr))
+            self.assertTrue(locked_job._try_lock())
+            try:
+                self.assertFalse(job._try_lock())
+                self.assertFalse(job_model._reset_stale_jobs())
+                self.assertEqual(job.state, 'running')
+            finally:
+                locked_job._unlock()
+        finally:
+            cr.close()
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
 from . import ecdf_report
+from . import ecdf_report_batch
@@ -12,20 +12,131 @@ Reports :
 Generation is based on MIS Builder
 '''
 
-from datetime import datetime
-from datetime import timedelta
-from cStringIO import StringIO
-import re as re
+from collections import defaultdict
+from functools import partial
 import base64
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import zipfile
 
 from lxml import etree
 from openerp import models, fields, api, tools
 from openerp.exceptions import ValidationError
 from openerp.exceptions import Warning as UserError
+from openerp.tools.safe_eval import _BUILTINS, _SAFE_OPCODES, test_expr
 from openerp.tools.translate import _
-from openerp.addons.mis_builder.models.aep import\
-    AccountingExpressionProcessor as AEP
 from openerp.addons.mis_builder.models.accounting_none import AccountingNone
+from openerp.addons.mis_builder.models.aggregate import \
+    _sum, _avg, _min, _max
+
+from ..models.ecdf_aep import EcdfAEP, EcdfBalances
+from ..models.ecdf_fiscal_context import EcdfFiscalContext
+from ..models.ecdf_kpi_data import EcdfKpiData, EcdfKpiTable
+from ..models.ecdf_parallel import export_snapshot, run_in_workers
+from ..models.ecdf_profiler import EcdfProfiler, NO_PROFILER
+from ..models.mis_report import ECDF_KPI_NAME, ECDF_TEMPLATES, \
+    VARIABLE_NAME
+from ..models.res_company import MATRICULE_LENGTHS, RCS_NUMBER, VAT_NUMBER
+
+_logger = logging.getLogger(__name__)
+
+ECDF_NAMESPACE = "http://www.ctie.etat.lu/2011/ecdf"
+
+# Compiled eCDF schema, shared by all the threads of the process
+_ecdf_schema = None
+_ecdf_schema_lock = threading.Lock()
+
+
+def _get_ecdf_schema():
+    '''
+    :returns: the eCDF schema, compiled on first use
+    Must be called with _ecdf_schema_lock acquired.
+    '''
+    global _ecdf_schema
+    if _ecdf_schema is None:
+        xsd = tools.file_open('l10n_lu_ecdf/xsd/ecdf-v1.1.xsd')
+        try:
+            _ecdf_schema = etree.XMLSchema(etree.parse(xsd))
+        finally:
+            xsd.close()
+    return _ecdf_schema
+
+
+def _ecdf_schema_errors(doc):
+    '''
+    Validates a document against the eCDF schema. lxml validators keep
+    their error log, so validations are serialised.
+    :param doc: XML document or node
+    :returns: the validation errors (empty if the document is valid)
+    '''
+    with _ecdf_schema_lock:
+        schema = _get_ecdf_schema()
+        if schema.validate(doc):
+            return []
+        return list(schema.error_log)
+
+
+def _ecdf_schema_stream_errors(fileobj):
+    '''
+    Validates an eCDF file while parsing it, releasing the declarers as
+    soon as they are validated, so the document is never fully loaded.
+    :param fileobj: file object of the XML file
+    :returns: the validation errors (empty if the file is valid)
+    '''
+    with _ecdf_schema_lock:
+        schema = _get_ecdf_schema()
+        try:
+            for event, element in etree.iterparse(
+                    fileobj, schema=schema,
+                    tag='{%s}Declarer' % ECDF_NAMESPACE):
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        except etree.XMLSyntaxError as e:
+            return [e]
+        return []
+
+
+def _base64_file(fileobj):
+    '''
+    :returns: the content of the file encoded in base64, without holding
+              the decoded content in memory
+    '''
+    encoded = tempfile.TemporaryFile()
+    try:
+        base64.encode(fileobj, encoded)
+        encoded.seek(0)
+        return encoded.read()
+    finally:
+        encoded.close()
+
+
+def _compute_declaration_task(report_values, report, profiling, ledger_state,
+                              env):
+    '''
+    Task run by the workers: computes one of the selected reports
+    :param report_values: values of the eCDF report wizard
+    :param report: dict(type, model, templ) of the report
+    :param profiling: whether the stages of the report are recorded
+    :param ledger_state: state of the ledger of the generation
+    :returns: tuple (XML node "Declaration" as a string or None, values to
+              store, EcdfProfiler of the worker or None)
+    '''
+    wizard = env['ecdf.report'].new(report_values)
+    profiler = EcdfProfiler(env.cr) if profiling else NO_PROFILER
+    fiscal_contexts = wizard._get_fiscal_contexts(
+        wizard.current_fiscyear | wizard.prev_fiscyear)
+    stored_results = []
+    declaration = wizard._compute_declaration(report, fiscal_contexts,
+                                              profiler=profiler,
+                                              stored_results=stored_results,
+                                              ledger_state=ledger_state)
+    if declaration is not None:
+        declaration = etree.tostring(declaration)
+    return declaration, stored_results, profiler if profiling else None
 
 
 class EcdfReport(models.TransientModel):
@@ -71,6 +182,21 @@ class EcdfReport(models.TransientModel):
                                        required=True)
     prev_fiscyear = fields.Many2one('account.fiscalyear',
                                     'Previous Fiscal Year')
+    # Multi-year mode
+    first_fiscyear = fields.Many2one('account.fiscalyear',
+                                     'First Fiscal Year',
+                                     help="Declare all the fiscal years "
+                                          "from this one to the current "
+                                          "fiscal year, each one with the "
+                                          "fiscal year before it. Each "
+                                          "fiscal year is computed once.")
+    multi_year_output = fields.Selection(
+        (('single', 'One file'),
+         ('per_year', 'One file per fiscal year')),
+        'Multi-year Output',
+        default='single',
+        help="One file declaring all the fiscal years, or a zip archive "
+             "of one file per fiscal year")
     # Comments
     remarks = fields.Text('Comments')
     # Agent
@@ -80,14 +206,29 @@ class EcdfReport(models.TransientModel):
                       size=10)
     company_registry = fields.Char('Company Registry',
                                    size=7)
-    # File name (computed)
-    file_reference = fields.Char('File name',
-                                 size=24,
-                                 compute='_compute_file_reference')
     full_file_name = fields.Char('Full file name',
                                  size=28)
     # File
     xml_file = fields.Binary('XML File', readonly=True)
+    # Instrumentation
+    profiling = fields.Boolean('Record timings',
+                               help="Record the time, the SQL queries and "
+                                    "the rows fetched by each stage of the "
+                                    "generation, per report type.")
+    profile_log = fields.Text('Timings', readonly=True)
+    # Preview
+    preview_codes = fields.Char('eCDF Codes',
+                                help="eCDF codes to compute before "
+                                     "generating the file, separated by "
+                                     "commas, such as 639, 640")
+    preview_result = fields.Text('Preview', readonly=True)
+    report_workers = fields.Integer('Parallel Reports',
+                                    default=1,
+                                    help="Number of report types computed "
+                                         "at the same time, each one with "
+                                         "its own database connection "
+                                         "sharing the snapshot of the "
+                                         "generation.")
 
     @api.multi
     @api.constrains('matricule')
@@ -97,8 +238,8 @@ class EcdfReport(models.TransientModel):
         '''
         for record in self:
             if not record.matricule:
-                return
-            if len(record.matricule) not in [11, 13]:
+                continue
+            if len(record.matricule) not in MATRICULE_LENGTHS:
                 raise ValidationError(_('Matricule must be 11 or 13 \
                 characters long.'))
 
@@ -108,12 +249,10 @@ class EcdfReport(models.TransientModel):
         '''
         Constraint : regex validation on RCS Number
         '''
-        exp = r"""^[A-Z][^0]\d{1,5}$"""
-        rexp = re.compile(exp, re.X)
         for record in self:
             if not record.company_registry:
-                return
-            if not rexp.match(record.company_registry):
+                continue
+            if not RCS_NUMBER.match(record.company_registry):
                 raise ValidationError(_('RCS number must begin with an \
                 uppercase letter followed by 2 to 6 digits. \
                 The first digit must not be 0.'))
@@ -124,18 +263,15 @@ class EcdfReport(models.TransientModel):
         '''
         Constraint : regex validation on VAT Number
         '''
-        exp = r"""^[A-Z]{2}\d{8}$"""
-        rexp = re.compile(exp, re.X)
         for record in self:
             if not record.vat:
-                return
-            if not rexp.match(record.vat):
+                continue
+            if not VAT_NUMBER.match(record.vat):
                 raise ValidationError(_('VAT number must begin with two \
                 uppercase letters followed by 8 digits.'))
 
-    @api.depends('chart_account_id.company_id.ecdf_prefixe')
     @api.multi
-    def _compute_file_reference(self):
+    def _allocate_file_reference(self):
         '''
         000000XyyyymmddThhmmssNN
         Position 1 - 6: eCDF prefix of the user's company
@@ -145,26 +281,25 @@ class EcdfReport(models.TransientModel):
         Position 17 - 22: creation time of the file, format hhmmss
         Position 23 - 24: sequence number (NN) in range (01 - 99)
         for the unicity of the names of the files created in the same second
+        :returns: a new file reference, unique for the eCDF prefix of the
+                  company, for a file generated now
         '''
-        for record in self:
-            nbr = 1
-            dtf = "X%Y%m%dT%H%M%S"
-            prefixe = record.chart_account_id.company_id.ecdf_prefixe
-            if not prefixe:
-                prefixe = '000000'
-            res = prefixe + datetime.now().strftime(dtf) + str("%02d" % nbr)
-            record.file_reference = res
+        self.ensure_one()
+        prefixe = self.chart_account_id.company_id.ecdf_prefixe or '000000'
+        return self.env['ecdf.file.reference'].allocate(prefixe)
 
     @api.multi
     @api.onchange('chart_account_id')
     def _onchange_company(self):
         '''
         On Change : 'chart_account_id'
-        Fields 'current_fiscyear' and 'prev_fiscyear' are reset
+        Fields 'current_fiscyear', 'prev_fiscyear' and 'first_fiscyear'
+        are reset
         '''
         for record in self:
             record.current_fiscyear = False
             record.prev_fiscyear = False
+            record.first_fiscyear = False
 
     @api.multi
     @api.onchange('current_fiscyear')
@@ -176,19 +311,8 @@ class EcdfReport(models.TransientModel):
         for rec in self:
             rec.prev_fiscyear = False
             if rec.current_fiscyear:
-                # get the date stop
-                previous_date_stop = datetime.strftime(
-                    datetime.strptime(
-                        rec.current_fiscyear.date_start,
-                        "%Y-%m-%d"
-                    ) - timedelta(days=1),
-                    "%Y-%m-%d"
-                )
-                # search fiscal year with the previous date stop as date stop
-                rec.prev_fiscyear = rec.env['account.fiscalyear'].search(
-                    [('date_stop', '=', previous_date_stop),
-                     ('company_id', '=', rec.current_fiscyear.company_id.id)]
-                )
+                rec.prev_fiscyear = \
+                    rec.current_fiscyear.get_previous_fiscalyear()
 
     @api.multi
     @api.constrains('prev_fiscyear')
@@ -204,6 +328,23 @@ class EcdfReport(models.TransientModel):
                 raise ValidationError(
                     _('Previous fiscal year must be before the current one'))
 
+    @api.multi
+    @api.constrains('first_fiscyear', 'current_fiscyear')
+    def _check_first_fiscyear(self):
+        '''
+        Constraint : first_fiscyear <= current_fiscyear, of the same company
+        '''
+        for record in self:
+            if not record.first_fiscyear:
+                continue
+            if record.first_fiscyear.company_id != \
+                    record.current_fiscyear.company_id or \
+                    record.first_fiscyear.date_start > \
+                    record.current_fiscyear.date_start:
+                raise ValidationError(
+                    _('First fiscal year must be a fiscal year of the same '
+                      'company, not after the current one'))
+
     @staticmethod
     def get_ecdf_file_version():
         '''
@@ -331,218 +472,289 @@ class EcdfReport(models.TransientModel):
         :param val: value to add in the XML node
         :param comment: Optional comment
         '''
-        if val is None or val is AccountingNone:
-            if ecdf in self.KEEP_ZERO:
-                val = 0.0
-            else:
-                return
-        value = round(val, 2) or 0.0
-        if comment:
-            element.append(etree.Comment(comment))
-        child = etree.Element('NumericField', id=ecdf)
-        child.text = ("%.2f" % value).replace('.', ',')
-        element.append(child)
+        self._append_num_fields(element, [(ecdf, val, comment)])
+
+    @api.multi
+    def _append_num_fields(self, element, num_fields):
+        '''
+        Appends lines "NumericField" in one pass, with the same rules as
+        _append_num_field
+        :param element: XML node
+        :param num_fields: iterable of (eCDF code, value, comment)
+        '''
+        keep_zero = self.KEEP_ZERO
+        for ecdf, val, comment in num_fields:
+            if val is None or val is AccountingNone:
+                if ecdf in keep_zero:
+                    val = 0.0
+                else:
+                    continue
+            if comment:
+                element.append(etree.Comment(comment))
+            child = etree.SubElement(element, 'NumericField', id=ecdf)
+            child.text = ("%.2f" % (round(val, 2) or 0.0)).replace('.', ',')
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_ecdf_code_map(self, kpi_technical_names):
+        '''
+        Maps the KPIs of a template to their eCDF codes. The technical
+        names of a template only change with the template, so the map is
+        computed once per template version.
+        :param kpi_technical_names: tuple of the KPI technical names, in the
+                                    order of the computed data
+        :returns: tuple of (index in the data, code 1, code 2) for the KPIs
+                  declared in eCDF
+        '''
+        code_map = []
+        for index, name in enumerate(kpi_technical_names):
+            line_match = ECDF_KPI_NAME.match(name or '')
+            if line_match:
+                code_map.append((index,
+                                 line_match.group('code1'),
+                                 line_match.group('code2')))
+        return tuple(code_map)
+
+    @api.model
+    def _get_data_code_map(self, data):
+        '''
+        :param data: EcdfKpiData, or list of dict(kpi_name,
+                     kpi_technical_name, val)
+        :returns: the eCDF code map of the data (see _get_ecdf_code_map)
+        '''
+        return self._get_ecdf_code_map(
+            EcdfKpiData.wrap(data).table.technical_names)
 
     @api.multi
     def _append_fr_lines(self, data_curr, form_data, data_prev=None):
         '''
         Appends lines "NumericField" in the "form_data" node
-        :param data_curr: data of the previous year
+        :param data_curr: data of the previous year (EcdfKpiData, or list
+                          of dict(kpi_name, kpi_technical_name, val))
         :param form_data: XML node "form_data"
         :param data_prev: date of the previous year
         '''
-        # Regex : group('current') : ecdf_code for current year
-        #         group('previous') : ecdf_code for previous year
-        exp = r"""^ecdf\_(?P<previous>\d*)\_(?P<current>\d*)"""
-        rexp = re.compile(exp, re.X)
+        data_curr = EcdfKpiData.wrap(data_curr)
+        data_prev = EcdfKpiData.wrap(data_prev)
+        # code 1 : ecdf_code for previous year
+        # code 2 : ecdf_code for current year
+        code_map = self._get_data_code_map(data_curr)
         for record in self:
-            for report in data_curr:
-                line_match = rexp.match(report['kpi_technical_name'])
-                if line_match:
-                    ecdf_code = line_match.group('current')
-                    record._append_num_field(
-                        form_data,
-                        ecdf_code,
-                        report['val'],
-                        comment=" current - %s " % report['kpi_name']
-                    )
+            record._append_num_fields(form_data, [
+                (current, data_curr.get_val(index),
+                 " current - %s " % data_curr.get_kpi_name(index))
+                for index, previous, current in code_map])
             if data_prev:
                 # Previous fiscal year
-                for report in data_prev:
-                    line_match = rexp.match(report['kpi_technical_name'])
-                    if line_match:
-                        ecdf_code = line_match.group('previous')
-                        record._append_num_field(
-                            form_data,
-                            ecdf_code,
-                            report['val'],
-                            comment=" previous - %s " % report['kpi_name']
-                        )
+                record._append_num_fields(form_data, [
+                    (previous, data_prev.get_val(index),
+                     " previous - %s " % data_prev.get_kpi_name(index))
+                    for index, previous, current
+                    in self._get_data_code_map(data_prev)])
             else:
                 # No Previous fical year: we must output 0.0 for
                 # items where we have a value in current fiscal year
                 form_data.append(etree.Comment(" no previous year"))
-                for report in data_curr:
-                    line_match = rexp.match(report['kpi_technical_name'])
-                    if line_match:
-                        ecdf_code = line_match.group('previous')
-                        if report['val'] not in (AccountingNone, None):
-                            record._append_num_field(form_data,
-                                                     ecdf_code,
-                                                     0.0)
+                record._append_num_fields(form_data, [
+                    (previous, 0.0, None)
+                    for index, previous, current in code_map
+                    if data_curr.has_val(index)])
+
+    @api.multi
+    def _get_fiscal_contexts(self, fiscal_years):
+        '''
+        :param fiscal_years: fiscal years of the company of the wizard
+        :returns: dict {fiscal year id: EcdfFiscalContext}
+        '''
+        self.ensure_one()
+        return EcdfFiscalContext.resolve(
+            self.env, fiscal_years,
+            self.chart_account_id.company_id.currency_id)
+
+    @api.multi
+    def _get_ledger_state(self):
+        '''
+        :returns: the state of the ledger of the company, read once per
+                  generation, see ecdf.kpi.result.get_ledger_state
+        '''
+        self.ensure_one()
+        return self.env['ecdf.kpi.result'].get_ledger_state(
+            self.chart_account_id.company_id)
+
+    @api.multi
+    def _get_declaration(self, report_type, report_model, fiscal_context):
+        '''
+        :param fiscal_context: EcdfFiscalContext of the declared fiscal year
+        :returns: XML node "Declaration" and its node "FormData", with the
+                  year, the period and the text fields of the fiscal year
+        '''
+        self.ensure_one()
+        declaration = etree.Element('Declaration',
+                                    type=report_type,
+                                    language=self.get_language(),
+                                    model=report_model)
+        year = etree.SubElement(declaration, 'Year')
+        year.text = fiscal_context.year
+        period = etree.SubElement(declaration, 'Period')
+        period.text = '1'
+        form_data = etree.SubElement(declaration, 'FormData')
+        for field_id, text in fiscal_context.text_fields:
+            tfid = etree.SubElement(form_data, 'TextField', id=field_id)
+            tfid.text = text
+        return declaration, form_data
 
     @api.multi
     def _get_finan_report(self, data_current, report_type, report_model,
-                          data_previous=None):
+                          data_previous=None, fiscal_context=None):
         '''
         Generates a financial report (P&L or Balance Sheet) in XML format
         :param data_current: dictionary of data of the current year
         :param report_type: technical name of the report type
         :param data_previous: dictionary of data of the previous year
+        :param fiscal_context: EcdfFiscalContext of the current year
         :returns: XML node called "declaration"
         '''
         self.ensure_one()
-        period_ids = (self.env['account.period'].search(
-            [('special', '=', False),
-                ('fiscalyear_id', '=', self.current_fiscyear.id)]
-        )).sorted(key=lambda r: r.date_start)
+        if fiscal_context is None:
+            fiscal_context = self._get_fiscal_contexts(
+                self.current_fiscyear)[self.current_fiscyear.id]
 
-        if not period_ids:
+        if not fiscal_context.periods:
             return
 
-        period_from = period_ids[0]
-        period_to = period_ids[-1]
-        currency = self.chart_account_id.company_id.currency_id
-        declaration = etree.Element('Declaration',
-                                    type=report_type,
-                                    language=self.get_language(),
-                                    model=report_model)
-        year = etree.Element('Year')
-        year.text = datetime.strptime(period_from.date_start,
-                                      "%Y-%m-%d").strftime("%Y")
-        period = etree.Element('Period')
-        period.text = '1'
-        form_data = etree.Element('FormData')
-        tfid = etree.Element('TextField', id='01')
-        tfid.text = datetime.strptime(period_from.date_start,
-                                      "%Y-%m-%d").strftime("%d/%m/%Y")
-        form_data.append(tfid)
-        tfid = etree.Element('TextField', id='02')
-        tfid.text = datetime.strptime(period_to.date_stop,
-                                      "%Y-%m-%d").strftime("%d/%m/%Y")
-        form_data.append(tfid)
-        tfid = etree.Element('TextField', id='03')
-        tfid.text = currency.name
-        form_data.append(tfid)
-
+        declaration, form_data = self._get_declaration(report_type,
+                                                       report_model,
+                                                       fiscal_context)
         self._append_fr_lines(data_current,
                               form_data,
                               data_previous)
 
-        declaration.append(year)
-        declaration.append(period)
-        declaration.append(form_data)
-
         return declaration
 
     @api.multi
-    def _get_chart_ac(self, data, report_type, report_model):
+    def _get_chart_ac(self, data, report_type, report_model,
+                      fiscal_context=None):
         '''
         Generates the chart of accounts in XML format
-        :param data: Dictionary of values (name, technical name, value)
+        :param data: EcdfKpiData, or list of dict(kpi_name,
+                     kpi_technical_name, val)
         :param report_type: Technical name of the report type
+        :param fiscal_context: EcdfFiscalContext of the current year
         :returns: XML node called "declaration"
         '''
         self.ensure_one()
-        # Regex : group('debit') : ecdf_code for debit column
-        #         group('credit') ecdf_code for credit column
-        exp = r"""^ecdf\_(?P<debit>\d*)\_(?P<credit>\d*)"""
-        rexp = re.compile(exp, re.X)
-
-        period_ids = (self.env['account.period'].search(
-            [('special', '=', False),
-                ('fiscalyear_id', '=', self.current_fiscyear.id)]
-        )).sorted(key=lambda r: r.date_start)
+        if fiscal_context is None:
+            fiscal_context = self._get_fiscal_contexts(
+                self.current_fiscyear)[self.current_fiscyear.id]
 
-        if not period_ids:
+        if not fiscal_context.periods:
             return
 
-        period_from = period_ids[0]
-        period_to = period_ids[-1]
-        declaration = etree.Element('Declaration',
-                                    type=report_type,
-                                    language=self.get_language(),
-                                    model=report_model)
-        year = etree.Element('Year')
-        year.text = datetime.strptime(period_from.date_start,
-                                      "%Y-%m-%d").strftime("%Y")
-        period = etree.Element('Period')
-        period.text = '1'
-        form_data = etree.Element('FormData')
-        tfid = etree.Element('TextField', id='01')
-        tfid.text = datetime.strptime(period_from.date_start,
-                                      "%Y-%m-%d").strftime("%d/%m/%Y")
-        form_data.append(tfid)
-        tfid = etree.Element('TextField', id='02')
-        tfid.text = datetime.strptime(period_to.date_stop,
-                                      "%Y-%m-%d").strftime("%d/%m/%Y")
-        form_data.append(tfid)
-        tfid = etree.Element('TextField', id='03')
-        tfid.text = self.chart_account_id.company_id.currency_id.name
-        form_data.append(tfid)
+        declaration, form_data = self._get_declaration(report_type,
+                                                       report_model,
+                                                       fiscal_context)
 
         if self.remarks:  # add remarks in chart of accounts
             fid = etree.Element('TextField', id='2385')
             fid.text = self.remarks
             form_data.append(fid)
 
-        for report in data:
-            line_match = rexp.match(report['kpi_technical_name'])
-            if line_match:
-                if report['val'] not in (AccountingNone, None):
-                    balance = round(report['val'], 2)
-                    if balance <= 0:  # 0.0 must be in the credit column
-                        ecdf_code = line_match.group('credit')
-                        balance = abs(balance)
-                        comment = 'credit'
-                    else:
-                        ecdf_code = line_match.group('debit')
-                        comment = 'debit'
-
-                    # code 106 appears 2 times in the chart of accounts
-                    # with different ecdf codes
-                    # so we hard-code it here:
-                    # this is the only exception to the general algorithm
-                    # TODO why not have 2 kpi's which return the same result
-                    #      so the algorithm remains generic?
-                    if report['kpi_name'][:5] == '106 -':
-                        if balance <= 0.0:
-                            ecdf_codes = ['0118', '2260']
-                        else:
-                            ecdf_codes = ['0117', '2259']
-
-                        self._append_num_field(
-                            form_data, ecdf_codes[0], balance,
-                            comment=" %s - %s " % (comment,
-                                                   report['kpi_name'])
-                        )
-                        self._append_num_field(
-                            form_data, ecdf_codes[1], balance,
-                            comment=" %s - %s " % (comment,
-                                                   report['kpi_name'])
-                        )
-
-                    self._append_num_field(
-                        form_data, ecdf_code, balance,
-                        comment=" %s - %s " % (comment, report['kpi_name'])
-                    )
-
-        declaration.append(year)
-        declaration.append(period)
-        declaration.append(form_data)
+        # code 1 : ecdf_code for debit column
+        # code 2 : ecdf_code for credit column
+        num_fields = []
+        data = EcdfKpiData.wrap(data)
+        for index, debit_code, credit_code in self._get_data_code_map(data):
+            if not data.has_val(index):
+                continue
+            kpi_name = data.get_kpi_name(index)
+            balance = round(data.get_val(index), 2)
+            if balance <= 0:  # 0.0 must be in the credit column
+                ecdf_code = credit_code
+                balance = abs(balance)
+                comment = " credit - %s " % kpi_name
+            else:
+                ecdf_code = debit_code
+                comment = " debit - %s " % kpi_name
+
+            # code 106 appears 2 times in the chart of accounts
+            # with different ecdf codes
+            # so we hard-code it here:
+            # this is the only exception to the general algorithm
+            # TODO why not have 2 kpi's which return the same result
+            #      so the algorithm remains generic?
+            if kpi_name[:5] == '106 -':
+                if balance <= 0.0:
+                    ecdf_codes = ['0118', '2260']
+                else:
+                    ecdf_codes = ['0117', '2259']
+                num_fields.append((ecdf_codes[0], balance, comment))
+                num_fields.append((ecdf_codes[1], balance, comment))
+
+            num_fields.append((ecdf_code, balance, comment))
+        self._append_num_fields(form_data, num_fields)
 
         return declaration
 
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_aep_parsed_state(self, mis_template_id, write_date,
+                              chart_account_id):
+        '''
+        Parses the KPI expressions of a MIS template and resolves their
+        account codes in a chart of accounts.
+        The result is cached per process; the cache is cleared when KPIs
+        or accounts are modified.
+
+        :param write_date: last update of the template, part of the key only
+        :returns: parsed state of an EcdfAEP
+        '''
+        aep = EcdfAEP(self.env)
+        plan = self.env['mis.report'].browse(mis_template_id).ecdf_get_plan()
+        for entry in plan['kpis']:
+            for source in entry['variables']:
+                aep.parse_expr(source)
+        aep.done_parsing(self.env['account.account'].browse(chart_account_id))
+        return aep.get_parsed_state()
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_aep_code_index(self, mis_template_id, write_date,
+                            chart_account_id):
+        '''
+        Indexes the account prefixes of a MIS template, for a chart of
+        accounts. Cached as _get_aep_parsed_state().
+
+        :returns: code index of an EcdfAEP
+        '''
+        aep = EcdfAEP(self.env)
+        aep.set_parsed_state(self._get_aep_parsed_state(mis_template_id,
+                                                        write_date,
+                                                        chart_account_id))
+        return aep.get_code_index()
+
+    @api.multi
+    def _get_aep(self, mis_template, balances=None):
+        '''
+        :param mis_template: template MIS Builder of the report
+        :param balances: optional EcdfBalances shared with the other
+                         templates of the generation
+        :returns: an EcdfAEP ready to compute the template for the
+                  chart of accounts of the wizard
+        '''
+        self.ensure_one()
+        aep = EcdfAEP(self.env)
+        aep.set_parsed_state(self._get_aep_parsed_state(
+            mis_template.id,
+            mis_template.write_date,
+            self.chart_account_id.id))
+        aep.set_code_index(self._get_aep_code_index(
+            mis_template.id,
+            mis_template.write_date,
+            self.chart_account_id.id))
+        if balances is not None:
+            aep.set_balances(balances)
+        return aep
+
     @api.multi
     def compute(self, mis_template, fiscal_year):
         '''
@@ -550,104 +762,616 @@ class EcdfReport(models.TransientModel):
 
         :param mis_template: template MIS Builder of the report
         :param fiscal_year: fiscal year to compute
-        :returns: list of dict(kpi_name, kpi_technical_name, val)
+        :returns: EcdfKpiData, readable as a list of dict(kpi_name,
+                  kpi_technical_name, val)
+        '''
+        self.ensure_one()
+        return self.compute_multi(mis_template, fiscal_year)[fiscal_year.id]
+
+    @api.multi
+    def compute_multi(self, mis_template, fiscal_years, profiler=NO_PROFILER,
+                      report_type=None, fiscal_contexts=None,
+                      stored_results=None, balances=None, ledger_state=None):
+        '''
+        Compute the values for several fiscal years, using the MIS Builder
+        template. The KPI expressions are parsed once and the balances of
+        all the fiscal years are fetched with one grouped query.
+
+        :param mis_template: template MIS Builder of the report
+        :param fiscal_years: fiscal years to compute
+        :param profiler: EcdfProfiler recording the stages "parse" and
+                         "compute" for the report type
+        :param fiscal_contexts: dict {fiscal year id: EcdfFiscalContext}
+                                containing the fiscal years, resolved if
+                                not given
+        :param stored_results: optional list collecting the arguments of
+                               ecdf.kpi.result.store, the records given by
+                               their ids, instead of storing the values
+                               (for workers rolling back their transaction)
+        :param balances: optional EcdfBalances shared with the other
+                         templates of the generation
+        :param ledger_state: state of the ledger of the generation, see
+                             ecdf.kpi.result.get_ledger_state, read if not
+                             given
+        :returns: dict {fiscal year id: EcdfKpiData}, the values sharing
+                  the names of the KPIs of the template
         '''
         self.ensure_one()
 
         # prepare AccountingExpressionProcessor
-        aep = AEP(self.env)
-        for kpi in mis_template.kpi_ids:
-            aep.parse_expr(kpi.expression)
-        aep.done_parsing(self.chart_account_id)
-
-        # Search periods
-        period_from = None
-        period_to = None
-        period_ids = self.env['account.period'].search(
-            [('special', '=', False),
-                ('fiscalyear_id', '=', fiscal_year.id)])
-        period_ids = period_ids.sorted(key=lambda r: r.date_start)
-        if period_ids:
-            period_from = period_ids[0]
-            period_to = period_ids[-1]
-
-        # Compute KPI values
-        kpi_values = mis_template._compute(self.env.lang, aep,
-                                           fiscal_year.date_start,
-                                           fiscal_year.date_stop,
-                                           period_from,
-                                           period_to,
+        with profiler.stage('parse', report_type):
+            aep = self._get_aep(mis_template, balances=balances)
+
+        with profiler.stage('compute', report_type):
+            if fiscal_contexts is None:
+                fiscal_contexts = self._get_fiscal_contexts(fiscal_years)
+            result_model = self.env['ecdf.kpi.result']
+            chart = self.chart_account_id
+            if ledger_state is None:
+                ledger_state = self._get_ledger_state()
+
+            # Values computed last time, and the KPIs to evaluate again
+            values = {}
+            signatures = {}
+            to_compute = []
+            to_update = []
+            to_store = []
+            for fiscal_year in fiscal_years:
+                signature = result_model.get_signature(
+                    chart, mis_template, fiscal_contexts[fiscal_year.id])
+                signatures[fiscal_year.id] = signature
+                stored = result_model.find(chart, fiscal_year, mis_template,
                                            self.target_move)
-        # prepare result
+                changed_account_ids = None
+                if stored and stored.signature == signature and \
+                        not mis_template.query_ids:
+                    changed_account_ids = stored.get_changed_account_ids()
+                if changed_account_ids is None:
+                    to_compute.append(fiscal_year)
+                    to_store.append(fiscal_year)
+                    continue
+                values[fiscal_year.id] = stored.get_values()
+                if not changed_account_ids:
+                    continue
+                to_store.append(fiscal_year)
+                kpi_names = self._get_dirty_kpis(mis_template,
+                                                 changed_account_ids)
+                if kpi_names:
+                    to_update.append((fiscal_year, kpi_names))
+
+            # Fetch the balances of all the fiscal years at once, only
+            # for the accounts of the KPIs to evaluate if no fiscal year
+            # is computed from scratch
+            periods = []
+            for fiscal_year in to_compute + [u[0] for u in to_update]:
+                fiscal_context = fiscal_contexts[fiscal_year.id]
+                periods.append((fiscal_year.date_start,
+                                fiscal_year.date_stop,
+                                fiscal_context.period_from,
+                                fiscal_context.period_to))
+            account_ids = None
+            if not to_compute:
+                account_ids = set()
+                for fiscal_year, kpi_names in to_update:
+                    account_ids |= self._get_kpis_account_ids(mis_template,
+                                                              kpi_names)
+            if periods:
+                aep.prefetch(periods, self.target_move, account_ids)
+
+            for fiscal_year in to_compute:
+                fiscal_context = fiscal_contexts[fiscal_year.id]
+                if mis_template.query_ids:
+                    # Compute KPI values
+                    kpi_values = mis_template._compute(
+                        self.env.lang, aep,
+                        fiscal_year.date_start,
+                        fiscal_year.date_stop,
+                        fiscal_context.period_from,
+                        fiscal_context.period_to,
+                        self.target_move)
+                    values[fiscal_year.id] = dict(
+                        (name, kpi_value['val'])
+                        for name, kpi_value in kpi_values.items())
+                    continue
+                # Compute KPI values, the totals after the KPIs they use
+                values[fiscal_year.id] = {}
+                self._evaluate_kpis(mis_template, aep,
+                                    self._get_template_order(mis_template),
+                                    fiscal_year, fiscal_context,
+                                    values[fiscal_year.id])
+            for fiscal_year, kpi_names in to_update:
+                self._evaluate_kpis(mis_template, aep, kpi_names,
+                                    fiscal_year,
+                                    fiscal_contexts[fiscal_year.id],
+                                    values[fiscal_year.id])
+            for fiscal_year in to_store:
+                if stored_results is not None:
+                    stored_results.append((chart.id, fiscal_year.id,
+                                           mis_template.id, self.target_move,
+                                           signatures[fiscal_year.id],
+                                           ledger_state,
+                                           values[fiscal_year.id]))
+                    continue
+                result_model.store(chart, fiscal_year, mis_template,
+                                   self.target_move,
+                                   signatures[fiscal_year.id],
+                                   ledger_state,
+                                   values[fiscal_year.id])
+
+            # prepare result
+            table = self._get_template_table(mis_template)
+            res = {}
+            for fiscal_year in fiscal_years:
+                res[fiscal_year.id] = EcdfKpiData.from_dict(
+                    table, values[fiscal_year.id])
+
+        return res
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_kpi_plan(self, mis_template_id, write_date):
+        '''
+        Loads the evaluation plan of a MIS template (see mis.report
+        ecdf_get_plan): the expressions are checked against the opcodes
+        allowed by safe_eval and compiled, and the accounting variables
+        parsed, once per process.
+
+        :param write_date: last update of the template, part of the key only
+        :returns: tuple of (KPI name, code of the expression using the
+                  names of the accounting variables or None if it is not
+                  valid, tuple of the accounting variables, names of the
+                  KPIs used by the KPI), the used KPIs first
+        '''
+        plan = self.env['mis.report'].browse(mis_template_id).ecdf_get_plan()
+        aep = EcdfAEP(self.env)
         res = []
-        for kpi in mis_template.kpi_ids:
-            res.append({
-                'kpi_name': kpi.description,
-                'kpi_technical_name': kpi.name,
-                'val': kpi_values[kpi.name]['val'],
-            })
+        for entry in plan['kpis']:
+            try:
+                code = test_expr(entry['expression'], _SAFE_OPCODES)
+            except Exception:
+                # as in MIS Builder, errors give no value
+                code = None
+            res.append((entry['name'],
+                        code,
+                        tuple(aep.parse_variable(source)
+                              for source in entry['variables']),
+                        frozenset(entry['used'])))
+        return tuple(res)
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_kpi_evaluation(self, mis_template_id, write_date,
+                            chart_account_id):
+        '''
+        Evaluation plan of a MIS template for a chart of accounts: the
+        accounting variables resolved to the ids of their accounts
+
+        :param write_date: last update of the template, part of the key only
+        :returns: dict {KPI name: (code of the expression or None, tuple of
+                  the resolved accounting variables)}
+        '''
+        aep = EcdfAEP(self.env)
+        aep.set_parsed_state(self._get_aep_parsed_state(mis_template_id,
+                                                        write_date,
+                                                        chart_account_id))
+        aep.set_code_index(self._get_aep_code_index(mis_template_id,
+                                                    write_date,
+                                                    chart_account_id))
+        return dict((name, (code, tuple(aep.resolve_variable(variable)
+                                        for variable in variables)))
+                    for name, code, variables, used_names
+                    in self._get_kpi_plan(mis_template_id, write_date))
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_kpi_codes(self, mis_template_id, write_date):
+        '''
+        :param write_date: last update of the template, part of the key only
+        :returns: tuple of (KPI name, code 1, code 2) of the KPIs declared
+                  in eCDF, from the evaluation plan of the template
+        '''
+        plan = self.env['mis.report'].browse(mis_template_id).ecdf_get_plan()
+        return tuple(tuple(codes) for codes in plan['codes'])
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_kpi_table(self, mis_template_id, write_date, lang):
+        '''
+        Names of the KPIs of a template, shared by all the values computed
+        for the template
+
+        :param write_date: last update of the template, part of the key only
+        :param lang: language of the descriptions of the KPIs
+        :returns: EcdfKpiTable
+        '''
+        kpis = self.env['mis.report'].with_context(lang=lang).browse(
+            mis_template_id).kpi_ids
+        return EcdfKpiTable(tuple(kpi.description for kpi in kpis),
+                            tuple(kpi.name for kpi in kpis))
+
+    @api.multi
+    def _get_template_table(self, mis_template):
+        self.ensure_one()
+        return self._get_kpi_table(mis_template.id, mis_template.write_date,
+                                   self.env.lang)
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_kpi_dependencies(self, mis_template_id, write_date,
+                              chart_account_id):
+        '''
+        :returns: tuple of (KPI name, ids of the accounts of the KPI, names
+                  of the KPIs used by the KPI), for each KPI of the template,
+                  the used KPIs first
+        '''
+        aep = EcdfAEP(self.env)
+        aep.set_parsed_state(self._get_aep_parsed_state(mis_template_id,
+                                                        write_date,
+                                                        chart_account_id))
+        dependencies = []
+        for name, code, variables, used_names in \
+                self._get_kpi_plan(mis_template_id, write_date):
+            account_ids = set()
+            for variable in variables:
+                account_ids |= aep.get_variable_account_ids(variable)
+            dependencies.append((name, frozenset(account_ids), used_names))
+        return tuple(dependencies)
+
+    @api.model
+    @tools.ormcache(skiparg=1)
+    def _get_kpi_order(self, mis_template_id, write_date, chart_account_id):
+        '''
+        KPIs of a template sorted topologically by its evaluation plan:
+        the totals come after the KPIs they use, so that each KPI is
+        evaluated once from the values of the KPIs it uses.
+        KPIs using accounts already used by the KPIs they sum are logged,
+        their balances being fetched and summed twice.
+
+        :returns: tuple of the KPI names
+        '''
+        order = tuple(name for name, code, variables, used_names
+                      in self._get_kpi_plan(mis_template_id, write_date))
+
+        redundant = self._get_redundant_kpis(mis_template_id, write_date,
+                                             chart_account_id)
+        if redundant:
+            _logger.warning(
+                'MIS template %d: KPIs using accounts already summed by the '
+                'KPIs they use: %s', mis_template_id,
+                ', '.join(sorted(redundant)))
+        return order
+
+    @api.model
+    def _get_redundant_kpis(self, mis_template_id, write_date,
+                            chart_account_id):
+        '''
+        :returns: dict {KPI name: account ids} of the KPIs using accounts
+                  that are also used, directly or not, by the KPIs they use
+        '''
+        dependencies = self._get_kpi_dependencies(mis_template_id,
+                                                  write_date,
+                                                  chart_account_id)
+        by_name = dict((name, (account_ids, used_names))
+                       for name, account_ids, used_names in dependencies)
+        covered = {}
+
+        def get_covered(name, visiting):
+            # accounts used by a KPI and the KPIs it uses
+            if name not in covered:
+                account_ids, used_names = by_name[name]
+                res = set(account_ids)
+                visiting.add(name)
+                for used_name in used_names:
+                    if used_name not in visiting:
+                        res |= get_covered(used_name, visiting)
+                visiting.discard(name)
+                covered[name] = res
+            return covered[name]
+
+        redundant = {}
+        for name, account_ids, used_names in dependencies:
+            if not account_ids or not used_names:
+                continue
+            children_account_ids = set()
+            for used_name in used_names:
+                children_account_ids |= get_covered(used_name, set([name]))
+            overlap = account_ids & children_account_ids
+            if overlap:
+                redundant[name] = overlap
+        return redundant
+
+    @api.multi
+    def _get_template_order(self, mis_template):
+        self.ensure_one()
+        return self._get_kpi_order(mis_template.id,
+                                   mis_template.write_date,
+                                   self.chart_account_id.id)
+
+    @api.multi
+    def _get_template_dependencies(self, mis_template):
+        self.ensure_one()
+        return self._get_kpi_dependencies(mis_template.id,
+                                          mis_template.write_date,
+                                          self.chart_account_id.id)
+
+    @api.multi
+    def _get_dirty_kpis(self, mis_template, changed_account_ids):
+        '''
+        :param changed_account_ids: accounts having new or modified moves
+        :returns: the names of the KPIs using these accounts, directly or
+                  through other KPIs, the used KPIs first
+        '''
+        self.ensure_one()
+        dependencies = self._get_template_dependencies(mis_template)
+        dirty = set(name for name, account_ids, used_names in dependencies
+                    if not account_ids.isdisjoint(changed_account_ids))
+        users = defaultdict(set)
+        for name, account_ids, used_names in dependencies:
+            for used_name in used_names:
+                users[used_name].add(name)
+        stack = list(dirty)
+        while stack:
+            for user in users[stack.pop()]:
+                if user not in dirty:
+                    dirty.add(user)
+                    stack.append(user)
+
+        # The used KPIs are evaluated first
+        return [name for name in self._get_template_order(mis_template)
+                if name in dirty]
+
+    @api.multi
+    def _get_used_kpis(self, mis_template, kpi_names):
+        '''
+        :returns: the names of the KPIs and of the KPIs they use, directly
+                  or through other KPIs, the used KPIs first
+        '''
+        self.ensure_one()
+        used_by_name = dict(
+            (name, used_names) for name, account_ids, used_names
+            in self._get_template_dependencies(mis_template))
+        used = set(kpi_names)
+        stack = list(used)
+        while stack:
+            for used_name in used_by_name.get(stack.pop(), ()):
+                if used_name not in used:
+                    used.add(used_name)
+                    stack.append(used_name)
+        return [name for name in self._get_template_order(mis_template)
+                if name in used]
+
+    @api.multi
+    def _get_kpis_account_ids(self, mis_template, kpi_names):
+        '''
+        :returns: the ids of the accounts used by the KPIs
+        '''
+        self.ensure_one()
+        kpi_names = set(kpi_names)
+        account_ids = set()
+        for name, kpi_account_ids, used_names in \
+                self._get_template_dependencies(mis_template):
+            if name in kpi_names:
+                account_ids |= kpi_account_ids
+        return account_ids
+
+    @api.multi
+    def _evaluate_kpis(self, mis_template, aep, kpi_names, fiscal_year,
+                       fiscal_context, values):
+        '''
+        Evaluates KPIs of a template as MIS Builder would compute them, the
+        other ones keeping their values. The totals are evaluated from the
+        values of the KPIs they use, without retries.
+        The compiled expressions of the evaluation plan are evaluated with
+        the values of their accounting variables, without parsing the
+        accounting expressions, with the builtins of the sandbox of MIS
+        Builder.
+        :param aep: EcdfAEP with the balances of the accounts of the KPIs
+        :param kpi_names: names of the KPIs, the used KPIs first
+        :param values: dict {KPI name: value}, updated in place
+        '''
+        self.ensure_one()
+        localdict = {
+            '__builtins__': _BUILTINS,
+            'registry': self.pool,
+            'sum': _sum,
+            'min': _min,
+            'max': _max,
+            'len': len,
+            'avg': _avg,
+            'AccountingNone': AccountingNone,
+        }
+        localdict.update(values)
+        aep.do_queries(fiscal_year.date_start,
+                       fiscal_year.date_stop,
+                       fiscal_context.period_from,
+                       fiscal_context.period_to,
+                       self.target_move)
+        evaluation = self._get_kpi_evaluation(mis_template.id,
+                                              mis_template.write_date,
+                                              self.chart_account_id.id)
+        variable_values = {}
+        for name in kpi_names:
+            code, variables = evaluation[name]
+            for i, variable in enumerate(variables):
+                if variable not in variable_values:
+                    variable_values[variable] = \
+                        aep.get_variable_value(variable)
+                localdict[VARIABLE_NAME % i] = variable_values[variable]
+            try:
+                val = eval(code, localdict) if code is not None else None
+            except Exception:
+                # as in MIS Builder, errors give no value
+                val = None
+            localdict[name] = val
+            values[name] = val
 
+    @api.multi
+    def _get_preview_kpis(self, mis_template, report_type, codes):
+        '''
+        Resolves eCDF codes to the KPIs declaring them, from their technical
+        names: ecdf_<previous year>_<current year> for the financial
+        reports, ecdf_<debit>_<credit> for the chart of accounts
+        :param codes: set of eCDF codes
+        :returns: dict {fiscal year id: names of the KPIs to evaluate}
+        '''
+        self.ensure_one()
+        current = set()
+        previous = set()
+        descriptions = dict((kpi.name, kpi.description or '')
+                            for kpi in mis_template.kpi_ids)
+        for name, code1, code2 in self._get_kpi_codes(
+                mis_template.id, mis_template.write_date):
+            if report_type == 'CA_PLANCOMPTA':
+                if code1 in codes or code2 in codes or (
+                        descriptions[name][:5] == '106 -' and
+                        codes & set(['0117', '0118', '2259', '2260'])):
+                    current.add(name)
+            elif code2 in codes:
+                current.add(name)
+            elif code1 in codes:
+                if self.prev_fiscyear:
+                    previous.add(name)
+                else:
+                    # 0.0 is declared if the current year has a value
+                    current.add(name)
+        res = {}
+        if current:
+            res[self.current_fiscyear.id] = current
+        if previous and report_type != 'CA_PLANCOMPTA':
+            res[self.prev_fiscyear.id] = previous
         return res
 
     @api.multi
-    def print_xml(self):
+    def preview(self, codes):
         '''
-        Generates the selected financial reports in XML format
-        The string is written in the base64 field "xml_file"
+        Computes the values of some eCDF codes, as they would be declared,
+        without computing the whole reports: only the KPIs declaring the
+        codes and the KPIs they use are evaluated, from the balances of
+        their accounts
+        :param codes: eCDF codes, such as ['639', '640']
+        :returns: dict {eCDF code: declared value, or None if the code is
+                  not declared}
         '''
         self.ensure_one()
-        ecdf_namespace = "http://www.ctie.etat.lu/2011/ecdf"
-        nsmap = {None: ecdf_namespace}  # the default namespace(no prefix)
+        codes = set(codes)
+        res = dict.fromkeys(codes)
+        # the current fiscal year is previewed, in multi-year mode as well
+        preview_years = self.current_fiscyear | self.prev_fiscyear
+        fiscal_contexts = self._get_fiscal_contexts(preview_years)
+        current_context = fiscal_contexts[self.current_fiscyear.id]
+        balances = EcdfBalances(self.env, self.target_move)
+        ledger_state = None
+        for report in self._get_reports():
+            mis_template = self.env.ref(report['templ'])
+            kpi_names = self._get_preview_kpis(mis_template, report['type'],
+                                               codes)
+            if not kpi_names:
+                continue
+            if mis_template.query_ids:
+                # values of queries: the whole template is computed
+                if ledger_state is None:
+                    ledger_state = self._get_ledger_state()
+                data = self.compute_multi(
+                    mis_template,
+                    self._get_report_fiscal_years(report) & preview_years,
+                    report_type=report['type'],
+                    fiscal_contexts=fiscal_contexts,
+                    balances=balances,
+                    ledger_state=ledger_state)
+            else:
+                data = self._compute_preview_data(mis_template, kpi_names,
+                                                  fiscal_contexts,
+                                                  balances=balances)
 
-        root = etree.Element("eCDFDeclarations", nsmap=nsmap)
+            # Values as declared in the file
+            if report['type'] == 'CA_PLANCOMPTA':
+                declaration = self._get_chart_ac(
+                    data[self.current_fiscyear.id], report['type'],
+                    report['model'], fiscal_context=current_context)
+            else:
+                declaration = self._get_finan_report(
+                    data[self.current_fiscyear.id], report['type'],
+                    report['model'], data.get(self.prev_fiscyear.id),
+                    fiscal_context=current_context)
+            if declaration is None:
+                continue
+            for field in declaration.iter('NumericField'):
+                if field.get('id') in codes:
+                    res[field.get('id')] = float(field.text.replace(',', '.'))
+        return res
 
-        # File Reference
-        ref = self.file_reference
-        self.full_file_name = ref + '.xml'  # for the download widget
-        file_reference = etree.Element('FileReference')
-        file_reference.text = ref
-        root.append(file_reference)
-        # File Version
-        file_version = etree.Element('eCDFFileVersion')
-        file_version.text = self.get_ecdf_file_version()
-        root.append(file_version)
-        # Interface
-        interface = etree.Element('Interface')
-        interface.text = self.get_interface()
-        root.append(interface)
-        # Agent
-        agent = etree.Element('Agent')
-        matr_agent = etree.Element('MatrNbr')
-        matr_agent.text = self.get_matr_agent()
-        rcs_agent = etree.Element('RCSNbr')
-        rcs_agent.text = self.get_rcs_agent()
-        vat_agent = etree.Element('VATNbr')
-        vat_agent.text = self.get_vat_agent()
-        agent.append(matr_agent)
-        agent.append(rcs_agent)
-        agent.append(vat_agent)
-        root.append(agent)
-        # Declarations
-        declarations = etree.Element('Declarations')
-        declarer = etree.Element('Declarer')
-        matr_declarer = etree.Element('MatrNbr')
-        matr_declarer.text = self.get_matr_declarer()
-        rcs_declarer = etree.Element('RCSNbr')
-        rcs_declarer.text = self.get_rcs_declarer()
-        vat_declarer = etree.Element('VATNbr')
-        vat_declarer.text = self.get_vat_declarer()
-        declarer.append(matr_declarer)
-        declarer.append(rcs_declarer)
-        declarer.append(vat_declarer)
+    @api.multi
+    def action_preview(self):
+        '''
+        Button: computes the eCDF codes to preview
+        '''
+        self.ensure_one()
+        codes = [code.strip() for code in (self.preview_codes or '').split(',')
+                 if code.strip()]
+        if not codes:
+            raise UserError(_('No eCDF code'),
+                            _('Please, enter the eCDF codes to preview'))
+        values = self.preview(codes)
+        lines = []
+        for code in codes:
+            val = values[code]
+            if val is None:
+                lines.append(_('%s: not declared') % code)
+            else:
+                lines.append('%s: %s' % (
+                    code, ("%.2f" % val).replace('.', ',')))
+        self.preview_result = '\n'.join(lines)
+        return self._get_print_xml_action()
+
+    @api.multi
+    def _compute_preview_data(self, mis_template, kpi_names,
+                              fiscal_contexts, balances=None):
+        '''
+        Evaluates KPIs of a template, with the KPIs they use
+        :param kpi_names: dict {fiscal year id: names of the KPIs}
+        :param balances: optional EcdfBalances shared with other templates
+        :returns: dict {fiscal year id: EcdfKpiData}, the other KPIs
+                  having no value
+        '''
+        self.ensure_one()
+        fiscal_years = self.env['account.fiscalyear'].browse(list(kpi_names))
+        names_by_year = {}
+        account_ids = set()
+        periods = []
+        for fiscal_year in fiscal_years:
+            names = self._get_used_kpis(mis_template,
+                                        kpi_names[fiscal_year.id])
+            names_by_year[fiscal_year.id] = names
+            account_ids |= self._get_kpis_account_ids(mis_template, names)
+            fiscal_context = fiscal_contexts[fiscal_year.id]
+            periods.append((fiscal_year.date_start,
+                            fiscal_year.date_stop,
+                            fiscal_context.period_from,
+                            fiscal_context.period_to))
+        aep = self._get_aep(mis_template, balances=balances)
+        aep.prefetch(periods, self.target_move, account_ids)
+
+        table = self._get_template_table(mis_template)
+        res = {}
+        for fiscal_year in self.current_fiscyear | self.prev_fiscyear:
+            values = {}
+            if fiscal_year.id in names_by_year:
+                self._evaluate_kpis(mis_template, aep,
+                                    names_by_year[fiscal_year.id],
+                                    fiscal_year,
+                                    fiscal_contexts[fiscal_year.id],
+                                    values)
+            res[fiscal_year.id] = EcdfKpiData.from_dict(table, values)
+        return res
 
+    @api.multi
+    def _get_reports(self):
+        '''
+        :returns: list of the selected reports, as dict(type, model, templ)
+        '''
+        self.ensure_one()
         reports = []
-        templ = {
-            'CA_PLANCOMPTA': 'l10n_lu_mis_reports.mis_report_ca',
-            'CA_BILAN': 'l10n_lu_mis_reports.mis_report_bs_2016',
-            'CA_BILANABR': 'l10n_lu_mis_reports.mis_report_abr_bs',
-            'CA_COMPP': 'l10n_lu_mis_reports.mis_report_pl_2016',
-            'CA_COMPPABR': 'l10n_lu_mis_reports.mis_report_abr_pl',
-        }
+        templ = ECDF_TEMPLATES
 
         # Report
         if self.with_ac:  # Chart of Accounts
@@ -676,6 +1400,303 @@ class EcdfReport(models.TransientModel):
         if not reports:
             raise UserError(_('No report type selected'),
                             _('Please, select a report type'))
+        return reports
+
+    @api.multi
+    def _get_ecdf_header(self, file_reference):
+        '''
+        Generates the header of the eCDF file, with the agent of the wizard
+        :param file_reference: reference of the file
+        :returns: list of XML nodes, from "FileReference" to "Agent"
+        '''
+        self.ensure_one()
+        # File Reference
+        file_ref = etree.Element('FileReference')
+        file_ref.text = file_reference
+        # File Version
+        file_version = etree.Element('eCDFFileVersion')
+        file_version.text = self.get_ecdf_file_version()
+        # Interface
+        interface = etree.Element('Interface')
+        interface.text = self.get_interface()
+        # Agent
+        agent = etree.Element('Agent')
+        matr_agent = etree.Element('MatrNbr')
+        matr_agent.text = self.get_matr_agent()
+        rcs_agent = etree.Element('RCSNbr')
+        rcs_agent.text = self.get_rcs_agent()
+        vat_agent = etree.Element('VATNbr')
+        vat_agent.text = self.get_vat_agent()
+        agent.append(matr_agent)
+        agent.append(rcs_agent)
+        agent.append(vat_agent)
+
+        return [file_ref, file_version, interface, agent]
+
+    @api.multi
+    def _write_ecdf_file(self, fileobj, file_reference, declarers):
+        '''
+        Writes the eCDF file incrementally: each declarer is serialised as
+        soon as it is available, so the whole document is never in memory
+        :param fileobj: file object to write to
+        :param file_reference: reference of the file
+        :param declarers: iterable of XML nodes "Declarer"
+        '''
+        self.ensure_one()
+        nsmap = {None: ECDF_NAMESPACE}  # the default namespace(no prefix)
+        with etree.xmlfile(fileobj, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element('eCDFDeclarations', nsmap=nsmap):
+                for element in self._get_ecdf_header(file_reference):
+                    xf.write(element)
+                with xf.element('Declarations'):
+                    for declarer in declarers:
+                        xf.write(declarer)
+
+    @api.multi
+    def _get_report_fiscal_years(self, report):
+        '''
+        :param report: dict(type, model, templ) of a selected report
+        :returns: the fiscal years of the report, the previous year being
+                  computed in the same pass except for the chart of accounts
+        '''
+        self.ensure_one()
+        if self.first_fiscyear:
+            fiscal_years = self._get_declared_fiscal_years()
+            if report['type'] != 'CA_PLANCOMPTA':
+                for previous in self._get_previous_fiscal_years(
+                        fiscal_years).values():
+                    fiscal_years |= previous
+            return fiscal_years
+        fiscal_years = self.current_fiscyear
+        if report['type'] != 'CA_PLANCOMPTA':
+            fiscal_years |= self.prev_fiscyear
+        return fiscal_years
+
+    @api.multi
+    def _get_declared_fiscal_years(self):
+        '''
+        :returns: the declared fiscal years, sorted by date: the current
+                  fiscal year, or in multi-year mode all the fiscal years
+                  of the company from the first one to the current one
+        '''
+        self.ensure_one()
+        if not self.first_fiscyear:
+            return self.current_fiscyear
+        return self.env['account.fiscalyear'].search(
+            [('company_id', '=', self.current_fiscyear.company_id.id),
+             ('date_start', '>=', self.first_fiscyear.date_start),
+             ('date_stop', '<=', self.current_fiscyear.date_stop)],
+            order='date_start')
+
+    @api.multi
+    def _get_previous_fiscal_years(self, fiscal_years):
+        '''
+        :returns: dict {fiscal year id: previous fiscal year, or an empty
+                  recordset}
+        '''
+        self.ensure_one()
+        return dict((fiscal_year.id, fiscal_year.get_previous_fiscalyear())
+                    for fiscal_year in fiscal_years)
+
+    @api.multi
+    def _compute_multi_year_declarations(self, reports, profiler=NO_PROFILER,
+                                         progress=None, ledger_state=None):
+        '''
+        Computes the selected reports for all the declared fiscal years:
+        each template is computed for all the fiscal years and the years
+        before them in one pass, from balances fetched once for all of
+        them, so a fiscal year which is also the previous year of the next
+        one is computed once
+        :param reports: the selected reports
+        :param profiler: EcdfProfiler recording the stages of each report
+        :param progress: optional callable, called with the report type
+                         and the fiscal years each time a report is computed
+        :param ledger_state: state of the ledger, read if not given
+        :returns: list of (fiscal year, XML nodes "Declaration" of the
+                  fiscal year), sorted by date
+        '''
+        self.ensure_one()
+        fiscal_years = self._get_declared_fiscal_years()
+        previous_years = self._get_previous_fiscal_years(fiscal_years)
+        all_years = fiscal_years
+        for previous in previous_years.values():
+            all_years |= previous
+        fiscal_contexts = self._get_fiscal_contexts(all_years)
+        # Balances of the company, fetched once for all the reports
+        balances = EcdfBalances(self.env, self.target_move)
+        if ledger_state is None:
+            ledger_state = self._get_ledger_state()
+        declarations = dict((fiscal_year.id, []) for fiscal_year
+                            in fiscal_years)
+        for report in reports:
+            mis_template = self.env.ref(report['templ'])
+            report_years = self._get_report_fiscal_years(report)
+            data = self.compute_multi(mis_template, report_years,
+                                      profiler=profiler,
+                                      report_type=report['type'],
+                                      fiscal_contexts=fiscal_contexts,
+                                      balances=balances,
+                                      ledger_state=ledger_state)
+            with profiler.stage('xml', report['type']):
+                for fiscal_year in fiscal_years:
+                    fiscal_context = fiscal_contexts[fiscal_year.id]
+                    if report['type'] == 'CA_PLANCOMPTA':
+                        declaration = self._get_chart_ac(
+                            data[fiscal_year.id], report['type'],
+                            report['model'], fiscal_context=fiscal_context)
+                    else:
+                        declaration = self._get_finan_report(
+                            data[fiscal_year.id], report['type'],
+                            report['model'],
+                            data.get(previous_years[fiscal_year.id].id),
+                            fiscal_context=fiscal_context)
+                    if declaration is not None:
+                        declarations[fiscal_year.id].append(declaration)
+            if progress:
+                progress(report['type'], report_years)
+        return [(fiscal_year, declarations[fiscal_year.id])
+                for fiscal_year in fiscal_years]
+
+    @api.multi
+    def _compute_declaration(self, report, fiscal_contexts,
+                             profiler=NO_PROFILER, stored_results=None,
+                             balances=None, ledger_state=None):
+        '''
+        Computes one of the selected reports
+        :param report: dict(type, model, templ) of the report
+        :param fiscal_contexts: dict {fiscal year id: EcdfFiscalContext}
+                                of the current and previous fiscal years
+        :param profiler: EcdfProfiler recording the stages of the report
+        :param stored_results: see compute_multi
+        :param balances: optional EcdfBalances shared with the other
+                         reports of the company
+        :param ledger_state: see compute_multi
+        :returns: XML node "Declaration" of the report, or None if there is
+                  nothing to declare
+        '''
+        self.ensure_one()
+        mis_report = self.env.ref(report['templ'])
+        fiscal_years = self._get_report_fiscal_years(report)
+        data = self.compute_multi(mis_report, fiscal_years,
+                                  profiler=profiler,
+                                  report_type=report['type'],
+                                  fiscal_contexts=fiscal_contexts,
+                                  stored_results=stored_results,
+                                  balances=balances,
+                                  ledger_state=ledger_state)
+        data_current = data[self.current_fiscyear.id]
+        current_context = fiscal_contexts[self.current_fiscyear.id]
+
+        with profiler.stage('xml', report['type']):
+            if report['type'] == 'CA_PLANCOMPTA':  # Chart of accounts
+                return self._get_chart_ac(data_current, report['type'],
+                                          report['model'],
+                                          fiscal_context=current_context)
+            data_previous = None
+            if self.prev_fiscyear:  # Previous year
+                data_previous = data[self.prev_fiscyear.id]
+            return self._get_finan_report(data_current, report['type'],
+                                          report['model'], data_previous,
+                                          fiscal_context=current_context)
+
+    @api.multi
+    def _compute_declarations_parallel(self, reports, workers,
+                                       progress=None, profiler=NO_PROFILER,
+                                       ledger_state=None):
+        '''
+        Computes the selected reports in worker threads, each one with its
+        own cursor importing the snapshot of the current transaction, so
+        that all the reports are computed from the same state of the ledger
+        The values computed by the workers are stored by the caller, the
+        workers rolling back their transaction.
+        :param reports: the selected reports
+        :param workers: number of worker threads
+        :param ledger_state: state of the ledger, read if not given
+        :returns: list of the XML nodes "Declaration" (or None) of the
+                  reports, in the same order
+        '''
+        self.ensure_one()
+        report_values = self._get_report_values()
+        profiling = profiler.cr is not None
+        if ledger_state is None:
+            ledger_state = self._get_ledger_state()
+        tasks = [partial(_compute_declaration_task, report_values, report,
+                         profiling, ledger_state)
+                 for report in reports]
+        results = run_in_workers(self.env, tasks, workers,
+                                 snapshot=export_snapshot(self.env))
+
+        result_model = self.env['ecdf.kpi.result']
+        declarations = []
+        for report, result in zip(reports, results):
+            declaration, stored_results, worker_profiler = result
+            for store_args in stored_results:
+                result_model.store(*self._browse_store_args(store_args))
+            if worker_profiler is not None:
+                profiler.merge(worker_profiler)
+            if declaration is not None:
+                declaration = etree.fromstring(declaration)
+            declarations.append(declaration)
+            if progress:
+                progress(report['type'],
+                         self._get_report_fiscal_years(report))
+        return declarations
+
+    @api.model
+    def _browse_store_args(self, store_args):
+        '''
+        :param store_args: arguments of ecdf.kpi.result.store collected by
+                           compute_multi, the records given by their ids
+        :returns: the arguments, with the records of this environment
+        '''
+        (chart_account_id, fiscal_year_id, mis_template_id, target_move,
+         signature, ledger_state, values) = store_args
+        return (self.env['account.account'].browse(chart_account_id),
+                self.env['account.fiscalyear'].browse(fiscal_year_id),
+                self.env['mis.report'].browse(mis_template_id),
+                target_move, signature, ledger_state, values)
+
+    @api.multi
+    def _get_declarer_element(self):
+        '''
+        :returns: XML node "Declarer" with the identifiers of the company
+                  of the chart of accounts, without declarations
+        '''
+        self.ensure_one()
+        declarer = etree.Element('Declarer')
+        matr_declarer = etree.Element('MatrNbr')
+        matr_declarer.text = self.get_matr_declarer()
+        rcs_declarer = etree.Element('RCSNbr')
+        rcs_declarer.text = self.get_rcs_declarer()
+        vat_declarer = etree.Element('VATNbr')
+        vat_declarer.text = self.get_vat_declarer()
+        declarer.append(matr_declarer)
+        declarer.append(rcs_declarer)
+        declarer.append(vat_declarer)
+        return declarer
+
+    @api.multi
+    def _get_declarer(self, progress=None, profiler=NO_PROFILER,
+                      workers=None, ledger_state=None):
+        '''
+        Computes the selected reports for the company of the chart of
+        accounts, for all the declared fiscal years in multi-year mode
+        :param progress: optional callable, called with the report type
+                         and the fiscal years each time a report is computed
+        :param profiler: EcdfProfiler recording the stages of each report
+        :param workers: number of reports computed at the same time, the
+                        field "report_workers" if not given (not in
+                        multi-year mode)
+        :param ledger_state: state of the ledger, shared by all the
+                             reports, read if not given
+        :returns: XML node called "Declarer"
+        '''
+        self.ensure_one()
+        declarer = self._get_declarer_element()
+        reports = self._get_reports()
+        if workers is None:
+            workers = self.report_workers
 
         error_not_found = ""
         for report in reports:
@@ -688,61 +1709,307 @@ class EcdfReport(models.TransientModel):
             if not mis_report or not len(mis_report):
                 error_not_found += '\n\t - ' + report['templ']
 
-            data_current = self.compute(mis_report,
-                                        self.current_fiscyear)
-            data_previous = None
-
-            if report['type'] != 'CA_PLANCOMPTA':
-                if self.prev_fiscyear:  # Previous year
-                    data_previous = self.compute(mis_report,
-                                                 self.prev_fiscyear)
-                financial_report = self._get_finan_report(data_current,
-                                                          report['type'],
-                                                          report['model'],
-                                                          data_previous)
-                if financial_report is not None:
-                    declarer.append(financial_report)
-            else:  # Chart of accounts
-                chart_of_account = self._get_chart_ac(data_current,
-                                                      report['type'],
-                                                      report['model'])
-                if chart_of_account is not None:
-                    declarer.append(chart_of_account)
-
         # Warning message if template(s) not found
         if error_not_found:
             raise UserError(
                 _('MIS Template(s) not found :'),
                 error_not_found)
 
-        # Declarer
-        declarations.append(declarer)
-        root.append(declarations)
-
-        # Write the xml
-        xml = etree.tostring(root, encoding='UTF-8', xml_declaration=True)
-        # Validate the generated XML schema
-        xsd = tools.file_open('l10n_lu_ecdf/xsd/ecdf-v1.1.xsd')
-        xmlschema_doc = etree.parse(xsd)
-        xmlschema = etree.XMLSchema(xmlschema_doc)
-        # Reparse only to have line numbers in error messages?
-        xml_to_validate = StringIO(xml)
-        parse_result = etree.parse(xml_to_validate)
-        # Validation
-        if xmlschema.validate(parse_result):
-            self.xml_file = base64.encodestring(xml)
-            return {
-                'name': 'eCDF Report',
-                'type': 'ir.actions.act_window',
-                'res_model': 'ecdf.report',
-                'view_mode': 'form',
-                'view_type': 'form',
-                'res_id': self.id,
-                'views': [(False, 'form')],
-                'target': 'new',
-            }
+        if ledger_state is None:
+            ledger_state = self._get_ledger_state()
+        if self.first_fiscyear:
+            declarations = []
+            for fiscal_year, year_declarations in \
+                    self._compute_multi_year_declarations(
+                        reports, profiler=profiler, progress=progress,
+                        ledger_state=ledger_state):
+                declarations.extend(year_declarations)
+        elif workers > 1 and len(reports) > 1:
+            declarations = self._compute_declarations_parallel(
+                reports, workers, progress=progress, profiler=profiler,
+                ledger_state=ledger_state)
         else:
-            error = xmlschema.error_log[0]
+            # Periods of the fiscal years, shared by all the reports
+            fiscal_contexts = self._get_fiscal_contexts(
+                self.current_fiscyear | self.prev_fiscyear)
+            # Balances of the company, fetched once for all the reports
+            balances = EcdfBalances(self.env, self.target_move)
+            declarations = []
+            for report in reports:
+                declarations.append(self._compute_declaration(
+                    report, fiscal_contexts, profiler=profiler,
+                    balances=balances, ledger_state=ledger_state))
+                if progress:
+                    progress(report['type'],
+                             self._get_report_fiscal_years(report))
+
+        for declaration in declarations:
+            if declaration is not None:
+                declarer.append(declaration)
+
+        return declarer
+
+    @api.model
+    def _validate_xml_file(self, fileobj):
+        '''
+        Validates a generated XML file against the eCDF schema, in a
+        streaming pass
+        :param fileobj: file object of the XML file
+        '''
+        fileobj.seek(0)
+        errors = _ecdf_schema_stream_errors(fileobj)
+        if errors:
+            # Reparse only to have line numbers in error messages
+            fileobj.seek(0)
+            line_errors = _ecdf_schema_errors(etree.parse(fileobj))
+            if line_errors:
+                message = _('Line %d: %s') % (line_errors[0].line,
+                                              line_errors[0].message)
+            else:
+                message = '%s' % errors[0]
             raise UserError(
                 _('The generated file doesn\'t fit the required schema !'),
-                error.message)
+                message)
+        fileobj.seek(0)
+
+    @api.multi
+    def _generate_xml_file(self, file_reference, declarers,
+                           profiler=NO_PROFILER):
+        '''
+        Writes the eCDF file in a temporary file and validates it
+        :param file_reference: reference of the file
+        :param declarers: iterable of XML nodes "Declarer"
+        :param profiler: EcdfProfiler recording the stages "write" and
+                         "validation"
+        :returns: the content of the file, encoded in base64
+        '''
+        self.ensure_one()
+        xml_file = tempfile.TemporaryFile()
+        try:
+            with profiler.stage('write'):
+                self._write_ecdf_file(xml_file, file_reference, declarers)
+            with profiler.stage('validation'):
+                self._validate_xml_file(xml_file)
+            return _base64_file(xml_file)
+        finally:
+            xml_file.close()
+
+    @api.multi
+    def _get_job_values(self):
+        '''
+        :returns: values of a background job generating the reports of
+                  the wizard
+        '''
+        self.ensure_one()
+        steps = []
+        for report in self._get_reports():
+            for fiscal_year in self._get_report_fiscal_years(report):
+                steps.append((0, 0, {'report_type': report['type'],
+                                     'fiscalyear_id': fiscal_year.id}))
+        return dict(self._get_report_values(),
+                    company_id=self.chart_account_id.company_id.id,
+                    step_ids=steps)
+
+    @api.multi
+    def _get_report_values(self):
+        '''
+        :returns: values of an eCDF report wizard (not saved) generating
+                  the reports of this wizard
+        '''
+        self.ensure_one()
+        return {
+            'chart_account_id': self.chart_account_id.id,
+            'current_fiscyear': self.current_fiscyear.id,
+            'prev_fiscyear': self.prev_fiscyear.id,
+            'language': self.language,
+            'target_move': self.target_move,
+            'with_pl': self.with_pl,
+            'with_bs': self.with_bs,
+            'with_ac': self.with_ac,
+            'reports_type': self.reports_type,
+            'remarks': self.remarks,
+            'matricule': self.matricule,
+            'vat': self.vat,
+            'company_registry': self.company_registry,
+        }
+
+    @api.multi
+    def print_xml_background(self):
+        '''
+        Enqueues the generation of the selected financial reports, which
+        is done by a scheduled action
+        :returns: action opening the background job
+        '''
+        self.ensure_one()
+        if self.first_fiscyear:
+            raise UserError(
+                _('Multi-year generation'),
+                _('The fiscal years of a multi-year generation are '
+                  'generated at once, not in background.'))
+        job = self.env['ecdf.report.job'].create(self._get_job_values())
+        return {
+            'name': 'eCDF Report Job',
+            'type': 'ir.actions.act_window',
+            'res_model': 'ecdf.report.job',
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_id': job.id,
+            'views': [(False, 'form')],
+            'target': 'current',
+        }
+
+    @api.multi
+    def _get_request_hash(self, ledger_state=None):
+        '''
+        :param ledger_state: state of the ledger, read if not given
+        :returns: a digest of what the generated file depends on: the
+                  versions of the templates, the state of the ledger and
+                  the parameters of the wizard
+        '''
+        self.ensure_one()
+        result_model = self.env['ecdf.kpi.result']
+        chart = self.chart_account_id
+        templates = []
+        reports = self._get_reports()
+        fiscal_years = self.env['account.fiscalyear'].browse()
+        for report in reports:
+            fiscal_years |= self._get_report_fiscal_years(report)
+        fiscal_contexts = self._get_fiscal_contexts(fiscal_years)
+        for report in reports:
+            mis_template = self.env.ref(report['templ'])
+            kpi_dates = mis_template.kpi_ids.mapped('write_date')
+            for fiscal_year in self._get_report_fiscal_years(report):
+                templates.append([
+                    report['type'],
+                    fiscal_year.id,
+                    mis_template.write_date,
+                    kpi_dates and max(kpi_dates),
+                    result_model.get_signature(
+                        chart, mis_template, fiscal_contexts[fiscal_year.id]),
+                ])
+        if ledger_state is None:
+            ledger_state = self._get_ledger_state()
+        module = self.env['ir.module.module'].search(
+            [('name', '=', 'l10n_lu_ecdf')], limit=1)
+        digest = hashlib.sha1(json.dumps([
+            templates,
+            [ledger_state['change_id'], ledger_state['change_count']],
+            sorted(self._get_report_values().items()),
+            [self.first_fiscyear.id, self.multi_year_output],
+            [self.get_matr_agent(), self.get_rcs_agent(),
+             self.get_vat_agent(), self.get_matr_declarer(),
+             self.get_rcs_declarer(), self.get_vat_declarer()],
+            module.latest_version,
+        ]))
+        return digest.hexdigest()
+
+    @api.multi
+    def print_xml(self):
+        '''
+        Generates the selected financial reports in XML format
+        The string is written in the base64 field "xml_file"
+        The file archived for the same request is returned if any, unless
+        the timings are recorded.
+        '''
+        self.ensure_one()
+        archive_model = self.env['ecdf.report.archive']
+        company = self.chart_account_id.company_id
+        ledger_state = self._get_ledger_state()
+        request_hash = self._get_request_hash(ledger_state=ledger_state)
+        if self.first_fiscyear and self.multi_year_output == 'per_year':
+            return self._print_xml_per_year(request_hash,
+                                            ledger_state=ledger_state)
+        archive = archive_model.find(company, request_hash)
+        if archive and not self.profiling:
+            self.full_file_name = archive.file_reference + '.xml'
+            self.xml_file = archive.get_datas()
+            return self._get_print_xml_action()
+
+        # File Reference
+        ref = self._allocate_file_reference()
+        self.full_file_name = ref + '.xml'  # for the download widget
+
+        profiler = NO_PROFILER
+        if self.profiling:
+            profiler = EcdfProfiler(self.env.cr)
+
+        # Declarer
+        declarer = self._get_declarer(profiler=profiler,
+                                      ledger_state=ledger_state)
+        self.xml_file = self._generate_xml_file(ref, [declarer],
+                                                profiler=profiler)
+        if self.profiling:
+            profiler.log(ref)
+            self.profile_log = profiler.format()
+        archive_model.archive(company, self.current_fiscyear, request_hash,
+                              ref, self.xml_file)
+        return self._get_print_xml_action()
+
+    @api.multi
+    def _print_xml_per_year(self, request_hash, ledger_state=None):
+        '''
+        Generates the selected financial reports of all the declared
+        fiscal years, in one file per fiscal year, archived on its fiscal
+        year. The files are written in a zip archive in the field
+        "xml_file", named after the reference of the last file.
+        :param request_hash: digest of the request of the wizard
+        :param ledger_state: state of the ledger, read if not given
+        '''
+        self.ensure_one()
+        archive_model = self.env['ecdf.report.archive']
+        company = self.chart_account_id.company_id
+        profiler = NO_PROFILER
+        if self.profiling:
+            profiler = EcdfProfiler(self.env.cr)
+
+        ref = None
+        zip_file = tempfile.TemporaryFile()
+        try:
+            with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for fiscal_year, declarations in \
+                        self._compute_multi_year_declarations(
+                            self._get_reports(), profiler=profiler,
+                            ledger_state=ledger_state):
+                    if not declarations:
+                        continue
+                    declarer = self._get_declarer_element()
+                    for declaration in declarations:
+                        declarer.append(declaration)
+                    ref = self._allocate_file_reference()
+                    datas = self._generate_xml_file(ref, [declarer],
+                                                    profiler=profiler)
+                    year_hash = hashlib.sha1(
+                        '%s-%d' % (request_hash, fiscal_year.id)).hexdigest()
+                    archive_model.archive(company, fiscal_year, year_hash,
+                                          ref, datas)
+                    zf.writestr(ref + '.xml', base64.b64decode(datas))
+            if ref is None:
+                raise UserError(
+                    _('Nothing to declare'),
+                    _('The declared fiscal years have no period.'))
+            self.full_file_name = ref + '.zip'
+            zip_file.seek(0)
+            self.xml_file = _base64_file(zip_file)
+        finally:
+            zip_file.close()
+        if self.profiling:
+            profiler.log(ref)
+            self.profile_log = profiler.format()
+        return self._get_print_xml_action()
+
+    @api.multi
+    def _get_print_xml_action(self):
+        '''
+        :returns: action showing the generated file
+        '''
+        self.ensure_one()
+        return {
+            'name': 'eCDF Report',
+            'type': 'ir.actions.act_window',
+            'res_model': 'ecdf.report',
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_id': self.id,
+            'views': [(False, 'form')],
+            'target': 'new',
+        }
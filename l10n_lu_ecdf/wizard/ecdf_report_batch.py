@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+'''
+This module provides a wizard able to generate the XML annual financial
+reports of several companies in one eCDF file, with one declarer per company
+'''
+
+from collections import OrderedDict
+from functools import partial
+
+from lxml import etree
+from openerp import models, fields, api
+from openerp.exceptions import ValidationError
+from openerp.exceptions import Warning as UserError
+from openerp.tools.translate import _
+
+from ..models.ecdf_parallel import run_in_workers
+
+
+def _compute_declarer(report_values, env):
+    '''
+    Task run by the workers: computes the declarer of one company
+    :param report_values: values of an eCDF report wizard
+    :returns: XML node "Declarer", as a string
+    '''
+    report = env['ecdf.report'].new(report_values)
+    return etree.tostring(report._get_declarer())
+
+
+class EcdfReportBatch(models.TransientModel):
+    '''
+    This wizard generates the eCDF annual reports of several companies in
+    one XML file, for an agent filing on behalf of its customers.
+    The declarers are computed in parallel when several workers are set.
+    '''
+    _name = 'ecdf.report.batch'
+    _description = 'eCDF Batch Report Wizard'
+
+    # Main info
+    language = fields.Selection(
+        (('FR', 'FR'), ('DE', 'DE'), ('EN', 'EN')),
+        'Language',
+        required=True
+    )
+    target_move = fields.Selection(
+        [('posted', 'All Posted Entries'), ('all', 'All Entries')],
+        string='Target Moves',
+        required=True,
+        default='posted'
+    )
+    # Reports types
+    with_pl = fields.Boolean('Profit & Loss',
+                             default=True)
+    with_bs = fields.Boolean('Balance Sheet',
+                             default=True)
+    with_ac = fields.Boolean('Chart of Accounts', default=True)
+    reports_type = fields.Selection((('full', 'Full'),
+                                     ('abbreviated', 'Abbreviated')),
+                                    'Reports Type',
+                                    default='full',
+                                    required=True)
+    # Comments
+    remarks = fields.Text('Comments')
+    # Agent
+    matricule = fields.Char('Matricule',
+                            size=13)
+    vat = fields.Char("Tax ID",
+                      size=10)
+    company_registry = fields.Char('Company Registry',
+                                   size=7)
+    # Declarers
+    line_ids = fields.One2many('ecdf.report.batch.line',
+                               'batch_id',
+                               'Companies')
+    workers = fields.Integer('Parallel Workers',
+                             default=1,
+                             help="Number of companies computed at the same "
+                                  "time, each one with its own database "
+                                  "connection.")
+    # File
+    full_file_name = fields.Char('Full file name',
+                                 size=28)
+    xml_file = fields.Binary('XML File', readonly=True)
+
+    @api.multi
+    def _get_agent_report(self):
+        '''
+        :returns: an eCDF report wizard (not saved) for the agent, that is
+                  the company of the user
+        '''
+        self.ensure_one()
+        company = self.env.user.company_id
+        report = self.env['ecdf.report'].new({
+            'chart_account_id': self._get_chart_account(company).id,
+            'language': self.language,
+            'matricule': self.matricule,
+            'vat': self.vat,
+            'company_registry': self.company_registry,
+        })
+        report.check_matr()
+        report.check_rcs()
+        report.check_vat()
+        return report
+
+    @api.model
+    def _get_chart_account(self, company):
+        '''
+        :returns: the chart of accounts (root account) of the company
+        '''
+        chart_account = self.env['account.account'].search(
+            [('parent_id', '=', False),
+             ('company_id', '=', company.id)],
+            limit=1)
+        if not chart_account:
+            raise UserError(
+                _('No chart of accounts found'),
+                _('The company %s has no chart of accounts') % company.name)
+        return chart_account
+
+    @api.multi
+    def _get_report_values(self, line):
+        '''
+        :param line: company and fiscal years to declare
+        :returns: values of the eCDF report wizard of the line
+        '''
+        self.ensure_one()
+        return {
+            'chart_account_id': self._get_chart_account(line.company_id).id,
+            'current_fiscyear': line.current_fiscyear.id,
+            'prev_fiscyear': line.prev_fiscyear.id,
+            'language': self.language,
+            'target_move': self.target_move,
+            'with_pl': self.with_pl,
+            'with_bs': self.with_bs,
+            'with_ac': self.with_ac,
+            'reports_type': self.reports_type,
+            'remarks': self.remarks,
+        }
+
+    @api.multi
+    def print_xml(self):
+        '''
+        Generates the selected financial reports of all the companies in
+        one XML file
+        The string is written in the base64 field "xml_file"
+        '''
+        self.ensure_one()
+        if not self.line_ids:
+            raise UserError(_('No company selected'),
+                            _('Please, add the companies to declare'))
+        # All the identifiers checked before any computation
+        self.line_ids.mapped('company_id').ecdf_assert_identifiers()
+        agent_report = self._get_agent_report()
+        ref = agent_report._allocate_file_reference()
+
+        tasks = [partial(_compute_declarer, self._get_report_values(line))
+                 for line in self.line_ids]
+        results = run_in_workers(self.env, tasks, self.workers)
+
+        # One declarer per company, even if it has several fiscal years
+        results_by_company = OrderedDict()
+        for line, result in zip(self.line_ids, results):
+            results_by_company.setdefault(line.company_id.id, []).append(
+                result)
+
+        def declarers():
+            for company_results in results_by_company.values():
+                declarer = etree.fromstring(company_results[0])
+                for result in company_results[1:]:
+                    for declaration in etree.fromstring(
+                            result).iterchildren('Declaration'):
+                        declarer.append(declaration)
+                yield declarer
+
+        self.full_file_name = ref + '.xml'  # for the download widget
+        self.xml_file = agent_report._generate_xml_file(ref, declarers())
+        return {
+            'name': 'eCDF Batch Report',
+            'type': 'ir.actions.act_window',
+            'res_model': 'ecdf.report.batch',
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_id': self.id,
+            'views': [(False, 'form')],
+            'target': 'new',
+        }
+
+
+class EcdfReportBatchLine(models.TransientModel):
+    '''
+    A company to declare, with its fiscal years
+    '''
+    _name = 'ecdf.report.batch.line'
+    _description = 'eCDF Batch Report Company'
+
+    batch_id = fields.Many2one('ecdf.report.batch',
+                               'Batch',
+                               required=True,
+                               ondelete='cascade')
+    company_id = fields.Many2one('res.company',
+                                 'Company',
+                                 required=True)
+    current_fiscyear = fields.Many2one('account.fiscalyear',
+                                       'Current Fiscal Year',
+                                       required=True)
+    prev_fiscyear = fields.Many2one('account.fiscalyear',
+                                    'Previous Fiscal Year')
+
+    @api.multi
+    @api.onchange('company_id')
+    def _onchange_company(self):
+        '''
+        On Change : 'company_id'
+        Fields 'current_fiscyear' and 'prev_fiscyear' are reset
+        '''
+        for record in self:
+            record.current_fiscyear = False
+            record.prev_fiscyear = False
+
+    @api.multi
+    @api.onchange('current_fiscyear')
+    def _onchange_current_fiscal_year(self):
+        '''
+        On Change : 'current_fiscyear'
+        The field 'prev_fiscyear' is set with the year before current_fiscyear
+        '''
+        for rec in self:
+            rec.prev_fiscyear = False
+            if rec.current_fiscyear:
+                rec.prev_fiscyear = \
+                    rec.current_fiscyear.get_previous_fiscalyear()
+
+    @api.multi
+    @api.constrains('prev_fiscyear')
+    def _check_prev_fiscyear(self):
+        '''
+        Constraint : prev_fiscyear < current_fiscyear
+        '''
+        for record in self:
+            if record.prev_fiscyear.date_stop > \
+                    record.current_fiscyear.date_start:
+                raise ValidationError(
+                    _('Previous fiscal year must be before the current one'))
@@ -35,6 +35,9 @@
     * abbreviated balance sheet
     * profit and loss
     * abbreviated profit and loss
+
+    The balances of the detailed accounts are computed at once for the
+    whole report, instead of node by node and account by account.
 """,
     "data": [
         "account_financial_report.xml",
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Authors: Laetitia Gangloff
+#    Copyright (c) 2014 Acsone SA/NV (http://www.acsone.eu)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+'''
+Detailed Luxembourg financial reports
+
+The detailed nodes of the Luxembourg balance sheets and profits and losses
+list their accounts, and the core report reads the balances of the
+accounts node by node, and account by account for the comparison column.
+Before the lines are filled, the balances of all the accounts of the
+report are computed at once in each context of the report, with one
+grouped query on the move lines: the core report then reads them from the
+cache.
+'''
+
+from openerp.osv import osv
+from openerp.addons.account.report.account_financial_report import \
+    report_account_common
+
+# Root nodes of the Luxembourg financial reports
+LU_REPORTS = (
+    'l10n_lu.account_financial_report_13',
+    'l10n_lu.account_financial_report_14',
+    'l10n_lu.account_financial_report_abr_13',
+    'l10n_lu.account_financial_report_abr_14',
+)
+
+# Fields of the accounts read by the report
+BALANCE_FIELDS = ['balance', 'debit', 'credit']
+
+
+class report_account_common_lu(report_account_common):
+
+    def _is_lu_report(self, report_id):
+        model_data = self.pool['ir.model.data']
+        return any(model_data.xmlid_to_res_id(
+            self.cr, self.uid, xml_id, raise_if_not_found=False) == report_id
+            for xml_id in LU_REPORTS)
+
+    def _get_report_account_ids(self, report_id, context):
+        '''
+        :returns: the ids of the accounts of all the nodes of the report,
+                  with their children and consolidated accounts
+        '''
+        report_obj = self.pool['account.financial.report']
+        account_obj = self.pool['account.account']
+        report_ids = report_obj._get_children_by_order(
+            self.cr, self.uid, [report_id], context=context)
+        parent_ids = set()
+        type_ids = set()
+        for report in report_obj.browse(self.cr, self.uid, report_ids,
+                                        context=context):
+            if report.type == 'accounts':
+                parent_ids.update(report.account_ids.ids)
+            elif report.type == 'account_type':
+                type_ids.update(report.account_type_ids.ids)
+        account_ids = set()
+        if parent_ids:
+            account_ids.update(account_obj._get_children_and_consolidated(
+                self.cr, self.uid, list(parent_ids), context=context))
+        if type_ids:
+            account_ids.update(account_obj.search(
+                self.cr, self.uid, [('user_type', 'in', list(type_ids))],
+                context=context))
+        return list(account_ids)
+
+    def _prefetch_balances(self, data):
+        '''
+        Computes the balances of the accounts of the report in the cache of
+        the contexts of the report, the current one and the comparison one
+        '''
+        form = data['form']
+        contexts = [form['used_context']]
+        if form['enable_filter']:
+            contexts.append(form['comparison_context'])
+        account_ids = self._get_report_account_ids(
+            form['account_report_id'][0], form['used_context'])
+        if not account_ids:
+            return
+        account_obj = self.pool['account.account']
+        for context in contexts:
+            account_obj.browse(self.cr, self.uid, account_ids,
+                               context=context).read(BALANCE_FIELDS)
+
+    def get_lines(self, data):
+        if self._is_lu_report(data['form']['account_report_id'][0]):
+            self._prefetch_balances(data)
+        return super(report_account_common_lu, self).get_lines(data)
+
+
+class report_financial(osv.AbstractModel):
+    _inherit = 'report.account.report_financial'
+    _wrapped_report_class = report_account_common_lu
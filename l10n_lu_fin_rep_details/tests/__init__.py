@@ -0,0 +1 @@
+from . import test_account_financial_report
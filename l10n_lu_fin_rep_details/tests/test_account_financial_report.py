@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from openerp.addons.account.report.account_financial_report import \
+    report_account_common
+from openerp.tests import common
+
+from ..report.account_financial_report import report_account_common_lu
+
+
+class TestAccountFinancialReport(common.TransactionCase):
+
+    def setUp(self):
+        super(TestAccountFinancialReport, self).setUp()
+        self.company = self.env.ref('base.main_company')
+        self.chart = self.env['account.account'].search(
+            [('parent_id', '=', False),
+             ('company_id', '=', self.company.id)], limit=1)
+        self.root = self.env.ref('l10n_lu.account_financial_report_13')
+        self.fiscal_years = {}
+        for year in (2014, 2015):
+            fiscal_year = self.env['account.fiscalyear'].create({
+                'company_id': self.company.id,
+                'name': 'LU %d' % year,
+                'code': 'LU%d' % year,
+                'date_start': '%d-01-01' % year,
+                'date_stop': '%d-12-31' % year})
+            fiscal_year.create_period()
+            self.fiscal_years[year] = fiscal_year
+
+    def _create_move(self, account, counterpart, fiscal_year, amount):
+        period = fiscal_year.period_ids.filtered(lambda p: not p.special)[0]
+        journal = self.env['account.journal'].search(
+            [('company_id', '=', self.company.id)], limit=1)
+        self.env['account.move'].create({
+            'journal_id': journal.id,
+            'period_id': period.id,
+            'date': period.date_start,
+            'line_id': [
+                (0, 0, {'name': 'detail', 'account_id': account.id,
+                        'debit': amount}),
+                (0, 0, {'name': 'detail', 'account_id': counterpart.id,
+                        'credit': amount})]}).post()
+
+    def _get_data(self):
+        '''
+        :returns: the data of the report wizard, with the debit and credit
+                  columns and the previous year as comparison
+        '''
+        used_context = {'fiscalyear': self.fiscal_years[2015].id,
+                        'state': 'posted',
+                        'chart_account_id': self.chart.id}
+        comparison_context = dict(used_context,
+                                  fiscalyear=self.fiscal_years[2014].id)
+        return {'form': {
+            'account_report_id': (self.root.id, self.root.name),
+            'used_context': used_context,
+            'comparison_context': comparison_context,
+            'enable_filter': True,
+            'debit_credit': True,
+            'label_filter': 'Previous year',
+            'target_move': 'posted',
+        }}
+
+    def test_get_lines(self):
+        '''
+        The lines of the Luxembourg reports computed from the prefetched
+        balances are the lines of the core report
+        '''
+        report_model = self.registry('account.financial.report')
+        nodes = report_model.browse(
+            self.cr, self.uid, report_model._get_children_by_order(
+                self.cr, self.uid, [self.root.id]))
+        node = nodes.filtered(
+            lambda n: n.type == 'account_type' and n.account_type_ids and
+            n.display_detail != 'no_detail')[0]
+        account = self.env['account.account'].create({
+            'name': 'Detailed account',
+            'code': 'LU999',
+            'type': 'other',
+            'user_type': node.account_type_ids[0].id,
+            'parent_id': self.chart.id,
+            'company_id': self.company.id})
+        counterpart = self.env['account.account'].search(
+            [('type', '=', 'other'),
+             ('company_id', '=', self.company.id),
+             ('id', '!=', account.id)], limit=1)
+        self._create_move(account, counterpart, self.fiscal_years[2015],
+                          1000.0)
+        self._create_move(account, counterpart, self.fiscal_years[2014],
+                          250.0)
+
+        data = self._get_data()
+        parser = report_account_common_lu(self.cr, self.uid, '', {})
+        self.assertTrue(parser._is_lu_report(self.root.id))
+        lines = parser.get_lines(data)
+        self.env.invalidate_all()
+        expected = report_account_common(
+            self.cr, self.uid, '', {}).get_lines(data)
+        self.assertEqual(lines, expected)
+
+        account_lines = [line for line in lines
+                         if line['type'] == 'account' and
+                         line['name'].startswith('LU999')]
+        self.assertTrue(account_lines)
+        for line in account_lines:
+            self.assertEqual(abs(line['balance']), 1000.0)
+            self.assertEqual(abs(line['balance_cmp']), 250.0)
+            self.assertEqual(line['debit'], 1000.0)